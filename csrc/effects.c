@@ -1,4 +1,5 @@
 #include <stdint.h>
+#include "effects.h"
 
 void c_fade_strip(uint32_t *leds, int count, float factor) {
     if (!leds || count <= 0) return;
@@ -37,3 +38,147 @@ void c_draw_bar(uint32_t *leds, int start, int length,
         leds[i] = ((uint32_t)nr << 16) | ((uint32_t)ng << 8) | nb;
     }
 }
+
+static inline uint32_t blend_px(uint32_t dst, uint32_t src, int mode) {
+    if (mode == BLEND_SET) return src;
+    int dr = (dst >> 16) & 0xFF, dg = (dst >> 8) & 0xFF, db = dst & 0xFF;
+    int sr = (src >> 16) & 0xFF, sg = (src >> 8) & 0xFF, sb = src & 0xFF;
+    int r, g, b;
+    if (mode == BLEND_MAX) {
+        r = dr > sr ? dr : sr;
+        g = dg > sg ? dg : sg;
+        b = db > sb ? db : sb;
+    } else {
+        r = dr + sr; if (r > 255) r = 255;
+        g = dg + sg; if (g > 255) g = 255;
+        b = db + sb; if (b > 255) b = 255;
+    }
+    return ((uint32_t)r << 16) | ((uint32_t)g << 8) | (uint32_t)b;
+}
+
+/* Scale a packed colour by scale/256.  R and B are multiplied together in
+ * one word (they are 16 bits apart, so the products cannot collide). */
+static inline uint32_t scale_px(uint32_t c, uint32_t scale) {
+    uint32_t rb = (((c & 0xFF00FFu) * scale) >> 8) & 0xFF00FFu;
+    uint32_t g = (((c & 0x00FF00u) * scale) >> 8) & 0x00FF00u;
+    return rb | g;
+}
+
+void c_fade_fixed(uint32_t *leds, int count, uint32_t scale) {
+    if (!leds || count <= 0) return;
+    if (scale > 256) scale = 256;
+    for (int i = 0; i < count; ++i)
+        leds[i] = scale_px(leds[i], scale);
+}
+
+void c_build_hue_table(uint32_t *table, int size, float sat, float val) {
+    if (!table || size <= 0) return;
+    for (int i = 0; i < size; ++i) {
+        float h = (float)i / size * 6.0f;
+        int sector = (int)h;
+        float f = h - sector;
+        float p = val * (1.0f - sat);
+        float q = val * (1.0f - sat * f);
+        float t = val * (1.0f - sat * (1.0f - f));
+        float r, g, b;
+        switch (sector % 6) {
+        case 0: r = val; g = t; b = p; break;
+        case 1: r = q; g = val; b = p; break;
+        case 2: r = p; g = val; b = t; break;
+        case 3: r = p; g = q; b = val; break;
+        case 4: r = t; g = p; b = val; break;
+        default: r = val; g = p; b = q; break;
+        }
+        table[i] = ((uint32_t)(r * 255.0f) << 16) |
+                   ((uint32_t)(g * 255.0f) << 8) | (uint32_t)(b * 255.0f);
+    }
+}
+
+void c_fill_hue_ramp(uint32_t *leds, int count, int start, int length,
+                     const uint32_t *table, int table_size,
+                     float hue, float hue_step,
+                     float intensity, float intensity_step, int mode) {
+    if (!leds || !table || count <= 0 || length <= 0 || table_size <= 0) return;
+    if (length > count) length = count;
+    start %= count;
+    if (start < 0) start += count;
+    for (int k = 0; k < length; ++k) {
+        float h = hue + hue_step * k;
+        h -= (float)(int)h;
+        if (h < 0.0f) h += 1.0f;
+        int ti = (int)(h * table_size);
+        if (ti >= table_size) ti = table_size - 1;
+        float in = intensity + intensity_step * k;
+        if (in <= 0.0f) continue;
+        if (in > 1.0f) in = 1.0f;
+        int pos = start + k;
+        if (pos >= count) pos -= count;
+        leds[pos] = blend_px(leds[pos], scale_px(table[ti], (uint32_t)(in * 256.0f)), mode);
+    }
+}
+
+void c_fill_gradient(uint32_t *leds, int start, int length,
+                     uint32_t c0, uint32_t c1, int mode) {
+    if (!leds || length <= 0) return;
+    if (start < 0) start = 0;
+    int r0 = (c0 >> 16) & 0xFF, g0 = (c0 >> 8) & 0xFF, b0 = c0 & 0xFF;
+    int r1 = (c1 >> 16) & 0xFF, g1 = (c1 >> 8) & 0xFF, b1 = c1 & 0xFF;
+    int den = length > 1 ? length - 1 : 1;
+    for (int k = 0; k < length; ++k) {
+        uint32_t r = (uint32_t)(r0 + (r1 - r0) * k / den);
+        uint32_t g = (uint32_t)(g0 + (g1 - g0) * k / den);
+        uint32_t b = (uint32_t)(b0 + (b1 - b0) * k / den);
+        int i = start + k;
+        leds[i] = blend_px(leds[i], (r << 16) | (g << 8) | b, mode);
+    }
+}
+
+void c_scatter(uint32_t *leds, int count, const int32_t *idx,
+               const uint32_t *colors, int n, int mode) {
+    if (!leds || !idx || !colors) return;
+    for (int k = 0; k < n; ++k) {
+        int i = idx[k];
+        if (i < 0 || i >= count) continue;
+        leds[i] = blend_px(leds[i], colors[k], mode);
+    }
+}
+
+/* Final output stage, run once per frame before the push: per-channel
+ * gamma/brightness tables (lut[0..255] red, [256..511] green, [512..767]
+ * blue) map src into dst while the strip current is summed.  ma[] is the
+ * draw of one channel at full duty, idle_ma the quiescent draw per LED.  A
+ * frame over budget_ma (when > 0) is scaled down as a whole to fit; since
+ * the scale is rounded down the limited draw never exceeds the budget.
+ * out[0] = estimated mA, out[1] = mA after limiting.  src may equal dst. */
+void c_output_stage(const uint32_t *src, uint32_t *dst, int count,
+                    const uint8_t *lut, const float *ma, float idle_ma,
+                    float budget_ma, float *out) {
+    if (!src || !dst || !lut || !ma || count <= 0) return;
+    const uint8_t *lr = lut, *lg = lut + 256, *lb = lut + 512;
+    uint64_t sr = 0, sg = 0, sb = 0;
+    for (int i = 0; i < count; ++i) {
+        uint32_t c = src[i];
+        uint32_t r = lr[(c >> 16) & 0xFF];
+        uint32_t g = lg[(c >> 8) & 0xFF];
+        uint32_t b = lb[c & 0xFF];
+        sr += r;
+        sg += g;
+        sb += b;
+        dst[i] = (r << 16) | (g << 8) | b;
+    }
+    float idle = idle_ma * count;
+    float dyn = ((float)sr * ma[0] + (float)sg * ma[1] + (float)sb * ma[2]) / 255.0f;
+    float est = idle + dyn, lim = est;
+    if (budget_ma > 0.0f && est > budget_ma && dyn > 0.0f) {
+        float k = (budget_ma - idle) / dyn;
+        uint32_t scale = k > 0.0f ? (uint32_t)(k * 256.0f) : 0;
+        if (scale > 256) scale = 256;
+        for (int i = 0; i < count; ++i)
+            dst[i] = scale_px(dst[i], scale);
+        lim = idle + dyn * scale / 256.0f;
+    }
+    if (out) {
+        out[0] = est;
+        out[1] = lim;
+    }
+}
@@ -4,4 +4,23 @@
 void c_fade_strip(uint32_t *leds, int count, float factor);
 void c_draw_bar(uint32_t *leds, int start, int length,
                 uint8_t r, uint8_t g, uint8_t b, float intensity);
+
+/* blend modes for the batch kernels */
+#define BLEND_SET 0
+#define BLEND_ADD 1
+#define BLEND_MAX 2
+
+void c_fade_fixed(uint32_t *leds, int count, uint32_t scale);
+void c_build_hue_table(uint32_t *table, int size, float sat, float val);
+void c_fill_hue_ramp(uint32_t *leds, int count, int start, int length,
+                     const uint32_t *table, int table_size,
+                     float hue, float hue_step,
+                     float intensity, float intensity_step, int mode);
+void c_fill_gradient(uint32_t *leds, int start, int length,
+                     uint32_t c0, uint32_t c1, int mode);
+void c_scatter(uint32_t *leds, int count, const int32_t *idx,
+               const uint32_t *colors, int n, int mode);
+void c_output_stage(const uint32_t *src, uint32_t *dst, int count,
+                    const uint8_t *lut, const float *ma, float idle_ma,
+                    float budget_ma, float *out);
 #endif
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import time
+
+import numpy as np
+
+from pitch import PitchEstimator
+
+# name: (lo Hz, hi Hz)
+DEFAULT_BANDS = {
+    "bass": (40, 150),
+    "mid": (200, 2000),
+    "high": (4000, 8000),
+}
+LEAD_BAND = (200, 2000)
+
+
+class AudioAnalyzer:
+    # Streaming FFT analysis over the last `window` samples.  All buffers,
+    # the window function and the band slices are built once; a hop only
+    # writes into preallocated arrays.
+    def __init__(self, sample_rate, window, bands=DEFAULT_BANDS,
+                 lead_band=LEAD_BAND, pitch_min_amp=0.2):
+        self.sample_rate = sample_rate
+        self.pitch_min_amp = pitch_min_amp
+        self.size = window
+        # Every sample is stored twice (at i and i + window) so the newest
+        # `window` samples are always the contiguous slice ring[pos:pos+window].
+        self.ring = np.zeros(2 * window, dtype=np.float32)
+        self.pos = 0
+        self.work = np.zeros(window, dtype=np.float32)
+        self.win = np.hanning(window).astype(np.float32)
+        self.freqs = np.fft.rfftfreq(window, 1.0 / sample_rate)
+        self.spec = np.fft.rfft(self.work)
+        self.mag = np.zeros(self.spec.size, dtype=self.spec.real.dtype)
+        try:
+            np.fft.rfft(self.work, out=self.spec)
+            self._fft_out = True
+        except TypeError:
+            self._fft_out = False
+        self.bands = {name: self.band_slice(lo, hi)
+                      for name, (lo, hi) in bands.items()}
+        self.lead = self.band_slice(*lead_band)
+        self.pitch = PitchEstimator(self.freqs, lead_band, min_amp=pitch_min_amp,
+                                    dtype=self.mag.dtype)
+        self.confidence = 0.0
+        self.values = dict.fromkeys(self.bands, 0.0)
+        self.calls = 0
+        self.last_time = 0.0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def band_slice(self, lo, hi):
+        a = int(np.searchsorted(self.freqs, lo, "left"))
+        b = int(np.searchsorted(self.freqs, hi, "right"))
+        return slice(a, b)
+
+    def reset(self):
+        self.ring.fill(0.0)
+        self.pos = 0
+
+    def push(self, pcm):
+        # pcm: int16 mono samples
+        n = pcm.size
+        size = self.size
+        if n >= size:
+            pcm = pcm[-size:]
+            n = size
+        pos = self.pos
+        first = min(n, size - pos)
+        self._store(pcm[:first], pos)
+        if first < n:
+            self._store(pcm[first:], 0)
+        self.pos = (pos + n) % size
+
+    def _store(self, pcm, at):
+        end = at + pcm.size
+        seg = self.ring[at:end]
+        np.multiply(pcm, 1.0 / 32768.0, out=seg, casting="unsafe")
+        self.ring[at + self.size:end + self.size] = seg
+
+    def analyze(self):
+        t0 = time.perf_counter()
+        view = self.ring[self.pos:self.pos + self.size]
+        work = self.work
+        np.subtract(view, view.mean(), out=work)
+        np.multiply(work, self.win, out=work)
+        if self._fft_out:
+            np.fft.rfft(work, out=self.spec)
+        else:
+            self.spec = np.fft.rfft(work)
+        mag = self.mag
+        np.abs(self.spec, out=mag)
+
+        values = self.values
+        for name, sl in self.bands.items():
+            values[name] = float(mag[sl].mean()) if sl.stop > sl.start else 0.0
+        overall = float(mag.mean())
+
+        lead, self.confidence = self.pitch.estimate(mag)
+
+        dt = time.perf_counter() - t0
+        self.calls += 1
+        self.last_time = dt
+        self.total_time += dt
+        if dt > self.max_time:
+            self.max_time = dt
+        return lead, values, overall
+
+    def mean_time(self):
+        return self.total_time / self.calls if self.calls else 0.0
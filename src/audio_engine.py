@@ -1,115 +1,126 @@
 #!/usr/bin/env python3
-import time, os, json, subprocess, math, signal
-from collections import deque
+import time, os, math
 
 import numpy as np
 
-from protocol import (create_client_socket, MODE_MUSIC, MODE_AMBIENT, MODE_OFF,
-                      MODE_TREE, MODE_CHASE, MODE_SPARKLE, MODE_NAMES)
+from protocol import MODE_MUSIC, MODE_OFF, MODE_NAMES, StateEncoder
+from audio_analyzer import AudioAnalyzer
+from beat_tracker import BeatTracker
+from feature_cache import open_features
+from library import Library, PlayQueue, LibraryWatcher
+from decoder import (PlaybackSink, DecoderCache, SwitchTimer, PCM_CHANNELS,
+                     PCM_FRAME_BYTES)
+from audio_pipeline import PcmRing, StateSender, DecodeReader
 import buttons
+from notify import Notifier
+from metrics import Registry, serve as serve_metrics
 try:
-    from oled_i2c import oled_show
+    from oled_i2c import oled_show, oled_stats
 except ImportError:
     def oled_show(*args, **kwargs):
         pass
 
+    def oled_stats(**values):
+        pass
+
 SAMPLE_RATE = 44100
 FPS = 40
 FRAME_SIZE = int(SAMPLE_RATE / FPS)
-ANALYSIS_WINDOW = 3
+ANALYSIS_WINDOW = 3     # hops; tools/pitch_bench.py shows the trade-off
+PITCH_MIN_CONFIDENCE = 0.1
 AUDIO_DEVICE = "plughw:CARD=Headphones,DEV=0"
+RING_HOPS = 8
+REPORT_INTERVAL = 10.0
+DISPLAY_STATS_INTERVAL = 1.0
+READER_STALL = 2.0      # s without decoded audio before heartbeats stop
+# "shm": shared-memory slot to the LED engine, falling back to the socket
+STATE_TRANSPORT = os.environ.get("STATE_TRANSPORT", "shm")
+METRICS_PATH = os.environ.get("AUDIO_METRICS", "/tmp/musical_lights.audio.metrics")
+# Latency model: each state carries the CLOCK_MONOTONIC time its audio is
+# heard -- PCM still in the pipe to the player (measured) plus the player's
+# and ALSA's own buffering (AUDIO_OUTPUT_DELAY; tools/latency.py measures
+# it).  The LED engine queues the state and takes its render + push time
+# off.  SYNC_AUDIO=0 sends states for immediate display instead.
+AUDIO_OUTPUT_DELAY = float(os.environ.get("AUDIO_OUTPUT_DELAY", 0.1))
+SYNC_AUDIO = os.environ.get("SYNC_AUDIO", "1") == "1"
+# play order: "all" (by name), "shuffle" or "playlist:<name>"; unset resumes
+# the saved queue (see tools/library.py)
+LIBRARY_QUEUE = os.environ.get("LIBRARY_QUEUE")
 
 
 class AudioEngine:
     def __init__(self):
-        base = os.path.dirname(os.path.abspath(__file__))
-        self.songs_dir = os.path.join(base, "..", "songs")
-        self.bpm_file = os.path.join(base, "..", "bpm_table.json")
         buttons.setup()
-        self.songs = sorted(f for f in os.listdir(self.songs_dir)
-                            if f.lower().endswith(".mp3"))
-        self.idx = 0
-        self.sock = None
+        # Long-pressing MODE toggles the lights off and back; the other
+        # buttons fire on the press edge.
+        self.buttons = buttons.ButtonEvents(long_pins=(buttons.BUTTON_MODE,))
+        self.mode_before_off = MODE_MUSIC
+        # Songs come from the library index; the watcher thread started in
+        # loop() keeps it (and the queue) in step with the songs directory.
+        self.library = Library()
+        self.queue = PlayQueue(self.library, LIBRARY_QUEUE)
+        self.track_id = None
+        self.sender = StateSender(shm=STATE_TRANSPORT == "shm")
+        self.encoder = StateEncoder()
+        self.ring = PcmRing(FRAME_SIZE * RING_HOPS)
         self.running = True
         self.note_smoother = None
-        self.bass_hist = deque(maxlen=FPS)
-        self.mid_hist = deque(maxlen=FPS)
         self.kick_env = 0.0
         self.snare_env = 0.0
         self.pitch_min_amp = 0.2
-        self.kick_rel = 1.6
-        self.kick_abs = 0.01
-        self.snare_rel = 1.4
-        self.snare_abs = 0.01
+        self.analyzer = AudioAnalyzer(SAMPLE_RATE, FRAME_SIZE * ANALYSIS_WINDOW,
+                                      pitch_min_amp=self.pitch_min_amp)
+        self.beats = BeatTracker(self.analyzer.freqs, FPS,
+                                 dtype=self.analyzer.mag.dtype)
+        self.beat_seed = None   # (bpm,) from the reader thread, applied here
         self.mode = MODE_MUSIC
         self.paused = False
-        try:
-            with open(self.bpm_file, "r") as f:
-                self.bpm_table = json.load(f)
-        except Exception:
-            self.bpm_table = {}
-
-    def connect(self):
-        if not self.sock:
-            self.sock = create_client_socket()
-
-    def send(self, msg):
-        if not self.sock:
-            self.connect()
-        if not self.sock:
-            return
-        try:
-            self.sock.sendall((msg + "\n").encode())
-        except BrokenPipeError:
-            self.sock = None
-
-    def analyze(self, samples):
-        if samples.size == 0:
-            return 0.0, 0.0, 0.0, 0.0
-        samples = samples - np.mean(samples)
-        win = np.hanning(samples.size).astype(np.float32)
-        spec = np.fft.rfft(samples * win)
-        mag = np.abs(spec)
-        freqs = np.fft.rfftfreq(samples.size, 1.0 / SAMPLE_RATE)
-
-        def band(lo, hi):
-            mask = (freqs >= lo) & (freqs <= hi)
-            if not np.any(mask):
-                return 0.0
-            return float(np.mean(mag[mask]))
-
-        bass = band(40, 150)
-        mid = band(200, 2000)
-        high = band(4000, 8000)
-        overall = float(np.mean(mag))
-
-        lead = 0.0
-        mask = (freqs >= 200) & (freqs <= 2000)
-        if np.any(mask):
-            mm = mag[mask]
-            peak = float(np.max(mm))
-            if peak > self.pitch_min_amp:
-                idx = int(np.argmax(mm))
-                lead = float(freqs[mask][idx])
-
-        self.bass_hist.append(bass)
-        self.mid_hist.append(mid)
-        bmean = float(np.mean(self.bass_hist)) if self.bass_hist else 0.0
-        mmean = float(np.mean(self.mid_hist)) if self.mid_hist else 0.0
-
-        if bmean > 0 and bass > max(self.kick_abs, self.kick_rel * bmean):
-            self.kick_env = 1.0
-        else:
-            self.kick_env *= 0.85
-        if mmean > 0 and mid > max(self.snare_abs, self.snare_rel * mmean):
-            self.snare_env = 1.0
-        else:
-            self.snare_env *= 0.85
+        self.sink = None
+        self.lookahead = 0.0    # apply_at - now of the last state
+        m = self.metrics = Registry("audio")
+        self.t_read = m.histogram("decode_read_seconds")
+        self.t_write = m.histogram("sink_write_seconds")
+        self.t_analyze = m.histogram("analyze_seconds")
+        self.t_send = m.histogram("send_seconds")
+        self.t_hop = m.histogram("hop_seconds")     # PCM ready -> state sent
+        m.gauge("ring_depth", lambda: self.ring.depth())
+        m.gauge("ring_dropped_total", lambda: self.ring.dropped)
+        m.gauge("states_sent_total", lambda: self.sender.sent)
+        m.gauge("states_dropped_total", lambda: self.sender.dropped)
+        m.gauge("shm_attached", lambda: self.sender.attached)
+        m.gauge("analysis_live", lambda: self.track is None)
+        m.gauge("queue_length", lambda: len(self.queue))
+        m.gauge("lookahead_seconds", lambda: self.lookahead)
+
+    @property
+    def idx(self):
+        return self.queue.pos
 
-        self.kick_env = float(max(0.0, min(1.0, self.kick_env)))
-        self.snare_env = float(max(0.0, min(1.0, self.snare_env)))
+    def send(self, mode, note=-1, level=0.0, gliss=0.0, kick=0.0, snare=0.0,
+             phase=0.0, tempo=0.0, downbeat=0.0, apply_at=0.0):
+        t0 = self.t_send.start()
+        self.sender.send(self.encoder.encode(mode, note, level, gliss,
+                                             kick, snare, phase, tempo,
+                                             downbeat, apply_at))
+        self.t_send.stop(t0)
+
+    def heard_at(self, behind=0):
+        # When the sample `behind` samples before the newest one written to
+        # the sink comes out of the speaker.
+        now = time.monotonic()
+        t = (now + self.sink.queued() / (SAMPLE_RATE * PCM_FRAME_BYTES)
+             + AUDIO_OUTPUT_DELAY - behind / SAMPLE_RATE)
+        self.lookahead = t - now
+        return t
+
+    def analyze(self):
+        lead, bands, overall = self.analyzer.analyze()
+        beats = self.beats
+        beats.process(self.analyzer.mag)
+        self.kick_env = beats.kick_env
+        self.snare_env = beats.snare_env
         level = min(1.0, overall * 4.0)
-        return lead, bass, high, level
+        return lead, bands["bass"], bands["high"], level
 
     @staticmethod
     def freq_to_note(freq):
@@ -121,113 +132,207 @@ class AudioEngine:
         gliss = float(midi - near)
         return idx, gliss, midi
 
-    def loop(self):
-        window_samples = FRAME_SIZE * ANALYSIS_WINDOW
-        buf = np.zeros(window_samples, dtype=np.int16)
-        while self.running:
-            if not self.songs:
-                oled_show("No songs", "", "")
-                time.sleep(1.0)
-                continue
-            name = self.songs[self.idx]
-            path = os.path.join(self.songs_dir, name)
-            bpm = self.bpm_table.get(name, {}).get("bpm")
-            line3 = f"BPM: {bpm:.0f}" if bpm else MODE_NAMES.get(self.mode, "Music")
-            oled_show("Playing:", name[:15], line3)
-            cmd = [
-                "ffmpeg", "-hide_banner", "-loglevel", "error",
-                "-i", path,
-                "-filter_complex",
-                "[0:a]asplit=2[out1][out2];"
-                "[out2]aresample=44100,pan=mono|c0=c0[pcm]",
-                "-map", "[out1]", "-f", "alsa", AUDIO_DEVICE,
-                "-map", "[pcm]", "-f", "s16le", "-"
-            ]
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=FRAME_SIZE * 4)
-            self.note_smoother = None
-            self.bass_hist.clear()
-            self.mid_hist.clear()
-            self.kick_env = 0.0
-            self.snare_env = 0.0
-            self.paused = False
-            while proc.poll() is None and self.running:
-                # Buttons
-                if buttons.button_pressed(buttons.BUTTON_MODE):
-                    # cycle through 6 modes
-                    self.mode = (self.mode + 1) % 6
-                    oled_show("Mode:", MODE_NAMES.get(self.mode, "?"), name[:15])
-                    if self.mode == MODE_OFF:
-                        self.send(f"STATE {MODE_OFF} -1 0 0 0 0")
-                    time.sleep(0.1)
-                if buttons.button_pressed(buttons.BUTTON_NEXT):
-                    self.idx = (self.idx + 1) % len(self.songs)
-                    proc.terminate(); break
-                if buttons.button_pressed(buttons.BUTTON_PREV):
-                    self.idx = (self.idx - 1) % len(self.songs)
-                    proc.terminate(); break
-                if buttons.button_pressed(buttons.BUTTON_PLAY):
-                    if not self.paused:
-                        proc.send_signal(signal.SIGSTOP)
-                        self.paused = True
-                        oled_show("Paused", name[:15], "")
-                    else:
-                        proc.send_signal(signal.SIGCONT)
-                        self.paused = False
-                        oled_show("Playing", name[:15], MODE_NAMES.get(self.mode, ""))
-                    time.sleep(0.2)
-                if self.paused:
-                    time.sleep(0.05)
-                    continue
+    def live_step(self, pcm):
+        self.analyzer.push(pcm)
+        lead, bass, high, level = self.analyze()
+        # noise burst or chord: no clear lead, but not silence either
+        hold = lead > 0.0 and self.analyzer.confidence < PITCH_MIN_CONFIDENCE
+        if hold:
+            lead = 0.0
+        note_idx, gliss, midi = self.freq_to_note(lead)
+        if midi is not None:
+            if self.note_smoother is None:
+                self.note_smoother = midi
+            else:
+                self.note_smoother = 0.75 * self.note_smoother + 0.25 * midi
+            final_midi = self.note_smoother
+            final_note = int(round(final_midi)) % 12
+        else:
+            if self.note_smoother is not None:
+                if not hold:
+                    self.note_smoother = 0.9 * self.note_smoother
+                final_note = int(round(self.note_smoother)) % 12
+            else:
+                final_note = -1
+        return final_note, gliss, level
 
-                raw = proc.stdout.read(FRAME_SIZE * 2)
-                if not raw:
-                    break
-                new = np.frombuffer(raw, dtype=np.int16)
-                n = new.size
-                if n > window_samples:
-                    new = new[-window_samples:]; n = new.size
-                buf = np.roll(buf, -n)
-                buf[-n:] = new
-                f32 = buf.astype(np.float32) / 32768.0
-                lead, bass, high, level = self.analyze(f32)
-                note_idx, gliss, midi = self.freq_to_note(lead)
-                if midi is not None:
-                    if self.note_smoother is None:
-                        self.note_smoother = midi
-                    else:
-                        self.note_smoother = 0.75 * self.note_smoother + 0.25 * midi
-                    final_midi = self.note_smoother
-                    final_note = int(round(final_midi)) % 12
-                else:
-                    if self.note_smoother is not None:
-                        self.note_smoother = 0.9 * self.note_smoother
-                        final_note = int(round(self.note_smoother)) % 12
-                    else:
-                        final_note = -1
-
-                if self.mode == MODE_MUSIC:
-                    msg = f"STATE {MODE_MUSIC} {final_note} {level:.2f} {gliss:.3f} {self.kick_env:.2f} {self.snare_env:.2f}"
-                elif self.mode == MODE_AMBIENT:
-                    msg = f"STATE {MODE_AMBIENT} -1 {level:.2f} 0.000 0.00 0.00"
-                elif self.mode == MODE_OFF:
-                    msg = f"STATE {MODE_OFF} -1 0 0 0 0"
-                elif self.mode == MODE_TREE:
-                    msg = f"STATE {MODE_TREE} -1 {level:.2f} 0 0 0"
-                elif self.mode == MODE_CHASE:
-                    msg = f"STATE {MODE_CHASE} -1 {level:.2f} 0 0 0"
-                elif self.mode == MODE_SPARKLE:
-                    msg = f"STATE {MODE_SPARKLE} -1 {level:.2f} 0 0 0"
+    def song_path(self, tid):
+        return self.library.path_of(tid) or os.devnull
+
+    def start_track(self, idx):
+        # Hand playback over to the (ideally prewarmed) decoder for queue
+        # position idx and start warming its neighbours.  Decoders are keyed
+        # by track id, so queue changes never play the wrong prefetch.
+        # Analysis state carries over.  Returns None if the reader stopped
+        # while the queue was empty.
+        q = self.queue
+        tid = self.track_id = q.seek(idx)
+        while tid is None:
+            # every song gone: wait for the watcher to add one, like loop()
+            oled_show("No songs", "", "")
+            time.sleep(1.0)
+            if self.reader.stopped:
+                return None
+            tid = self.track_id = q.seek(idx)
+        name = self.library.name_of(tid)
+        dec, warm = self.decoders.take(tid)
+        self.switch_timer.begin(warm)
+        self.decoders.prefetch({q.id_at(q.pos + 1), q.id_at(q.pos - 1)} - {tid})
+        entry = self.library.entry(tid)
+        # Cached feature tracks replace live FFT analysis for this song.
+        self.track = open_features(self.song_path(tid), entry)
+        bpm = entry.get("bpm")
+        line3 = f"BPM: {bpm:.0f}" if bpm else MODE_NAMES.get(self.mode, "Music")
+        oled_show("Playing:", name[:15], line3)
+        oled_stats(bpm=bpm)
+        self.beat_seed = (bpm,)
+        return dec
+
+    def end_track(self, dec):
+        dec.close()
+        a = self.analyzer
+        if self.track is not None:
+            print("features: played from cache", flush=True)
+        else:
+            print("analysis: %d hops, %.2f ms mean, %.2f ms max"
+                  % (a.calls, a.mean_time() * 1000.0, a.max_time * 1000.0),
+                  flush=True)
+
+    def on_first_write(self):
+        dt = self.switch_timer.first_write()
+        if dt is not None:
+            print("track switch: %.1f ms (%s)"
+                  % (dt * 1000.0, "warm" if self.switch_timer.warm else "cold"),
+                  flush=True)
+
+    def on_button(self, pin, kind):
+        name = self.library.name_of(self.track_id)
+        if pin == buttons.BUTTON_MODE:
+            if kind == buttons.LONG_PRESS:
+                if self.mode == MODE_OFF:
+                    self.mode = self.mode_before_off
                 else:
-                    msg = f"STATE {MODE_MUSIC} {final_note} {level:.2f} {gliss:.3f} {self.kick_env:.2f} {self.snare_env:.2f}"
-                self.send(msg)
-                time.sleep(1.0 / FPS * 0.5)
-            if proc.poll() is None:
-                proc.terminate()
-            try:
-                proc.wait(timeout=1.0)
-            except Exception:
-                pass
-            self.idx = (self.idx + 1) % len(self.songs)
+                    self.mode_before_off = self.mode
+                    self.mode = MODE_OFF
+            else:
+                self.mode = (self.mode + 1) % len(MODE_NAMES)
+            oled_show("Mode:", MODE_NAMES.get(self.mode, "?"), name[:15])
+            if self.mode == MODE_OFF:
+                self.send(MODE_OFF)
+        elif pin == buttons.BUTTON_NEXT:
+            self.reader.skip(1)
+        elif pin == buttons.BUTTON_PREV:
+            self.reader.skip(-1)
+        elif pin == buttons.BUTTON_PLAY:
+            self.paused = not self.paused
+            if self.paused:
+                self.reader.pause()
+                oled_show("Paused", name[:15], "")
+            else:
+                self.reader.resume()
+                oled_show("Playing", name[:15], MODE_NAMES.get(self.mode, ""))
+
+    def report(self):
+        print("pipeline: ring %d/%d samples, %d dropped; sent %d, dropped %d"
+              % (self.ring.depth(), self.ring.cap, self.ring.dropped,
+                 self.sender.sent, self.sender.dropped), flush=True)
+
+    def process_hop(self, hop):
+        # Analysis stage for one hop: features (live or cached) -> state.
+        t_hop = self.t_hop.start()
+        if self.beat_seed is not None:
+            seed, self.beat_seed = self.beat_seed, None
+            self.beats.seed(seed[0])
+        beats = self.beats
+        track = self.track
+        if track is None:
+            t0 = self.t_analyze.start()
+            final_note, gliss, level = self.live_step(hop)
+            self.t_analyze.stop(t0)
+            # centre of this hop; the samples after it are still in the ring
+            behind = self.ring.depth() + FRAME_SIZE // 2
+        else:
+            row = track.at(self.reader.position)
+            final_note = int(row["note"])
+            gliss = float(row["gliss"])
+            level = float(row["level"])
+            self.kick_env = float(row["kick"])
+            self.snare_env = float(row["snare"])
+            beats.process_cached(int(row["beat"]), self.kick_env,
+                                 self.snare_env)
+            behind = 0          # row of the newest position written
+        apply_at = self.heard_at(behind) if SYNC_AUDIO else 0.0
+
+        # Full state in every mode; the LED engine's preset for the
+        # mode decides what it uses.
+        self.send(self.mode, final_note, level, gliss, self.kick_env,
+                  self.snare_env, beats.phase, beats.bpm, beats.downbeat,
+                  apply_at)
+        self.t_hop.stop(t_hop)
+
+    def loop(self):
+        self.watcher = LibraryWatcher(self.library)
+        self.watcher.start()
+        while not len(self.queue):
+            oled_show("No songs", "", "")
+            time.sleep(1.0)
+        self.sink = PlaybackSink(AUDIO_DEVICE)
+        self.decoders = DecoderCache(self.song_path)
+        self.switch_timer = SwitchTimer()
+        self.track = None
+        metrics_srv = serve_metrics(self.metrics, METRICS_PATH)
+        self.reader = DecodeReader(self, self.sink, self.ring,
+                                   FRAME_SIZE * PCM_FRAME_BYTES, PCM_CHANNELS)
+        self.reader.start()
+        self.buttons.start()
+        self.notifier = Notifier()
+        self.notifier.ready()
+        hop = np.zeros(FRAME_SIZE, dtype=np.int16)
+        next_report = time.monotonic() + REPORT_INTERVAL
+        next_stats = time.monotonic() + DISPLAY_STATS_INTERVAL
+        stats_sent = 0
+        seen_chunks = 0
+        progress = time.monotonic()
+        try:
+            while self.running:
+                for pin, kind in self.buttons.poll():
+                    self.on_button(pin, kind)
+
+                now = time.monotonic()
+                # Heartbeats vouch for the reader, not this loop: they stop
+                # when no audio has been decoded for READER_STALL, unless
+                # playback is paused or the queue is empty.
+                reader = self.reader
+                if (reader.chunks != seen_chunks or not reader.playing.is_set()
+                        or not len(self.queue)):
+                    seen_chunks = reader.chunks
+                    progress = now
+                if now - progress < READER_STALL:
+                    self.notifier.beat(now)
+                if now >= next_report:
+                    self.report()
+                    next_report = now + REPORT_INTERVAL
+                if now >= next_stats:
+                    # state updates per second actually reaching the LEDs
+                    oled_stats(fps=(self.sender.sent - stats_sent)
+                               / DISPLAY_STATS_INTERVAL)
+                    stats_sent = self.sender.sent
+                    next_stats = now + DISPLAY_STATS_INTERVAL
+
+                # Analysis stage: one hop at a time, at the rate PCM arrives.
+                if not self.ring.read(hop, timeout=0.05):
+                    continue
+                self.process_hop(hop)
+        finally:
+            self.buttons.stop()
+            self.reader.stop()
+            self.reader.join(timeout=2.0)
+            self.decoders.close()
+            self.watcher.stop()
+            self.sink.close()
+            self.sender.close()
+            if metrics_srv is not None:
+                metrics_srv.close()
 
 
 if __name__ == "__main__":
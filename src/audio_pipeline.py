@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import threading, queue, time, socket, array
+
+import numpy as np
+
+from protocol import (SOCKET_PATH, PRIORITY_DEFAULT, MSG_ACK, HEADER,
+                      create_client_socket, encode_hello, encode_shm)
+from shm_state import ShmStateWriter, HAVE_EVENTFD
+
+RECONNECT_INTERVAL = 0.25     # quick to find a restarted LED engine
+
+
+class PcmRing:
+    # Bounded single-producer/single-consumer ring of mono int16 samples.
+    # The lock only covers index updates and two slice copies per call.
+    # When the consumer falls behind, the oldest samples are dropped.
+    def __init__(self, capacity):
+        self.buf = np.zeros(capacity, dtype=np.int16)
+        self.cap = capacity
+        self.head = 0   # total samples consumed
+        self.tail = 0   # total samples produced
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def depth(self):
+        return self.tail - self.head
+
+    def clear(self):
+        with self.cond:
+            self.head = self.tail
+
+    def write(self, pcm):
+        n = pcm.size
+        if n > self.cap:
+            self.dropped += n - self.cap
+            pcm = pcm[-self.cap:]
+            n = self.cap
+        with self.cond:
+            over = self.tail - self.head + n - self.cap
+            if over > 0:
+                self.head += over
+                self.dropped += over
+            self._copy_in(pcm, self.tail % self.cap)
+            self.tail += n
+            self.cond.notify()
+
+    def read(self, out, timeout=None):
+        n = out.size
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.tail - self.head >= n,
+                                      timeout):
+                return False
+            self._copy_out(out, self.head % self.cap)
+            self.head += n
+        return True
+
+    def _copy_in(self, pcm, at):
+        first = min(pcm.size, self.cap - at)
+        self.buf[at:at + first] = pcm[:first]
+        if first < pcm.size:
+            self.buf[:pcm.size - first] = pcm[first:]
+
+    def _copy_out(self, out, at):
+        first = min(out.size, self.cap - at)
+        out[:first] = self.buf[at:at + first]
+        if first < out.size:
+            out[first:] = self.buf[:out.size - first]
+
+
+class StateSender:
+    # Non-blocking sender.  A message that cannot be written right away is
+    # dropped (the next one supersedes it); a partially written message is
+    # finished first so the stream stays framed.
+    #
+    # With shm=True the sender also offers a shared-memory slot on connect.
+    # Once the LED engine acknowledges it, states go to the slot instead of
+    # the socket, which then only serves to notice the peer going away.
+    def __init__(self, path=SOCKET_PATH, priority=PRIORITY_DEFAULT, name="audio",
+                 shm=False):
+        self.path = path
+        self.hello = encode_hello(priority, name)
+        self.sock = None
+        self.pending = b""
+        self.sent = 0
+        self.dropped = 0
+        self.next_connect = 0.0
+        self.slot = None
+        self.attached = False
+        self.next_check = 0.0
+        if shm and HAVE_EVENTFD:
+            try:
+                self.slot = ShmStateWriter()
+            except OSError as e:
+                print("shared memory unavailable, using socket:", e)
+
+    def connect(self):
+        now = time.monotonic()
+        if self.sock or now < self.next_connect:
+            return self.sock
+        self.next_connect = now + RECONNECT_INTERVAL
+        self.sock = create_client_socket(self.path)
+        if self.sock:
+            self.sock.setblocking(False)
+            # goes out ahead of the first state
+            self.pending = self.hello
+            if self.slot is not None:
+                self._offer_slot()
+        return self.sock
+
+    def _offer_slot(self):
+        msg = self.hello + encode_shm(self.slot.name)
+        fds = array.array("i", [self.slot.efd])
+        try:
+            self.sock.sendmsg([msg], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+            self.pending = b""
+        except OSError:
+            pass                        # plain socket transport then
+
+    def _poll_peer(self):
+        # ACK from the LED engine, or EOF when it went away.
+        try:
+            data = self.sock.recv(64)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._drop_conn()
+        elif (len(data) >= HEADER.size and data[3] == MSG_ACK
+              and self.slot is not None):
+            self.attached = True
+
+    def _drop_conn(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.sock = None
+        self.attached = False
+
+    def send(self, msg):
+        if self.attached:
+            now = time.monotonic()
+            if now >= self.next_check:
+                self.next_check = now + RECONNECT_INTERVAL
+                self._poll_peer()
+            if self.attached:
+                self.slot.publish(msg)
+                self.sent += 1
+                return True
+        if not self.connect():
+            self.dropped += 1
+            return False
+        if self.slot is not None:
+            self._poll_peer()
+            if self.sock is None:
+                self.dropped += 1
+                return False
+        try:
+            if self.pending:
+                n = self.sock.send(self.pending)
+                self.pending = self.pending[n:]
+                if self.pending:
+                    self.dropped += 1
+                    return False
+            n = self.sock.send(msg)
+            if n < len(msg):
+                self.pending = bytes(msg[n:])
+        except BlockingIOError:
+            self.dropped += 1
+            return False
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            self._drop_conn()
+            self.dropped += 1
+            return False
+        self.sent += 1
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self._drop_conn()
+        if self.slot is not None:
+            self.slot.close()
+            self.slot = None
+
+
+class DecodeReader(threading.Thread):
+    # Reader stage: pulls PCM from the current decoder, feeds the playback
+    # sink (whose blocking write paces the whole pipeline) and publishes the
+    # mono samples to the analysis ring.  Track changes and pause/resume are
+    # requests handled between chunks, so ffmpeg is never signalled.
+    def __init__(self, engine, sink, ring, hop_bytes, channels):
+        super().__init__(daemon=True)
+        self.engine = engine
+        self.sink = sink
+        self.ring = ring
+        self.hop_bytes = hop_bytes
+        self.channels = channels
+        self.requests = queue.SimpleQueue()
+        self.playing = threading.Event()
+        self.playing.set()
+        self.stopped = False
+        self.position = 0.0
+        self.chunks = 0
+
+    def skip(self, delta):
+        self.requests.put(delta)
+
+    def pause(self):
+        self.playing.clear()
+
+    def resume(self):
+        self.playing.set()
+
+    def stop(self):
+        self.stopped = True
+        self.playing.set()
+
+    def run(self):
+        eng = self.engine
+        dec = eng.start_track(eng.idx)
+        try:
+            while dec is not None and not self.stopped:
+                try:
+                    delta = self.requests.get_nowait()
+                except queue.Empty:
+                    delta = 0
+                if delta:
+                    eng.end_track(dec)
+                    dec = eng.start_track(eng.idx + delta)
+                    self.ring.clear()
+                    continue
+                if not self.playing.wait(0.1):
+                    continue
+                t0 = eng.t_read.start()
+                raw = dec.read(self.hop_bytes)
+                eng.t_read.stop(t0)
+                if not raw:
+                    # End of track: next decoder is already primed.
+                    eng.end_track(dec)
+                    dec = eng.start_track(eng.idx + 1)
+                    continue
+                t0 = eng.t_write.start()
+                self.sink.write(raw)
+                eng.t_write.stop(t0)
+                eng.on_first_write()
+                self.ring.write(np.frombuffer(raw, dtype=np.int16)[0::self.channels])
+                self.position = dec.position()
+                self.chunks += 1
+        finally:
+            if dec is not None:
+                dec.close()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import numpy as np
+
+# Onset detection runs on a bank of log-spaced triangular bands: one matmul
+# maps the FFT magnitudes onto them, and band groups (kick, snare, all) are a
+# second, tiny matmul over the positive log-energy differences (spectral
+# flux).  Thresholds follow a running mean and mean deviation, updated in
+# O(1) per hop.  A phase-locked loop keeps beat phase and tempo between
+# onsets; the tempo is seeded from the library BPM when the song is known.
+ONSET_BANDS = 24
+FMIN = 30.0
+FMAX = 8000.0
+KICK_BAND = (30, 150)
+SNARE_BAND = (200, 5000)
+LOG_GAIN = 100.0            # log1p(gain * energy): roughly a dB scale
+ADAPT = 0.03                # weight of each hop in the running mean/deviation
+THRESH_K = 2.0              # onset: flux > mean + k * deviation
+THRESH_FLOOR = 0.02
+REFRACTORY = 0.1            # seconds between onsets of one detector
+ENV_DECAY = 0.85            # same per-hop decay as the old kick/snare envelope
+TEMPO_RANGE = (60.0, 180.0)
+TEMPO_PRIOR = 120.0         # octave-error prior for unseeded tempo estimates
+SEED_TOLERANCE = 0.08       # a seeded tempo may drift this much
+TEMPO_HISTORY = 6.0         # seconds of onset strength kept for tempo search
+TEMPO_EVERY = 1.0           # seconds between tempo searches
+PLL_PHASE_GAIN = 0.2
+PLL_FREQ_GAIN = 0.02
+PLL_WINDOW = 0.25           # only onsets this close (in beats) correct phase
+BEATS_PER_BAR = 4
+BAR_DECAY = 0.9             # per-bar decay of the downbeat evidence
+
+
+def log_filterbank(freqs, n_bands=ONSET_BANDS, fmin=FMIN, fmax=FMAX,
+                   dtype=np.float32):
+    # Triangular bands with log-spaced centres, each normalised to unit sum.
+    # Bands narrower than an FFT bin fall back to their nearest bin.
+    edges = np.geomspace(fmin, fmax, n_bands + 2)
+    fb = np.zeros((n_bands, freqs.size), dtype=dtype)
+    for i in range(n_bands):
+        lo, mid, hi = edges[i:i + 3]
+        tri = np.minimum((freqs - lo) / (mid - lo), (hi - freqs) / (hi - mid))
+        np.maximum(tri, 0.0, out=tri)
+        if tri.sum() <= 0.0:
+            tri[int(np.abs(freqs - mid).argmin())] = 1.0
+        fb[i] = tri / tri.sum()
+    return fb, edges[1:-1]
+
+
+class AdaptiveThreshold:
+    # Onset picker over one flux signal: fires when the value rises above a
+    # running mean + k * mean absolute deviation, at most once per refractory
+    # period.
+    def __init__(self, refractory_hops, k=THRESH_K, floor=THRESH_FLOOR,
+                 alpha=ADAPT):
+        self.refractory = refractory_hops
+        self.k = k
+        self.floor = floor
+        self.alpha = alpha
+        self.mean = 0.0
+        self.dev = 0.0
+        self.wait = 0
+
+    def step(self, x):
+        fire = False
+        if self.wait:
+            self.wait -= 1
+        elif x > self.mean + self.k * self.dev + self.floor:
+            fire = True
+            self.wait = self.refractory
+        d = x - self.mean
+        self.mean += self.alpha * d
+        self.dev += self.alpha * (abs(d) - self.dev)
+        return fire
+
+
+class BeatTracker:
+    def __init__(self, freqs, fps, n_bands=ONSET_BANDS, dtype=np.float32):
+        self.fps = fps
+        self.fb, centres = log_filterbank(freqs, n_bands, dtype=dtype)
+        groups = np.zeros((3, n_bands), dtype=dtype)
+        for row, (lo, hi) in enumerate((KICK_BAND, SNARE_BAND, (0, FMAX))):
+            sel = (centres >= lo) & (centres <= hi)
+            groups[row, sel] = 1.0 / max(1, int(sel.sum()))
+        self.groups = groups
+        self.energy = np.zeros(n_bands, dtype=dtype)
+        self.prev = np.zeros(n_bands, dtype=dtype)
+        self.diff = np.zeros(n_bands, dtype=dtype)
+        self.flux = np.zeros(3, dtype=dtype)
+        hops = max(1, int(round(REFRACTORY * fps)))
+        self.kick = AdaptiveThreshold(hops)
+        self.snare = AdaptiveThreshold(hops)
+        self.onset = AdaptiveThreshold(hops)
+        self.history = np.zeros(int(TEMPO_HISTORY * fps), dtype=np.float32)
+        self.hist_pos = 0
+        self.tempo_every = max(1, int(TEMPO_EVERY * fps))
+        self.lags = np.arange(int(fps * 60.0 / TEMPO_RANGE[1]),
+                              int(fps * 60.0 / TEMPO_RANGE[0]) + 1)
+        lag_bpm = 60.0 * fps / self.lags
+        self.lag_prior = np.exp(-0.5 * np.log2(lag_bpm / TEMPO_PRIOR) ** 2)
+        self.reset()
+
+    def reset(self):
+        self.prev.fill(0.0)
+        self.history.fill(0.0)
+        self.hist_pos = 0
+        self.hops = 0
+        self.kick_env = 0.0
+        self.snare_env = 0.0
+        self.downbeat = 0.0
+        self.seed_period = None
+        self.period = self.fps * 60.0 / TEMPO_PRIOR
+        self.phase = 0.0
+        self.beat = 0
+        self.bar = np.zeros(BEATS_PER_BAR)
+        self.bar_start = 0
+
+    def seed(self, bpm):
+        # Known tempo for the new track (from the BPM table), or None.
+        self.reset()
+        if bpm and TEMPO_RANGE[0] / 2 <= bpm <= TEMPO_RANGE[1] * 2:
+            while bpm < TEMPO_RANGE[0]:
+                bpm *= 2.0
+            while bpm > TEMPO_RANGE[1]:
+                bpm /= 2.0
+            self.seed_period = self.period = self.fps * 60.0 / bpm
+
+    @property
+    def bpm(self):
+        return 60.0 * self.fps / self.period
+
+    def process(self, mag):
+        # One hop of live analysis from the analyzer's magnitude spectrum.
+        e = self.energy
+        np.dot(self.fb, mag, out=e)
+        np.multiply(e, LOG_GAIN, out=e)
+        np.log1p(e, out=e)
+        np.subtract(e, self.prev, out=self.diff)
+        np.maximum(self.diff, 0.0, out=self.diff)
+        self.energy, self.prev = self.prev, e
+        np.dot(self.groups, self.diff, out=self.flux)
+        kick, snare, onset = self.flux.tolist()
+        kick_hit = self.kick.step(kick)
+        snare_hit = self.snare.step(snare)
+        hit = self.onset.step(onset) or kick_hit
+        self._envelopes(kick_hit, snare_hit)
+        self._track(onset, hit, kick_hit, kick)
+
+    def process_cached(self, beat, kick, snare):
+        # One hop from a cached feature row: envelopes are precomputed and
+        # beat frames come from the offline tracker.
+        self.kick_env = kick
+        self.snare_env = snare
+        self._track(0.0, bool(beat), kick >= 0.99, kick)
+
+    def _envelopes(self, kick_hit, snare_hit):
+        self.kick_env = 1.0 if kick_hit else self.kick_env * ENV_DECAY
+        self.snare_env = 1.0 if snare_hit else self.snare_env * ENV_DECAY
+
+    def _track(self, strength, hit, kick_hit, kick):
+        self.hops += 1
+        self.history[self.hist_pos] = strength
+        self.hist_pos = (self.hist_pos + 1) % self.history.size
+        if (self.seed_period is None and strength
+                and self.hops % self.tempo_every == 0
+                and self.hops >= self.history.size // 2):
+            self._estimate_tempo()
+
+        self.downbeat *= ENV_DECAY
+        self.phase += 1.0 / self.period
+        if hit:
+            err = self.phase - round(self.phase)    # onsets belong on beats
+            if abs(err) < PLL_WINDOW:
+                self.phase -= PLL_PHASE_GAIN * err
+                self._nudge_period(err)
+                if kick_hit:
+                    self.bar[self.beat % BEATS_PER_BAR] += kick
+        while self.phase >= 1.0:
+            self.phase -= 1.0
+            self._next_beat()
+        if self.phase < 0.0:
+            # pulled back across the beat it just started
+            self.phase += 1.0
+            self.beat = (self.beat - 1) % BEATS_PER_BAR
+
+    def _next_beat(self):
+        self.beat = (self.beat + 1) % BEATS_PER_BAR
+        if self.beat == 0:
+            self.bar *= BAR_DECAY
+            self.bar_start = int(self.bar.argmax())
+        if self.beat == self.bar_start:
+            self.downbeat = 1.0
+
+    def _nudge_period(self, err):
+        # early onsets (err < 0) shorten the period, late ones lengthen it
+        period = self.period * (1.0 + PLL_FREQ_GAIN * err)
+        if self.seed_period is not None:
+            lo = self.seed_period * (1.0 - SEED_TOLERANCE)
+            hi = self.seed_period * (1.0 + SEED_TOLERANCE)
+        else:
+            lo, hi = self.lags[0], self.lags[-1]
+        self.period = min(hi, max(lo, period))
+
+    def _estimate_tempo(self):
+        # Autocorrelation of the onset strength over the lag range, weighted
+        # towards TEMPO_PRIOR to avoid octave errors.  Runs once per second.
+        h = np.roll(self.history, -self.hist_pos)
+        h = h - h.mean()
+        n = h.size
+        ac = np.array([np.dot(h[:n - lag], h[lag:]) for lag in self.lags])
+        if ac.max() <= 0.0:
+            return
+        lag = self.lags[int((ac * self.lag_prior).argmax())]
+        # move towards the new estimate; the PLL does the fine tuning
+        self.period += 0.5 * (lag - self.period)
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import time
+import time, queue, threading
 try:
     import RPi.GPIO as GPIO
     HAVE_GPIO = True
@@ -11,7 +11,6 @@ BUTTON_NEXT = 6
 BUTTON_PREV = 13
 BUTTON_PLAY = 19
 
-_last = {}
 _setup = False
 
 
@@ -33,14 +32,149 @@ def cleanup():
     _setup = False
 
 
-def button_pressed(pin, debounce=0.05):
-    if not HAVE_GPIO:
-        return False
-    now = time.time()
-    last = _last.get(pin, 0.0)
-    if now - last < debounce:
-        return False
-    if GPIO.input(pin) == GPIO.LOW:
-        _last[pin] = now
-        return True
-    return False
+# Edge-triggered events.  GPIO callbacks only timestamp the edge; debouncing
+# and press classification run on a worker thread, and the consumer drains
+# ready events with poll() without blocking.
+PRESS = "press"
+LONG_PRESS = "long"
+DOUBLE_PRESS = "double"
+
+ALL_BUTTONS = (BUTTON_MODE, BUTTON_NEXT, BUTTON_PREV, BUTTON_PLAY)
+
+
+class ButtonEvents:
+    def __init__(self, pins=ALL_BUTTONS, debounce=0.03, long_press=0.8,
+                 double_press=0.3, long_pins=(), double_pins=()):
+        self.pins = tuple(pins)
+        self.debounce = debounce
+        self.long_press = long_press
+        self.double_press = double_press
+        # Pins without long/double detection fire PRESS on the falling edge;
+        # the others have to wait for release or the double-press window.
+        self.long_pins = set(long_pins)
+        self.double_pins = set(double_pins)
+        self.edges = queue.SimpleQueue()
+        self.events = queue.SimpleQueue()
+        self.level = {}
+        self.last_edge = {}
+        self.settle = {}        # pin -> (end of debounce window, last level)
+        self.down_at = {}
+        self.long_sent = set()
+        self.clicks = {}
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        if self.running:
+            return self
+        self.running = True
+        if HAVE_GPIO:
+            setup()
+            for pin in self.pins:
+                self.level[pin] = GPIO.input(pin)
+                GPIO.add_event_detect(pin, GPIO.BOTH, callback=self._edge)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.edges.put(None)
+        if HAVE_GPIO:
+            for pin in self.pins:
+                try:
+                    GPIO.remove_event_detect(pin)
+                except Exception:
+                    pass
+
+    def _edge(self, pin):
+        # GPIO callback thread: timestamp and hand off, nothing else.
+        self.edges.put((pin, GPIO.input(pin), time.monotonic()))
+
+    def inject(self, pin, level, t=None):
+        # Simulated edge, for tests without GPIO.
+        self.edges.put((pin, level, time.monotonic() if t is None else t))
+
+    def poll(self):
+        out = []
+        while True:
+            try:
+                out.append(self.events.get_nowait())
+            except queue.Empty:
+                return out
+
+    def _emit(self, pin, kind):
+        self.events.put((pin, kind))
+
+    def _next_deadline(self):
+        deadlines = [t + self.long_press for p, t in self.down_at.items()
+                     if p in self.long_pins and p not in self.long_sent]
+        deadlines += [t + self.double_press for t in self.clicks.values()]
+        deadlines += [t for t, _ in self.settle.values()]
+        return min(deadlines) if deadlines else None
+
+    def _timers(self, now):
+        for pin, (t, level) in list(self.settle.items()):
+            if now >= t:
+                # edges were dropped in the debounce window: act on the level
+                # the pin settled at (a tap released inside it, say)
+                del self.settle[pin]
+                if HAVE_GPIO and pin in self.pins:
+                    level = GPIO.input(pin)
+                self._change(pin, level, t)
+        for pin, t in list(self.down_at.items()):
+            if (pin in self.long_pins and pin not in self.long_sent
+                    and now - t >= self.long_press):
+                self.long_sent.add(pin)
+                self._emit(pin, LONG_PRESS)
+        for pin, t in list(self.clicks.items()):
+            if now - t >= self.double_press:
+                del self.clicks[pin]
+                self._emit(pin, PRESS)
+
+    def _run(self):
+        while self.running:
+            deadline = self._next_deadline()
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                edge = self.edges.get(timeout=timeout)
+            except queue.Empty:
+                edge = False
+            if edge is None:
+                break
+            if edge:
+                self._handle(*edge)
+            self._timers(time.monotonic())
+
+    def _handle(self, pin, level, t):
+        last = self.last_edge.get(pin, -1.0)
+        if t - last < self.debounce:
+            self.settle[pin] = (last + self.debounce, level)
+            return
+        self.settle.pop(pin, None)
+        self._change(pin, level, t)
+
+    def _change(self, pin, level, t):
+        if self.level.get(pin, 1) == level:
+            return
+        self.last_edge[pin] = t
+        self.level[pin] = level
+        if level == 0:                  # pulled low: pressed
+            self.down_at[pin] = t
+            if pin not in self.long_pins and pin not in self.double_pins:
+                self._emit(pin, PRESS)
+            return
+        down = self.down_at.pop(pin, None)
+        if down is None or pin in self.long_sent:
+            self.long_sent.discard(pin)
+            return
+        if pin not in self.long_pins and pin not in self.double_pins:
+            return
+        if pin in self.double_pins:
+            if pin in self.clicks:
+                del self.clicks[pin]
+                self._emit(pin, DOUBLE_PRESS)
+            else:
+                self.clicks[pin] = t
+            return
+        self._emit(pin, PRESS)
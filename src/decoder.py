@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import subprocess, threading, time, fcntl, termios, array
+
+PCM_RATE = 44100
+PCM_CHANNELS = 2
+PCM_FRAME_BYTES = 2 * PCM_CHANNELS   # s16le interleaved
+PREFILL_SECONDS = 0.5
+SINK_PIPE_BYTES = 8192               # keep little audio queued ahead of ALSA
+F_SETPIPE_SZ = 1031
+
+
+class Decoder:
+    # One ffmpeg process decoding a file to s16le stereo.  start() primes the
+    # first buffers on a background thread so a switch to this track can
+    # begin playback immediately.
+    def __init__(self, path):
+        self.path = path
+        self.proc = subprocess.Popen(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", path,
+             "-ac", str(PCM_CHANNELS), "-ar", str(PCM_RATE),
+             "-f", "s16le", "-"],
+            stdout=subprocess.PIPE, stdin=subprocess.DEVNULL)
+        self.buf = bytearray()
+        self.frames = 0
+        self.eof = False
+        self._thread = None
+
+    def start(self, seconds=PREFILL_SECONDS):
+        want = int(seconds * PCM_RATE) * PCM_FRAME_BYTES
+        self._thread = threading.Thread(target=self._prefill, args=(want,),
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def _prefill(self, want):
+        while len(self.buf) < want:
+            chunk = self.proc.stdout.read(want - len(self.buf))
+            if not chunk:
+                self.eof = True
+                break
+            self.buf += chunk
+
+    def read(self, n):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.buf:
+            out = bytes(self.buf[:n])
+            del self.buf[:n]
+        elif self.eof:
+            out = b""
+        else:
+            out = self.proc.stdout.read(n)
+        if len(out) % PCM_FRAME_BYTES:
+            out = out[:len(out) - len(out) % PCM_FRAME_BYTES]
+        self.frames += len(out) // PCM_FRAME_BYTES
+        return out
+
+    def position(self):
+        return self.frames / PCM_RATE
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.terminate()
+        try:
+            self.proc.wait(timeout=1.0)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.proc.stdout.close()
+
+
+class PlaybackSink:
+    # A single long-lived ALSA writer shared by all tracks, so changing
+    # tracks never reopens the audio device.
+    def __init__(self, device):
+        self.device = device
+        self.proc = None
+        self.nread = array.array("i", [0])
+        self.open()
+
+    def open(self):
+        self.proc = subprocess.Popen(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error",
+             "-f", "s16le", "-ar", str(PCM_RATE), "-ac", str(PCM_CHANNELS),
+             "-i", "-", "-f", "alsa", self.device],
+            stdin=subprocess.PIPE)
+        try:
+            fcntl.fcntl(self.proc.stdin.fileno(), F_SETPIPE_SZ, SINK_PIPE_BYTES)
+        except OSError:
+            pass
+
+    def write(self, data):
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            self.close()
+            self.open()
+
+    def queued(self):
+        # Bytes written but still waiting in the pipe to the player.
+        try:
+            fcntl.ioctl(self.proc.stdin.fileno(), termios.FIONREAD, self.nread)
+        except (OSError, ValueError):
+            return 0
+        return self.nread[0]
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+        try:
+            self.proc.wait(timeout=1.0)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+class DecoderCache:
+    # Keeps decoders for the neighbouring tracks warm.
+    def __init__(self, path_for):
+        self.path_for = path_for
+        self.warm = {}
+
+    def take(self, idx):
+        dec = self.warm.pop(idx, None)
+        warm = dec is not None
+        if dec is None:
+            dec = Decoder(self.path_for(idx)).start()
+        return dec, warm
+
+    def prefetch(self, indices):
+        keep = set(indices)
+        for idx in list(self.warm):
+            if idx not in keep:
+                self.warm.pop(idx).close()
+        for idx in keep:
+            if idx not in self.warm:
+                self.warm[idx] = Decoder(self.path_for(idx)).start()
+
+    def close(self):
+        for dec in self.warm.values():
+            dec.close()
+        self.warm.clear()
+
+
+class SwitchTimer:
+    def __init__(self):
+        self.t0 = None
+        self.warm = False
+        self.last = 0.0
+        self.worst = 0.0
+
+    def begin(self, warm):
+        self.t0 = time.perf_counter()
+        self.warm = warm
+
+    def first_write(self):
+        if self.t0 is None:
+            return None
+        self.last = time.perf_counter() - self.t0
+        self.worst = max(self.worst, self.last)
+        self.t0 = None
+        return self.last
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+# Declarative effects.  A preset is a fade plus a stack of layers, read from
+# presets.json; each mode of the protocol names the preset it shows.  Layers:
+#
+#   fill      one colour over a zone
+#   bar       one colour over part of a zone (position/length or one of N
+#             divisions picked by `index`)
+#   gradient  two colours across a zone
+#   meter     gradient lit from the zone start up to `value` (0..1)
+#   chase     moving rainbow bar, `speed` pixels per frame or, with
+#             "tempo_lock", locked to the beat
+#   sparkle   random pixels from a palette
+#
+# Every layer has a blend mode (set / add / max) and may bind its parameters
+# to the state: "bind": {"brightness": "kick"} or, with scaling,
+# {"hue": [{"from": "note", "scale": 0.0833}, {"from": "gliss", "scale": 0.1}]}.
+# "when" / "unless" gate a layer on state values above a threshold.
+#
+# Presets are compiled once: zones become pixel ranges and buffer pointers,
+# constant colours are packed, bindings become small term lists.  A frame is
+# then one C call per layer over its whole range -- no per-pixel Python.
+import os, json, ctypes, colorsys
+
+import numpy as np
+
+PRESETS_FILE = os.environ.get(
+    "LED_PRESETS", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "presets.json"))
+
+BLEND_SET = 0
+BLEND_ADD = 1
+BLEND_MAX = 2
+BLEND_MODES = {"set": BLEND_SET, "add": BLEND_ADD, "max": BLEND_MAX}
+HUE_TABLE_SIZE = 256
+
+# state fields a binding can read, plus the frame counter and time
+SOURCES = ("note", "level", "gliss", "kick", "snare", "phase", "tempo",
+           "downbeat", "frame", "time")
+
+u32p = ctypes.POINTER(ctypes.c_uint32)
+i32p = ctypes.POINTER(ctypes.c_int32)
+
+
+def load_library(path=None):
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "..", "lib", "libeffects.so")
+    lib = ctypes.CDLL(path)
+    lib.c_fade_strip.argtypes = [u32p, ctypes.c_int, ctypes.c_float]
+    lib.c_draw_bar.argtypes = [u32p, ctypes.c_int, ctypes.c_int,
+                               ctypes.c_uint8, ctypes.c_uint8, ctypes.c_uint8,
+                               ctypes.c_float]
+    lib.c_fade_fixed.argtypes = [u32p, ctypes.c_int, ctypes.c_uint32]
+    lib.c_build_hue_table.argtypes = [u32p, ctypes.c_int,
+                                      ctypes.c_float, ctypes.c_float]
+    lib.c_fill_hue_ramp.argtypes = [u32p, ctypes.c_int, ctypes.c_int,
+                                    ctypes.c_int, u32p, ctypes.c_int,
+                                    ctypes.c_float, ctypes.c_float,
+                                    ctypes.c_float, ctypes.c_float,
+                                    ctypes.c_int]
+    lib.c_fill_gradient.argtypes = [u32p, ctypes.c_int, ctypes.c_int,
+                                    ctypes.c_uint32, ctypes.c_uint32,
+                                    ctypes.c_int]
+    lib.c_scatter.argtypes = [u32p, ctypes.c_int, i32p, u32p,
+                              ctypes.c_int, ctypes.c_int]
+    lib.c_output_stage.argtypes = [u32p, u32p, ctypes.c_int,
+                                   ctypes.POINTER(ctypes.c_uint8),
+                                   ctypes.POINTER(ctypes.c_float),
+                                   ctypes.c_float, ctypes.c_float,
+                                   ctypes.POINTER(ctypes.c_float)]
+    for fn in ("c_fade_strip", "c_draw_bar", "c_fade_fixed",
+               "c_build_hue_table", "c_fill_hue_ramp", "c_fill_gradient",
+               "c_scatter", "c_output_stage"):
+        getattr(lib, fn).restype = None
+    return lib
+
+
+def load_presets(path=PRESETS_FILE):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def pack(rgb):
+    r, g, b = (max(0, min(255, int(c))) for c in rgb)
+    return (r << 16) | (g << 8) | b
+
+
+PACK_SHIFTS = np.array([16, 8, 0], dtype=np.uint32)
+
+
+def scale_packed(c, k):
+    k = max(0.0, min(1.0, k))
+    return pack((((c >> 16) & 0xFF) * k, ((c >> 8) & 0xFF) * k, (c & 0xFF) * k))
+
+
+class Binding:
+    # Sum of terms: value = sum(scale * src + offset), where `period` first
+    # wraps a source to 0..1 (e.g. frame counter -> slow hue cycle).
+    def __init__(self, spec, const=0.0):
+        self.const = float(const)
+        self.terms = []
+        if spec is None:
+            return
+        if isinstance(spec, (int, float)):
+            self.const = float(spec)
+            return
+        if isinstance(spec, (str, dict)):
+            spec = [spec]
+        self.const = 0.0
+        for t in spec:
+            if isinstance(t, str):
+                t = {"from": t}
+            src = t["from"]
+            if src not in SOURCES:
+                raise ValueError("unknown binding source: %s" % src)
+            self.const += float(t.get("offset", 0.0))
+            self.terms.append((src, float(t.get("scale", 1.0)),
+                               t.get("period")))
+
+    @property
+    def constant(self):
+        return not self.terms
+
+    def value(self, ctx):
+        v = self.const
+        for src, scale, period in self.terms:
+            x = ctx[src]
+            if period:
+                x = (x % period) / period
+            v += scale * x
+        return v
+
+
+class Layer:
+    PARAMS = {"brightness": 1.0}
+
+    def __init__(self, graph, spec):
+        self.graph = graph
+        self.blend = BLEND_MODES[spec.get("blend", "add")]
+        self.start, self.length = graph.zone(spec.get("zone", "all"))
+        bind = spec.get("bind", {})
+        for name in bind:
+            if name not in self.PARAMS:
+                raise ValueError("%s layer has no parameter %s"
+                                 % (spec["type"], name))
+        self.p = {name: Binding(bind.get(name), spec.get(name, default))
+                  for name, default in self.PARAMS.items()}
+        self.when = [(s, float(v)) for s, v in spec.get("when", {}).items()]
+        self.unless = [(s, float(v)) for s, v in spec.get("unless", {}).items()]
+        for s, _ in self.when + self.unless:
+            if s not in SOURCES:
+                raise ValueError("unknown gate source: %s" % s)
+
+    def active(self, ctx):
+        for s, v in self.when:
+            if not ctx[s] > v:
+                return False
+        for s, v in self.unless:
+            if ctx[s] > v:
+                return False
+        return True
+
+    def reset(self):
+        pass
+
+
+class ColorLayer(Layer):
+    # A colour given as "color": [r, g, b] or via hue/saturation/value.
+    PARAMS = {"brightness": 1.0, "hue": 0.0, "saturation": 1.0, "value": 1.0}
+
+    def __init__(self, graph, spec):
+        super().__init__(graph, spec)
+        self.hsv = "color" not in spec
+        self.rgb = tuple(int(c) for c in spec.get("color", (0, 0, 0)))
+        if self.hsv and all(self.p[n].constant
+                            for n in ("hue", "saturation", "value")):
+            self.rgb = self._hsv_rgb(None)
+            self.hsv = False
+
+    def _hsv_rgb(self, ctx):
+        p = self.p
+        r, g, b = colorsys.hsv_to_rgb(p["hue"].value(ctx) % 1.0,
+                                      p["saturation"].value(ctx),
+                                      p["value"].value(ctx))
+        return int(r * 255), int(g * 255), int(b * 255)
+
+    def color(self, ctx):
+        return self._hsv_rgb(ctx) if self.hsv else self.rgb
+
+    def paint(self, start, length, rgb, inten):
+        if length <= 0 or inten <= 0.0:
+            return
+        g = self.graph
+        if self.blend == BLEND_ADD:
+            g.lib.c_draw_bar(g.ptr, start, length, rgb[0], rgb[1], rgb[2],
+                             float(inten))
+        else:
+            c = scale_packed(pack(rgb), inten)
+            g.lib.c_fill_gradient(g.ptr, start, length, c, c, self.blend)
+
+
+class FillLayer(ColorLayer):
+    def draw(self, ctx):
+        self.paint(self.start, self.length, self.color(ctx),
+                   self.p["brightness"].value(ctx))
+
+
+class BarLayer(ColorLayer):
+    # position/length are fractions of the zone; with "divisions": N the bar
+    # is section `index` (wrapped) of N equal sections instead.
+    PARAMS = dict(ColorLayer.PARAMS, position=0.0, length=0.1, index=0.0)
+
+    def __init__(self, graph, spec):
+        super().__init__(graph, spec)
+        self.divisions = int(spec.get("divisions", 0))
+        if self.divisions:
+            self.section = max(1, self.length // self.divisions)
+
+    def draw(self, ctx):
+        p = self.p
+        if self.divisions:
+            length = self.section
+            start = (self.start
+                     + (int(p["index"].value(ctx)) % self.divisions) * length)
+        else:
+            pos = p["position"].value(ctx) % 1.0
+            length = max(1, int(p["length"].value(ctx) * self.length))
+            start = self.start + int(pos * self.length)
+            length = min(length, self.start + self.length - start)
+        self.paint(start, length, self.color(ctx), p["brightness"].value(ctx))
+
+
+class GradientLayer(Layer):
+    def __init__(self, graph, spec):
+        super().__init__(graph, spec)
+        c0, c1 = spec.get("colors", ((0, 0, 0), (255, 255, 255)))
+        self.c0, self.c1 = pack(c0), pack(c1)
+
+    def draw(self, ctx):
+        k = self.p["brightness"].value(ctx)
+        if k <= 0.0 or self.length <= 0:
+            return
+        g = self.graph
+        g.lib.c_fill_gradient(g.ptr, self.start, self.length,
+                              scale_packed(self.c0, k),
+                              scale_packed(self.c1, k), self.blend)
+
+
+class MeterLayer(GradientLayer):
+    PARAMS = {"brightness": 1.0, "value": 0.0}
+
+    def __init__(self, graph, spec):
+        super().__init__(graph, spec)
+        self.rgb0 = np.array([(self.c0 >> s) & 0xFF for s in (16, 8, 0)], float)
+        self.rgb1 = np.array([(self.c1 >> s) & 0xFF for s in (16, 8, 0)], float)
+
+    def draw(self, ctx):
+        v = max(0.0, min(1.0, self.p["value"].value(ctx)))
+        lit = int(round(v * self.length))
+        k = self.p["brightness"].value(ctx)
+        if lit <= 0 or k <= 0.0:
+            return
+        # the lit part keeps the colours it has in the full-length gradient
+        end = pack(self.rgb0 + (self.rgb1 - self.rgb0) * (lit / self.length))
+        g = self.graph
+        g.lib.c_fill_gradient(g.ptr, self.start, lit, scale_packed(self.c0, k),
+                              scale_packed(end, k), self.blend)
+
+
+class ChaseLayer(Layer):
+    # Rainbow bar with a fading tail, moving `speed` pixels per frame.  With
+    # "tempo_lock": true it moves `beat_lengths` bar lengths per beat instead
+    # while the state carries a tempo.
+    PARAMS = {"brightness": 1.0, "speed": 1.5}
+
+    def __init__(self, graph, spec):
+        super().__init__(graph, spec)
+        self.bar = max(int(spec.get("min_length", 1)),
+                       int(self.length * float(spec.get("length", 0.1))))
+        self.bar = min(self.bar, max(1, self.length))
+        self.tempo_lock = bool(spec.get("tempo_lock", False))
+        self.per_beat = float(spec.get("beat_lengths", 1.0))
+        self.tail = float(spec.get("tail", 0.3))
+        self.zptr = graph.offset_ptr(self.start)
+        self.reset()
+
+    def reset(self):
+        self.pos = 0.0
+
+    def draw(self, ctx):
+        if self.length <= 0:
+            return
+        g = self.graph
+        tempo = ctx["tempo"] if self.tempo_lock else 0.0
+        if tempo > 0:
+            speed = self.bar * self.per_beat * tempo / (60.0 * g.fps)
+        else:
+            speed = self.p["speed"].value(ctx)
+        self.pos = (self.pos + speed) % self.length
+        g.lib.c_fill_hue_ramp(self.zptr, self.length, int(self.pos), self.bar,
+                              g.hue_ptr, HUE_TABLE_SIZE,
+                              self.pos / self.length, 1.0 / self.bar,
+                              self.p["brightness"].value(ctx),
+                              -self.tail / self.bar, self.blend)
+
+
+class SparkleLayer(Layer):
+    # `count` pixels per frame, or binomial(count, chance) with a chance < 1.
+    PARAMS = {"brightness": 1.0, "count": 10.0}
+
+    def __init__(self, graph, spec):
+        super().__init__(graph, spec)
+        self.chance = float(spec.get("chance", 1.0))
+        self.palette = np.array([pack(c) for c in
+                                 spec.get("palette", [(255, 255, 255)])],
+                                dtype=np.uint32)
+        # channels for dimming without per-frame Python lists
+        self.rgb = ((self.palette[:, None] >> PACK_SHIFTS) & 0xFF).astype(
+            np.float64)
+        self.scaled = np.empty_like(self.rgb)
+        self.channels = np.empty(self.rgb.shape, dtype=np.uint32)
+        self.dimmed = self.palette.copy()
+        self.zptr = graph.offset_ptr(self.start)
+
+    def draw(self, ctx):
+        n = max(0, int(self.p["count"].value(ctx)))
+        rng = self.graph.rng
+        if self.chance < 1.0:
+            n = rng.binomial(n, self.chance)
+        if not n or self.length <= 0:
+            return
+        k = self.p["brightness"].value(ctx)
+        pal = self.palette
+        if k < 1.0:
+            pal = self.dimmed
+            np.multiply(self.rgb, max(0.0, k), out=self.scaled)
+            np.copyto(self.channels, self.scaled, casting="unsafe")
+            np.left_shift(self.channels, PACK_SHIFTS, out=self.channels)
+            np.bitwise_or.reduce(self.channels, axis=1, out=pal)
+        idx = rng.integers(0, self.length, n).astype(np.int32)
+        colors = pal[rng.integers(0, len(pal), n)]
+        self.graph.lib.c_scatter(self.zptr, self.length,
+                                 idx.ctypes.data_as(i32p),
+                                 colors.ctypes.data_as(u32p), n, self.blend)
+
+
+LAYER_TYPES = {
+    "fill": FillLayer,
+    "bar": BarLayer,
+    "gradient": GradientLayer,
+    "meter": MeterLayer,
+    "chase": ChaseLayer,
+    "sparkle": SparkleLayer,
+}
+
+
+class Preset:
+    def __init__(self, graph, name, spec):
+        self.name = name
+        self.fade = float(spec.get("fade", 1.0))
+        self.fade_scale = int(self.fade * 256.0)
+        self.layers = []
+        for i, ls in enumerate(spec.get("layers", [])):
+            kind = LAYER_TYPES.get(ls.get("type"))
+            if kind is None:
+                raise ValueError("preset %s layer %d: unknown type %r"
+                                 % (name, i, ls.get("type")))
+            try:
+                self.layers.append(kind(graph, ls))
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError("preset %s layer %d: %s" % (name, i, e))
+
+
+class EffectGraph:
+    # Compiled presets over one framebuffer.  `modes` maps protocol mode ids
+    # to names ("music", ...) which presets.json maps to presets.
+    def __init__(self, lib, fb, zones, config, modes, fps, rng=None):
+        self.lib = lib
+        self.fb = fb
+        self.ptr = fb.ptr
+        self.count = fb.count
+        self.zones = dict(zones)
+        self.zones.setdefault("all", (0, fb.count))
+        self.fps = fps
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.hue_table = np.zeros(HUE_TABLE_SIZE, dtype=np.uint32)
+        self.hue_ptr = self.hue_table.ctypes.data_as(u32p)
+        lib.c_build_hue_table(self.hue_ptr, HUE_TABLE_SIZE, 1.0, 1.0)
+        self.ctx = dict.fromkeys(SOURCES, 0.0)
+        self.compile(config, modes)
+
+    def zone(self, z):
+        if isinstance(z, str):
+            if z not in self.zones:
+                raise ValueError("unknown zone %s" % z)
+            return self.zones[z]
+        a, b = z                        # inline fractions of the strip
+        start = int(round(a * self.count))
+        return start, max(0, int(round(b * self.count)) - start)
+
+    def offset_ptr(self, start):
+        return ctypes.cast(ctypes.addressof(self.fb.leds) + 4 * start, u32p)
+
+    def compile(self, config, modes):
+        presets = {name: Preset(self, name, spec)
+                   for name, spec in config.get("presets", {}).items()}
+        mapping = config.get("modes", {})
+        by_mode = {}
+        for mode, name in modes.items():
+            preset = mapping.get(name.lower(), name.lower())
+            if preset not in presets:
+                raise ValueError("no preset %r for mode %s" % (preset, name))
+            by_mode[mode] = presets[preset]
+        self.presets = presets
+        self.by_mode = by_mode
+        self.default = next(iter(by_mode.values()), None)
+
+    def reset(self):
+        for p in self.presets.values():
+            for layer in p.layers:
+                layer.reset()
+
+    def render(self, st, frame):
+        preset = self.by_mode.get(st.mode, self.default)
+        if preset is None:
+            return
+        if preset.fade <= 0.0:
+            self.fb.clear()
+        elif preset.fade < 1.0:
+            self.lib.c_fade_fixed(self.ptr, self.count, preset.fade_scale)
+        ctx = self.ctx
+        ctx["note"] = st.note
+        ctx["level"] = st.level
+        ctx["gliss"] = st.gliss
+        ctx["kick"] = st.kick
+        ctx["snare"] = st.snare
+        ctx["phase"] = st.phase
+        ctx["tempo"] = st.tempo
+        ctx["downbeat"] = st.downbeat
+        ctx["frame"] = frame
+        ctx["time"] = frame / self.fps
+        for layer in preset.layers:
+            if layer.active(ctx):
+                layer.draw(ctx)
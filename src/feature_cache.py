@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import os, hashlib
+
+import numpy as np
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+CACHE_DIR = os.path.join(BASE_DIR, "cache", "features")
+
+# Feature tracks are sampled at the live analysis hop rate.  The hop is a
+# whole number of samples, so the real rate is slightly above 40 Hz
+# (40.018); tracks stored with the nominal 40 drift behind the audio and
+# count as stale.
+FEATURE_SR = 44100
+FEATURE_HOP = int(FEATURE_SR / 40)
+FEATURE_FPS = FEATURE_SR / FEATURE_HOP
+FEATURE_WINDOW = FEATURE_HOP * 3
+
+FEATURE_DTYPE = np.dtype([
+    ("note", "i1"),     # smoothed lead note 0..11, -1 for none
+    ("beat", "u1"),     # 1 on frames with a tracked beat
+    ("gliss", "<f4"),
+    ("level", "<f4"),
+    ("kick", "<f4"),    # envelopes, 0..1
+    ("snare", "<f4"),
+    ("bass", "<f4"),    # band energies
+    ("mid", "<f4"),
+    ("high", "<f4"),
+])
+
+
+def content_hash(path, chunk=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(chunk)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def fps_current(fps):
+    # Was a track sampled at today's hop rate?
+    return bool(fps) and abs(fps - FEATURE_FPS) < 1e-6
+
+
+def feature_path(digest):
+    return os.path.join(CACHE_DIR, digest + ".npy")
+
+
+def save_features(digest, track):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = feature_path(digest)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, np.ascontiguousarray(track, dtype=FEATURE_DTYPE))
+    os.replace(tmp, path)
+    return path
+
+
+class FeatureTrack:
+    def __init__(self, path, fps=FEATURE_FPS):
+        self.data = np.load(path, mmap_mode="r")
+        self.fps = fps
+        self.frames = len(self.data)
+        self.duration = self.frames / fps
+
+    def at(self, t):
+        i = int(t * self.fps)
+        if i < 0:
+            i = 0
+        elif i >= self.frames:
+            i = self.frames - 1
+        return self.data[i]
+
+
+def open_features(path, entry):
+    # entry: the song's library record.  The cache is keyed by content hash;
+    # size/mtime say whether the stored hash still describes the file.  This
+    # runs on the playback path, so a file that changed since it was hashed
+    # counts as uncached until the library watcher has rehashed it.
+    digest = entry.get("hash")
+    if not digest or not fps_current(entry.get("feature_fps")):
+        return None
+    try:
+        st = os.stat(path)
+        if (st.st_size != entry.get("size")
+                or int(st.st_mtime) != entry.get("mtime")):
+            return None
+        track = FeatureTrack(feature_path(digest), entry["feature_fps"])
+    except (OSError, ValueError):
+        return None
+    if track.frames == 0 or track.data.dtype != FEATURE_DTYPE:
+        return None
+    return track
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+import ctypes, time, os, mmap, struct, threading
+
+import numpy as np
+
+try:
+    from rpi_ws281x import PixelStrip, ws
+    HAVE_WS281X = True
+except ImportError:
+    HAVE_WS281X = False
+
+
+class FrameBuffer:
+    # 0x00RRGGBB words, same layout as rpi_ws281x's ws2811_led_t.
+    # When an address is given the buffer aliases that memory (zero copy).
+    def __init__(self, count, address=None):
+        self.count = count
+        if address:
+            self.leds = (ctypes.c_uint32 * count).from_address(address)
+        else:
+            self.leds = (ctypes.c_uint32 * count)()
+        self.ptr = ctypes.cast(self.leds, ctypes.POINTER(ctypes.c_uint32))
+        self.pixels = np.ctypeslib.as_array(self.leds)
+
+    def clear(self):
+        ctypes.memset(self.leds, 0, self.count * 4)
+
+
+class FrameSnapshot:
+    # Last shown frame in a small mmapped file (tmpfs), rewritten every frame,
+    # so a restarted LED engine can put the same picture back immediately --
+    # even after a crash or SIGKILL.
+    HEADER = struct.Struct("<4sI")
+    MAGIC = b"MLFB"
+
+    def __init__(self, path, count):
+        self.count = count
+        size = self.HEADER.size + count * 4
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self.valid = os.fstat(fd).st_size == size
+            if not self.valid:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, n = self.HEADER.unpack_from(self.map, 0)
+        self.valid = self.valid and magic == self.MAGIC and n == count
+        self.pixels = np.frombuffer(self.map, dtype=np.uint32, count=count,
+                                    offset=self.HEADER.size)
+
+    def restore(self, fb):
+        if not self.valid:
+            return False
+        fb.pixels[:] = self.pixels
+        return True
+
+    def save(self, fb):
+        if not self.valid:
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, self.count)
+            self.valid = True
+        self.pixels[:] = fb.pixels
+
+    def close(self):
+        self.pixels = None
+        self.map.close()
+
+
+def channel_values(text):
+    # "2.2" -> (2.2, 2.2, 2.2); "255,230,200" -> one value per R, G, B
+    v = tuple(float(x) for x in str(text).split(","))
+    if len(v) == 1:
+        v *= 3
+    if len(v) != 3:
+        raise ValueError("expected one value or r,g,b: %r" % text)
+    return v
+
+
+class OutputStage:
+    # Last step before a push, one C pass (c_output_stage): per-channel gamma
+    # and brightness tables, current estimate, and scaling of the whole frame
+    # down to the supply budget.  Writes into a separate buffer, so effects
+    # keep fading from the uncorrected frame.
+    def __init__(self, lib, count, gamma=(1.0, 1.0, 1.0),
+                 levels=(255, 255, 255), budget_ma=0.0,
+                 channel_ma=(20.0, 20.0, 20.0), idle_ma=1.0):
+        self.lib = lib
+        self.count = count
+        self.budget_ma = float(budget_ma)
+        self.idle_ma = float(idle_ma)
+        self.ma = (ctypes.c_float * 3)(*channel_ma)
+        self.lut = (ctypes.c_uint8 * 768)()
+        table = np.ctypeslib.as_array(self.lut).reshape(3, 256)
+        x = np.arange(256) / 255.0
+        for c in range(3):
+            if gamma[c] <= 0 or not 0 <= levels[c] <= 255:
+                raise ValueError("bad gamma/brightness: %r / %r"
+                                 % (gamma, levels))
+            table[c] = np.round(x ** gamma[c] * levels[c])
+        # nothing to do: the server renders straight into the output
+        self.identity = (self.budget_ma <= 0 and tuple(gamma) == (1.0,) * 3
+                         and tuple(levels) == (255,) * 3)
+        self.out = (ctypes.c_float * 2)()
+        self.estimated_ma = 0.0
+        self.limited_ma = 0.0
+        self.limited_frames = 0
+
+    def apply(self, src, dst):
+        self.lib.c_output_stage(src.ptr, dst.ptr, self.count, self.lut, self.ma,
+                                self.idle_ma, self.budget_ma, self.out)
+        self.estimated_ma, self.limited_ma = self.out
+        if self.limited_ma < self.estimated_ma:
+            self.limited_frames += 1
+
+
+class NullOutput:
+    def __init__(self, count):
+        self.count = count
+
+    def address(self):
+        return None
+
+    def show(self, fb):
+        pass
+
+    def close(self):
+        pass
+
+
+class RecorderOutput(NullOutput):
+    # Keeps the last `keep` frames in memory for inspection.
+    def __init__(self, count, keep=1):
+        super().__init__(count)
+        self.frames = np.zeros((keep, count), dtype=np.uint32)
+        self.shown = 0
+
+    def show(self, fb):
+        self.frames[self.shown % len(self.frames)] = fb.pixels
+        self.shown += 1
+
+    def last(self):
+        if not self.shown:
+            return None
+        return self.frames[(self.shown - 1) % len(self.frames)]
+
+
+def channel_address(chan):
+    # The channel is a raw SWIG pointer; its ws2811_led_t array (allocated by
+    # ws2811_init) is only reachable through the accessor.  None before init.
+    return int(ws.ws2811_channel_t_leds_get(chan)) or None
+
+
+class WS281xOutput:
+    def __init__(self, count, pin, freq_hz, dma, invert, brightness, channel,
+                 strip_type, strip=None, pwm=None):
+        self.count = count
+        self.channel = channel
+        self.pwm = pwm
+        if pwm is not None:
+            # one of two strips on the shared PWM controller
+            self.strip = None
+            self._chan = pwm.channels[channel]
+            self._addr = pwm.addresses[channel]
+        else:
+            if strip is None:
+                strip = PixelStrip(count, pin, freq_hz, dma, invert, brightness,
+                                   channel, strip_type)
+                strip.begin()
+            self.strip = strip
+            self._chan = strip._channel
+            self._addr = channel_address(self._chan)
+
+    def address(self):
+        return self._addr
+
+    def show(self, fb):
+        if self._addr is not None:
+            if ctypes.addressof(fb.leds) != self._addr:
+                ctypes.memmove(self._addr, fb.leds, self.count * 4)
+        else:
+            set_led = ws.ws2811_led_set
+            chan = self._chan
+            for i, c in enumerate(fb.pixels.tolist()):
+                set_led(chan, i, c)
+        if self.pwm is not None:
+            self.pwm.shown(self.channel)
+        else:
+            self.strip.show()
+
+    def close(self):
+        if self.pwm is not None:
+            self.pwm.close()
+
+
+# GPIOs of the two PWM channels.  Both channels share one PWM block and one
+# DMA stream, so rpi_ws281x has to drive them from a single ws2811_t: two
+# PixelStrips would each reinitialise the PWM and one strip stops.
+PWM_PINS = {12: 0, 18: 0, 40: 0, 52: 0, 13: 1, 19: 1, 41: 1, 45: 1, 53: 1}
+
+
+class WS281xPWM:
+    # Both PWM channels in one rpi_ws281x instance.  Each channel's output
+    # fills its own pixel array; the strip is rendered (both channels in one
+    # DMA transfer) once every channel has been shown for the frame.
+    def __init__(self, freq_hz, dma, channels):
+        # channels: {0 and/or 1: dict(count, pin, invert, brightness,
+        #                             strip_type)}
+        self.leds = ws.new_ws2811_t()
+        self.channels = {}
+        for ch in (0, 1):
+            c = ws.ws2811_channel_get(self.leds, ch)
+            cfg = channels.get(ch)
+            ws.ws2811_channel_t_count_set(c, cfg["count"] if cfg else 0)
+            ws.ws2811_channel_t_gpionum_set(c, cfg["pin"] if cfg else 0)
+            ws.ws2811_channel_t_invert_set(c, 1 if cfg and cfg["invert"] else 0)
+            ws.ws2811_channel_t_brightness_set(c, cfg["brightness"] if cfg else 0)
+            if cfg:
+                ws.ws2811_channel_t_strip_type_set(c, cfg["strip_type"])
+                self.channels[ch] = c
+        ws.ws2811_t_freq_set(self.leds, freq_hz)
+        ws.ws2811_t_dmanum_set(self.leds, dma)
+        resp = ws.ws2811_init(self.leds)
+        if resp != ws.WS2811_SUCCESS:
+            raise RuntimeError("ws2811_init failed: %s"
+                               % ws.ws2811_get_return_t_str(resp))
+        # both arrays exist now; the channel outputs push into them directly
+        self.addresses = {ch: channel_address(c)
+                          for ch, c in self.channels.items()}
+        self.lock = threading.Lock()
+        self.pending = set(self.channels)
+        self.users = len(self.channels)
+
+    def shown(self, channel):
+        with self.lock:
+            self.pending.discard(channel)
+            if self.pending:
+                return
+            self.pending = set(self.channels)
+            resp = ws.ws2811_render(self.leds)
+        if resp != ws.WS2811_SUCCESS:
+            raise RuntimeError("ws2811_render failed: %s"
+                               % ws.ws2811_get_return_t_str(resp))
+
+    def close(self):
+        # once per channel output; the last one releases the hardware
+        self.users -= 1
+        if self.users == 0:
+            ws.ws2811_fini(self.leds)
+            ws.delete_ws2811_t(self.leds)
+
+
+def shared_pwm(specs):
+    # specs: (count, make_output keyword arguments) of the ws281x strips on
+    # PWM pins.  Returns the controller and sets each strip's channel.
+    channels = {}
+    for count, kw in specs:
+        ch = PWM_PINS[kw["pin"]]
+        if ch in channels:
+            raise ValueError("two strips on PWM channel %d" % ch)
+        kw["channel"] = ch
+        channels[ch] = dict(count=count, pin=kw["pin"], invert=kw["invert"],
+                            brightness=kw["brightness"],
+                            strip_type=kw["strip_type"])
+    freq = {kw["freq_hz"] for _, kw in specs}
+    dma = {kw["dma"] for _, kw in specs}
+    if len(freq) > 1 or len(dma) > 1:
+        raise ValueError("both PWM channels share one frequency and DMA channel")
+    if not HAVE_WS281X:
+        raise RuntimeError("rpi_ws281x not available")
+    return WS281xPWM(freq.pop(), dma.pop(), channels)
+
+
+def make_output(kind, count, **kw):
+    if kind == "null":
+        return NullOutput(count)
+    if kind == "record":
+        return RecorderOutput(count, kw.get("keep", 1))
+    if kind == "ws281x":
+        if not HAVE_WS281X and kw.get("strip") is None and kw.get("pwm") is None:
+            raise RuntimeError("rpi_ws281x not available")
+        return WS281xOutput(count, kw["pin"], kw["freq_hz"], kw["dma"],
+                            kw["invert"], kw["brightness"], kw["channel"],
+                            kw["strip_type"], kw.get("strip"), kw.get("pwm"))
+    if kind == "e131":
+        from net_output import E131Output
+        return E131Output(count, **kw)
+    if kind == "ddp":
+        from net_output import DDPOutput
+        return DDPOutput(count, **kw)
+    raise ValueError("unknown LED output: %s" % kind)
+
+
+class PushTimer:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.worst = 0.0
+
+    def start(self):
+        return time.perf_counter()
+
+    def stop(self, t0):
+        dt = time.perf_counter() - t0
+        self.last = dt
+        self.total += dt
+        self.count += 1
+        if dt > self.worst:
+            self.worst = dt
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
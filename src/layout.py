@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from framebuffer import FrameBuffer, PWM_PINS, make_output, shared_pwm
+
+# Effect zones as fractions of the logical strip.  The defaults reproduce the
+# original 300 LED layout: 12 note sections in 0..240, kick 240..270 and
+# snare 270..300.
+DEFAULT_ZONES = {
+    "notes": (0.0, 0.8),
+    "kick": (0.8, 0.9),
+    "snare": (0.9, 1.0),
+}
+
+
+class Segment:
+    def __init__(self, output, start, length, logical, reverse=False):
+        self.output = output
+        self.start = start
+        self.length = length
+        self.logical = logical
+        self.reverse = reverse
+
+
+class Layout:
+    # Maps one logical framebuffer onto segments of several physical outputs.
+    def __init__(self, outputs, segments, zones=DEFAULT_ZONES):
+        self.outputs = outputs          # name -> output backend
+        self.segments = segments
+        self.count = sum(s.length for s in segments)
+        self.zones = scale_zones(self.count, zones)
+
+
+def scale_zones(count, zones):
+    # fractions -> (start, length) in logical pixels
+    out = {}
+    for name, (a, b) in zones.items():
+        start = int(round(a * count))
+        out[name] = (start, max(0, int(round(b * count)) - start))
+    return out
+
+
+def load_layout(path, defaults):
+    # defaults: keyword arguments for make_output (pin, dma, freq_hz, ...),
+    # overridden per output by the config.
+    with open(path, "r") as f:
+        cfg = json.load(f)
+    specs = []
+    for o in cfg["outputs"]:
+        kw = dict(defaults)
+        kw.update({k: v for k, v in o.items() if k not in ("name", "type", "count")})
+        specs.append((o, kw))
+    # Two strips on the PWM pins have to share one controller.
+    pwm = [(o["count"], kw) for o, kw in specs
+           if o.get("type", "ws281x") == "ws281x" and kw.get("pin") in PWM_PINS]
+    if len(pwm) > 1:
+        ctl = shared_pwm(pwm)
+        for _, kw in pwm:
+            kw["pwm"] = ctl
+    outputs = {}
+    for o, kw in specs:
+        outputs[o["name"]] = make_output(o.get("type", "ws281x"), o["count"], **kw)
+    segments = []
+    logical = 0
+    for s in cfg.get("segments") or [{"output": n, "start": 0, "length": o.count}
+                                     for n, o in outputs.items()]:
+        out = outputs[s["output"]]
+        length = s.get("length", out.count - s.get("start", 0))
+        if s.get("start", 0) + length > out.count:
+            raise ValueError("segment exceeds output %s" % s["output"])
+        segments.append(Segment(out, s.get("start", 0), length, logical,
+                                s.get("reverse", False)))
+        logical += length
+    zones = dict(DEFAULT_ZONES)
+    zones.update({k: tuple(v) for k, v in cfg.get("zones", {}).items()})
+    return Layout(outputs, segments, zones)
+
+
+def single_layout(output, zones=DEFAULT_ZONES):
+    return Layout({"main": output}, [Segment(output, 0, output.count, 0)], zones)
+
+
+class LayoutOutput:
+    # Output backend that scatters the logical frame over every physical
+    # output, then shows them concurrently (one worker per output).
+    def __init__(self, layout):
+        self.layout = layout
+        self.count = layout.count
+        outs = list(layout.outputs.values())
+        self.frames = {id(o): FrameBuffer(o.count, o.address()) for o in outs}
+        self.outs = outs
+        self.pool = ThreadPoolExecutor(len(outs)) if len(outs) > 1 else None
+        seg = layout.segments
+        # One output covered by one straight segment: render into it directly.
+        self._direct = None
+        if (len(outs) == 1 and len(seg) == 1 and not seg[0].reverse
+                and seg[0].start == 0 and seg[0].length == outs[0].count):
+            self._direct = outs[0]
+
+    def address(self):
+        return self._direct.address() if self._direct is not None else None
+
+    def show(self, fb):
+        if self._direct is not None:
+            self._direct.show(fb)
+            return
+        src = fb.pixels
+        for s in self.layout.segments:
+            dst = self.frames[id(s.output)].pixels[s.start:s.start + s.length]
+            part = src[s.logical:s.logical + s.length]
+            dst[:] = part[::-1] if s.reverse else part
+        if self.pool is None:
+            for o in self.outs:
+                o.show(self.frames[id(o)])
+        else:
+            for f in [self.pool.submit(o.show, self.frames[id(o)])
+                      for o in self.outs]:
+                f.result()
+
+    def close(self):
+        for o in self.outs:
+            o.close()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
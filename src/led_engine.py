@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
-import time, socket, os, ctypes, random, math, colorsys
-from rpi_ws281x import PixelStrip, Color, ws
-from protocol import (SOCKET_PATH, MODE_MUSIC, MODE_AMBIENT, MODE_OFF,
-                      MODE_TREE, MODE_CHASE, MODE_SPARKLE)
+import time, socket, os, math, selectors, array, signal, heapq
+
+from render_clock import FrameClock
+from framebuffer import (FrameBuffer, FrameSnapshot, OutputStage, PushTimer,
+                         channel_values, make_output, HAVE_WS281X)
+from notify import Notifier
+from metrics import Registry, serve as serve_metrics
+from layout import LayoutOutput, load_layout, single_layout
+from effects_graph import EffectGraph, PRESETS_FILE, load_library, load_presets
+from state_trace import TraceWriter
+if HAVE_WS281X:
+    from rpi_ws281x import ws
+from protocol import SOCKET_PATH, MODE_NAMES, State, StateDecoder, encode_ack
+try:
+    from shm_state import ShmStateReader
+except ImportError:
+    ShmStateReader = None
 
 LED_COUNT = 300
 LED_PIN = 10
@@ -11,190 +24,428 @@ LED_DMA = 10
 LED_BRIGHTNESS = 255
 LED_INVERT = False
 LED_CHANNEL = 0
-LED_STRIP_TYPE = ws.WS2811_STRIP_GRB
+LED_STRIP_TYPE = ws.WS2811_STRIP_GRB if HAVE_WS281X else 0x00081000
+LED_OUTPUT = os.environ.get("LED_OUTPUT", "ws281x")  # ws281x | null | record
+# Output stage: gamma and brightness per channel ("2.2" or "r,g,b") and the
+# current budget of the supply in mA (0: no limit).  Brightness here is
+# applied in the stage's tables, on top of LED_BRIGHTNESS in the driver.
+LED_GAMMA = channel_values(os.environ.get("LED_GAMMA", "1.0"))
+LED_LEVELS = channel_values(os.environ.get("LED_LEVELS", "255"))
+LED_MAX_MA = float(os.environ.get("LED_MAX_MA", 9000))   # 10 A supply
+LED_CHANNEL_MA = channel_values(os.environ.get("LED_CHANNEL_MA", "20"))
+LED_IDLE_MA = 1.0       # per LED, all channels off
+LAYOUT_FILE = os.environ.get(
+    "LED_LAYOUT", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "..", "layout.json"))
+# Last shown frame, kept on tmpfs for warm restarts.
+FRAME_SNAPSHOT = os.environ.get(
+    "LED_SNAPSHOT", "/dev/shm/musical_lights.frame" if os.path.isdir("/dev/shm")
+    else "/tmp/musical_lights.frame")
+# Record every applied state to this file (replay with tools/replay.py).
+STATE_TRACE = os.environ.get("LED_TRACE")
+
+LED_FPS = float(os.environ.get("LED_FPS", 40))
+STATE_SMOOTH = 0.5      # per-frame approach of level/gliss to the last update
+BEAT_DECAY = 0.85       # per-frame kick/snare decay between updates
+STATE_TIMEOUT = 0.5     # seconds without updates before audio fields decay
+STATS_INTERVAL = 10.0
+METRICS_PATH = os.environ.get("LED_METRICS", "/tmp/musical_lights.led.metrics")
+MAX_PRODUCERS = 8
+# Timed states (apply_at set) wait in a queue until the frame that is on the
+# strip when their audio is heard; the lead is the measured render + push.
+MAX_PENDING = 128
+MAX_LOOKAHEAD = 2.0     # s; further ahead means the clocks disagree
+LEAD_SMOOTH = 0.05
+RECV_BUFFER = 64 * 1024
+ANC_BUFFER = socket.CMSG_SPACE(4 * array.array("i").itemsize)
+
+
+class Producer:
+    # One connected client: its stream decoder and when it last sent a state.
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = StateDecoder()
+        self.last_state = -math.inf
+        self.fds = []           # received via SCM_RIGHTS, not yet claimed
+        self.slot = None        # ShmStateReader once attached
 
-FADE_FACTOR = 0.80
+    @property
+    def priority(self):
+        return self.decoder.priority
+
+    def live(self, now):
+        return now - self.last_state <= STATE_TIMEOUT
 
 
 class LightServer:
-    def __init__(self):
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        lib_path = os.path.join(base_dir, "..", "lib", "libeffects.so")
-        self.lib = ctypes.CDLL(lib_path)
-        self.lib.c_fade_strip.argtypes = [ctypes.POINTER(ctypes.c_uint32),
-                                          ctypes.c_int, ctypes.c_float]
-        self.lib.c_draw_bar.argtypes = [ctypes.POINTER(ctypes.c_uint32),
-                                        ctypes.c_int, ctypes.c_int,
-                                        ctypes.c_uint8, ctypes.c_uint8, ctypes.c_uint8,
-                                        ctypes.c_float]
-        self.strip = PixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA,
-                                LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL, LED_STRIP_TYPE)
-        self.strip.begin()
-        self.leds = (ctypes.c_uint32 * LED_COUNT)()
-        self.ptr = ctypes.cast(self.leds, ctypes.POINTER(ctypes.c_uint32))
-
-        if os.path.exists(SOCKET_PATH):
-            os.remove(SOCKET_PATH)
+    def __init__(self, count=LED_COUNT, output=None, socket_path=SOCKET_PATH,
+                 layout=None, snapshot=None, presets=None, trace=None):
+        self.lib = load_library()
+        if layout is None:
+            defaults = dict(pin=LED_PIN, freq_hz=LED_FREQ_HZ, dma=LED_DMA,
+                            invert=LED_INVERT, brightness=LED_BRIGHTNESS,
+                            channel=LED_CHANNEL, strip_type=LED_STRIP_TYPE)
+            if output is None and os.path.exists(LAYOUT_FILE):
+                layout = load_layout(LAYOUT_FILE, defaults)
+            else:
+                if output is None:
+                    output = make_output(LED_OUTPUT, count, **defaults)
+                layout = single_layout(output)
+        # Effects render into one logical strip covering the whole layout.
+        self.layout = layout
+        self.count = layout.count
+        self.output = LayoutOutput(layout)
+        self.stage = OutputStage(self.lib, self.count, LED_GAMMA, LED_LEVELS,
+                                 LED_MAX_MA, LED_CHANNEL_MA, LED_IDLE_MA)
+        # Render straight into the output's pixel memory when it exposes it
+        # and there is no output stage; otherwise the stage writes there.
+        if self.stage.identity:
+            self.fb = self.out_fb = FrameBuffer(self.count,
+                                                self.output.address())
+        else:
+            self.fb = FrameBuffer(self.count)
+            self.out_fb = FrameBuffer(self.count, self.output.address())
+        self.leds = self.fb.leds
+        self.ptr = self.fb.ptr
+        # Modes are presets from presets.json, compiled against this buffer.
+        self.presets_path = presets if isinstance(presets, str) else PRESETS_FILE
+        self.effects = EffectGraph(
+            self.lib, self.fb, layout.zones,
+            presets if isinstance(presets, dict) else load_presets(self.presets_path),
+            MODE_NAMES, LED_FPS)
+        self.reload_presets = False
+        self.push_timer = PushTimer()
+        self.snapshot = None
+        if snapshot:
+            try:
+                self.snapshot = FrameSnapshot(snapshot, self.count)
+            except OSError as e:
+                print("frame snapshot disabled:", e)
+        self.trace = None
+        if trace:
+            try:
+                self.trace = TraceWriter(trace, self.count, LED_FPS,
+                                         time.monotonic(), time.time())
+            except OSError as e:
+                print("state trace disabled:", e)
+        self.notifier = Notifier()
+        self.blank_on_exit = True
+        self.clock = FrameClock(LED_FPS)
+        m = self.metrics = Registry("led")
+        self.t_render = {mode: m.histogram("render_seconds", 'mode="%s"'
+                                           % name.lower())
+                         for mode, name in MODE_NAMES.items()}
+        # modes this build has no name for (newer producers)
+        self.t_render_other = m.histogram("render_seconds", 'mode="other"')
+        self.t_push = m.histogram("push_seconds")
+        self.t_frame = m.histogram("frame_seconds")
+        self.t_show = m.histogram("state_to_show_seconds")
+        self.t_sync = m.histogram("sync_error_seconds")  # |shown - apply_at|
+        self.state_since = None     # arrival of the first not yet shown state
+        m.gauge("fps", lambda: self.clock.report()["fps"])
+        m.gauge("overruns", lambda: self.clock.overruns)
+        m.gauge("producers", lambda: len(self.producers))
+        m.gauge("takeovers_total", lambda: self.takeovers)
+        m.gauge("states_coalesced", lambda: sum(p.decoder.dropped
+                                                for p in self.producers))
+        m.gauge("decode_errors", lambda: sum(p.decoder.errors
+                                             for p in self.producers))
+        m.gauge("pending_states", lambda: len(self.pending))
+        m.gauge("late_states_total", lambda: self.late_states)
+        m.gauge("render_lead_seconds", lambda: self.lead)
+        m.gauge("current_estimated_ma", lambda: self.stage.estimated_ma)
+        m.gauge("current_limited_ma", lambda: self.stage.limited_ma)
+        m.gauge("power_limited_frames", lambda: self.stage.limited_frames)
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
         self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.server.bind(SOCKET_PATH)
-        self.server.listen(1)
+        self.server.bind(socket_path)
+        self.server.listen(MAX_PRODUCERS)
         self.server.setblocking(False)
+        self.producers = []
+        self.active = None
+        self.takeovers = 0
+        self.pending = []           # heap of (apply_at, n, priority, state)
+        self.pending_n = 0
+        self.late_states = 0
+        self.lead = 0.0
+        self.apply_target = 0.0     # apply_at of the state shown next
+        self.rx = bytearray(RECV_BUFFER)
+        self.rx_view = memoryview(self.rx)
 
+        self.running = True
         self.frame = 0
-        self.chase_pos = 0.0
+        self.target = None
+        self.cur = State()
+        self.last_update = 0.0
 
     def push(self):
-        for i in range(LED_COUNT):
-            c = self.leds[i]
-            r = (c >> 16) & 0xFF
-            g = (c >> 8) & 0xFF
-            b = c & 0xFF
-            self.strip.setPixelColor(i, Color(r, g, b))
-        self.strip.show()
-
-    def fade(self, factor=FADE_FACTOR):
-        self.lib.c_fade_strip(self.ptr, LED_COUNT, float(factor))
+        t0 = self.push_timer.start()
+        t1 = self.t_push.start()
+        if self.out_fb is not self.fb:
+            self.stage.apply(self.fb, self.out_fb)
+        self.output.show(self.out_fb)
+        self.t_push.stop(t1)
+        self.push_timer.stop(t0)
+        if self.snapshot is not None:
+            self.snapshot.save(self.fb)
 
     def clear(self):
-        for i in range(LED_COUNT):
-            self.leds[i] = 0
-
-    def render_music(self, note, level, gliss, kick, snare):
-        self.fade()
-        if note >= 0:
-            section = 20
-            base = (note % 12) * section
-            hue = (note / 12.0 + gliss * 0.1) % 1.0
-            r, g, b = colorsys.hsv_to_rgb(hue, 1.0, 1.0)
-            inten = min(level * 3.0, 1.0)
-            self.lib.c_draw_bar(self.ptr, base, section,
-                                int(r * 255), int(g * 255), int(b * 255),
-                                float(inten))
-        if kick > 0.1:
-            self.lib.c_draw_bar(self.ptr, 240, 30, 255, 80, 0, float(kick))
-        if snare > 0.1:
-            self.lib.c_draw_bar(self.ptr, 270, 30, 200, 200, 255, float(snare))
-
-    def render_ambient(self, level):
-        # Gentle breathing using level as brightness hint
-        self.fade(0.95)
-        # Add a slow hue wave
-        hue = (self.frame % 600) / 600.0
-        r, g, b = colorsys.hsv_to_rgb(hue, 0.6, 0.4 + 0.4 * level)
-        self.lib.c_draw_bar(self.ptr, 0, LED_COUNT,
-                            int(r * 255), int(g * 255), int(b * 255),
-                            0.2)
-
-    def render_tree(self):
-        # Festive: red/green/gold sparkles + gentle fade
-        self.fade(0.90)
-        palette = [
-            (0, 180, 0),    # deep green
-            (0, 255, 40),   # bright green
-            (255, 0, 0),    # red
-            (255, 50, 0),   # warm red
-            (255, 180, 0),  # gold
-            (255, 255, 40), # yellowish star
-        ]
-        # A few random sparkles per frame
-        for _ in range(10):
-            idx = random.randrange(0, LED_COUNT)
-            r, g, b = random.choice(palette)
-            self.lib.c_draw_bar(self.ptr, idx, 1, r, g, b, 1.0)
-
-    def render_chase(self):
-        # Rainbow chase bar
-        self.fade(0.85)
-        bar_len = max(10, LED_COUNT // 15)
-        self.chase_pos = (self.chase_pos + 1.5) % LED_COUNT
-        head = int(self.chase_pos)
-        for i in range(bar_len):
-            pos = (head + i) % LED_COUNT
-            t = i / bar_len
-            hue = (self.chase_pos / LED_COUNT + t) % 1.0
-            r, g, b = colorsys.hsv_to_rgb(hue, 1.0, 1.0)
-            self.lib.c_draw_bar(self.ptr, pos, 1,
-                                int(r * 255), int(g * 255), int(b * 255),
-                                1.0 - 0.3 * t)
-
-    def render_sparkle(self):
-        # Cold white/blue sparkles
-        self.fade(0.88)
-        for _ in range(15):
-            if random.random() < 0.5:
-                idx = random.randrange(0, LED_COUNT)
-                # white/blue mix
-                if random.random() < 0.5:
-                    r, g, b = 255, 255, 255
-                else:
-                    r, g, b = 120, 120, 255
-                self.lib.c_draw_bar(self.ptr, idx, 1, r, g, b, 1.0)
+        self.fb.clear()
+
+    def render(self, st):
+        self.effects.render(st, self.frame)
+
+    def reload(self):
+        # SIGHUP: recompile presets.json; a broken file keeps the old looks.
+        self.reload_presets = False
+        try:
+            self.effects.compile(load_presets(self.presets_path), MODE_NAMES)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print("presets not reloaded:", e, flush=True)
+            return
+        print("presets reloaded from", self.presets_path, flush=True)
+
+    def update(self, st, now):
+        # Latest received state; fields are eased towards it in step().
+        cur = self.cur
+        if self.target is None or st.mode != cur.mode:
+            cur.level = st.level
+            cur.gliss = st.gliss
+        cur.mode = st.mode
+        cur.note = st.note
+        cur.seq = st.seq
+        cur.kick = max(cur.kick, st.kick)
+        cur.snare = max(cur.snare, st.snare)
+        cur.downbeat = max(cur.downbeat, st.downbeat)
+        cur.phase = st.phase
+        cur.tempo = st.tempo
+        self.target = st
+        self.last_update = now
+
+    def step(self, now):
+        cur = self.cur
+        tgt = self.target
+        if now - self.last_update > STATE_TIMEOUT:
+            level, gliss = 0.0, 0.0
+        else:
+            level, gliss = tgt.level, tgt.gliss
+        cur.level += (level - cur.level) * STATE_SMOOTH
+        cur.gliss += (gliss - cur.gliss) * STATE_SMOOTH
+        cur.kick *= BEAT_DECAY
+        cur.snare *= BEAT_DECAY
+        cur.downbeat *= BEAT_DECAY
+        # keep the beat phase running between updates
+        cur.phase = (cur.phase + cur.tempo / (60.0 * LED_FPS)) % 1.0
+
+    def accept(self, sel):
+        try:
+            conn, _ = self.server.accept()
+        except BlockingIOError:
+            return
+        if len(self.producers) >= MAX_PRODUCERS:
+            conn.close()
+            return
+        conn.setblocking(False)
+        p = Producer(conn)
+        self.producers.append(p)
+        sel.register(conn, selectors.EVENT_READ, p)
+
+    def drop(self, sel, p):
+        sel.unregister(p.sock)
+        p.sock.close()
+        if p.slot is not None:
+            sel.unregister(p.slot)
+            p.slot.close()
+        for fd in p.fds:
+            os.close(fd)
+        self.producers.remove(p)
+        if self.active is p:
+            self.active = None
+
+    def attach(self, sel, p):
+        # Producer offered a shared-memory slot plus its eventfd.
+        name = p.decoder.shm_name
+        p.decoder.shm_name = None
+        if ShmStateReader is None or not p.fds:
+            return
+        efd = p.fds.pop(0)
+        try:
+            p.slot = ShmStateReader(name, efd)
+        except OSError as e:
+            print("shm attach failed, staying on socket:", e)
+            os.close(efd)
+            return
+        sel.register(p.slot, selectors.EVENT_READ, p)
+        try:
+            p.sock.send(encode_ack())
+        except OSError:
+            pass
+
+    def receive(self, sel, p):
+        try:
+            n, anc, _, _ = p.sock.recvmsg_into([self.rx], ANC_BUFFER)
+        except BlockingIOError:
+            return
+        except OSError:
+            n, anc = 0, ()
+        for level, kind, data in anc:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds = array.array("i")
+                fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+                p.fds.extend(fds)
+        if not n:
+            self.drop(sel, p)
+            return
+        # backlog: only the newest state is kept
+        st = p.decoder.feed(self.rx_view[:n])
+        if p.decoder.shm_name is not None:
+            self.attach(sel, p)
+        if st is not None:
+            self.offer(p, st)
+
+    def offer(self, p, st):
+        now = time.monotonic()
+        p.last_state = now
+        # A live producer with higher priority owns the lights.
+        for q in self.producers:
+            if q.priority > p.priority and q.live(now):
+                return
+        if self.active is not p:
+            if self.active is not None and self.active.priority < p.priority:
+                self.takeovers += 1
+            self.active = p
+        if st.apply_at > 0.0:
+            if st.apply_at <= now:
+                self.late_states += 1
+            if st.apply_at - now < MAX_LOOKAHEAD:
+                if len(self.pending) >= MAX_PENDING:
+                    heapq.heappop(self.pending)
+                self.pending_n += 1
+                heapq.heappush(self.pending, (st.apply_at, self.pending_n,
+                                              p.priority, st.copy()))
+                return
+        else:
+            # untimed (a button, another producer): drop what was queued
+            self.pending.clear()
+        self.apply(p.priority, st, now)
+
+    def apply(self, priority, st, now):
+        if self.trace is not None:
+            self.trace.record(now, priority, st)
+        self.update(st, now)
+        if self.state_since is None:
+            self.state_since = now
+        if st.apply_at > 0.0:
+            self.apply_target = st.apply_at
+
+    def apply_due(self, now):
+        # Timed states heard by the time this frame reaches the strip, to
+        # the nearest frame.
+        due = now + self.lead + 0.5 / LED_FPS
+        pending = self.pending
+        while pending and pending[0][0] <= due:
+            _, _, priority, st = heapq.heappop(pending)
+            self.apply(priority, st, now)
+
+    def show_frame(self, now):
+        if self.pending:
+            self.apply_due(now)
+        # Keep rendering the last mode even when updates stop.
+        if self.target is None:
+            return
+        start = time.monotonic()
+        t0 = self.t_frame.start()
+        h = self.t_render.get(self.cur.mode, self.t_render_other)
+        t1 = h.start()
+        self.render(self.cur)
+        h.stop(t1)
+        self.push()
+        shown = time.monotonic()
+        self.lead += (shown - start - self.lead) * LEAD_SMOOTH
+        if self.state_since is not None:
+            if self.metrics.enabled:
+                self.t_show.observe(shown - self.state_since)
+                if self.apply_target:
+                    self.t_sync.observe(abs(shown - self.apply_target))
+            self.state_since = None
+            self.apply_target = 0.0
+        self.step(now)
+        self.frame += 1
+        self.t_frame.stop(t0)
+
+    def handoff(self):
+        # Stop for a restart: leave the last frame on the strip (and in the
+        # snapshot) for the next instance instead of blanking.
+        self.blank_on_exit = False
+        self.running = False
 
     def run(self):
-        conn = None
-        buf = ""
+        clock = self.clock = FrameClock(LED_FPS)
+        sel = selectors.DefaultSelector()
+        sel.register(self.server, selectors.EVENT_READ, None)
+        next_stats = time.monotonic() + STATS_INTERVAL
+        if self.snapshot is not None and self.snapshot.restore(self.fb):
+            self.push()         # warm restart: same picture, no blackout
+        self.notifier.ready()
         try:
-            while True:
-                if conn is None:
-                    try:
-                        conn, _ = self.server.accept()
-                        conn.setblocking(False)
-                    except BlockingIOError:
-                        pass
-                if conn is not None:
-                    try:
-                        data = conn.recv(1024)
-                        if not data:
-                            conn.close(); conn = None
+            while self.running:
+                # Sleep until a socket is readable or the frame is due.
+                timeout = clock.remaining()
+                if timeout > 0:
+                    for key, _ in sel.select(timeout):
+                        p = key.data
+                        if p is None:
+                            self.accept(sel)
+                        elif key.fileobj is p.sock:
+                            self.receive(sel, p)
                         else:
-                            buf += data.decode()
-                    except BlockingIOError:
-                        pass
-                    except (BrokenPipeError, ConnectionResetError):
-                        conn = None
-
-                while "\n" in buf:
-                    line, buf = buf.split("\n", 1)
-                    line = line.strip()
-                    if not line:
-                        continue
-                    parts = line.split()
-                    if parts[0] != "STATE" or len(parts) != 7:
-                        continue
-                    try:
-                        mode = int(parts[1])
-                        note = int(parts[2])
-                        level = float(parts[3])
-                        gliss = float(parts[4])
-                        kick = float(parts[5])
-                        snare = float(parts[6])
-                    except ValueError:
-                        continue
-
-                    if mode == MODE_MUSIC:
-                        self.render_music(note, level, gliss, kick, snare)
-                    elif mode == MODE_AMBIENT:
-                        self.render_ambient(level)
-                    elif mode == MODE_OFF:
-                        self.clear()
-                    elif mode == MODE_TREE:
-                        self.render_tree()
-                    elif mode == MODE_CHASE:
-                        self.render_chase()
-                    elif mode == MODE_SPARKLE:
-                        self.render_sparkle()
-
-                    self.push()
-                    self.frame += 1
-
-                time.sleep(0.01)
+                            st = p.slot.read()
+                            if st is not None:
+                                self.offer(p, st)
+                    continue
+                now = clock.tick()
+                self.notifier.beat(now)
+                if self.reload_presets:
+                    self.reload()
+
+                self.show_frame(now)
+
+                if now >= next_stats:
+                    r = clock.report()
+                    print("frames: %.1f fps, jitter %.2f/%.2f ms, overruns %d,"
+                          " push %.2f ms, producers %d, takeovers %d,"
+                          " current %.2f A (limited %d frames)"
+                          % (r["fps"], r["jitter_mean_ms"], r["jitter_max_ms"],
+                             r["overruns"], self.push_timer.mean() * 1000.0,
+                             len(self.producers), self.takeovers,
+                             self.stage.limited_ma / 1000.0,
+                             self.stage.limited_frames), flush=True)
+                    clock.reset_stats()
+                    next_stats = now + STATS_INTERVAL
+                    if self.trace is not None:
+                        self.trace.flush()
         finally:
-            if conn is not None:
-                conn.close()
+            for p in list(self.producers):
+                self.drop(sel, p)
+            sel.close()
             self.server.close()
-            self.clear()
-            self.push()
+            if self.blank_on_exit:
+                self.clear()
+                self.push()
+            self.output.close()
+            if self.snapshot is not None:
+                self.snapshot.close()
+            if self.trace is not None:
+                self.trace.close()
 
 
 if __name__ == "__main__":
-    LightServer().run()
+    srv = LightServer(snapshot=FRAME_SNAPSHOT, trace=STATE_TRACE)
+    serve_metrics(srv.metrics, METRICS_PATH)
+    # SIGUSR1: restart handoff, SIGTERM: stop and blank, SIGHUP: presets
+    signal.signal(signal.SIGUSR1, lambda *_: srv.handoff())
+    signal.signal(signal.SIGHUP, lambda *_: setattr(srv, "reload_presets", True))
+    signal.signal(signal.SIGTERM, lambda *_: setattr(srv, "running", False))
+    srv.run()
@@ -0,0 +1,617 @@
+#!/usr/bin/env python3
+# Song library: a SQLite index of the songs directory plus the play queue.
+#
+# Each track row keeps the file's path (relative to the songs directory),
+# size and mtime, probed duration / sample rate, and the analysis results
+# (BPM, loudness, content hash and feature file).  The engine never lists
+# the directory: startup opens the database and the saved queue, and a
+# watcher thread keeps the index current from inotify events (falling back
+# to a periodic rescan).  A full scan only stats files; unknown files are
+# probed afterwards, one at a time, off the audio path.
+#
+# Renames keep their row: inotify move events carry a cookie that pairs the
+# old and new name, and a scan matches a vanished row to a new file with the
+# same size and mtime (and content hash when one is known).
+#
+# The queue is a list of track ids -- sorted, shuffled or a playlist --
+# stored as one blob with the current position, so NEXT/PREV are list
+# lookups and a restart resumes at the same song.
+import os, json, time, array, random, select, sqlite3, struct, ctypes, \
+    threading, subprocess
+
+from feature_cache import content_hash, feature_path
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SONGS_DIR = os.path.join(BASE_DIR, "songs")
+LIBRARY_DB = os.environ.get("LIBRARY_DB", os.path.join(BASE_DIR, "library.db"))
+BPM_TABLE = os.path.join(BASE_DIR, "bpm_table.json")
+SONG_EXTENSIONS = (".mp3", ".flac", ".ogg", ".wav", ".m4a")
+RESCAN_INTERVAL = 60.0      # without inotify
+MOVE_PAIR_TIMEOUT = 0.5     # a moved-out file is gone if no moved-in follows
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER, mtime INTEGER,
+    present INTEGER NOT NULL DEFAULT 1,
+    added REAL,
+    probed INTEGER NOT NULL DEFAULT 0,
+    duration REAL, sample_rate INTEGER, channels INTEGER,
+    bpm REAL, loudness REAL,
+    hash TEXT, hashed_size INTEGER, hashed_mtime INTEGER,
+    features TEXT, feature_fps REAL, frames INTEGER
+);
+CREATE INDEX IF NOT EXISTS tracks_stat ON tracks (size, mtime);
+CREATE TABLE IF NOT EXISTS playlists (
+    name TEXT NOT NULL, pos INTEGER NOT NULL, track_id INTEGER NOT NULL,
+    PRIMARY KEY (name, pos)
+);
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value);
+"""
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT = struct.Struct("iIII")
+
+
+def is_song(name):
+    return name.lower().endswith(SONG_EXTENSIONS) and not name.startswith(".")
+
+
+class Inotify:
+    # Minimal ctypes binding: one fd, watches, and a batch read of events.
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", path)
+        return wd
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        # -> [(mask, cookie, name)]
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        out = []
+        pos = 0
+        while pos + EVENT.size <= len(data):
+            _, mask, cookie, n = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos:pos + n].split(b"\0", 1)[0]
+            pos += n
+            out.append((mask, cookie, os.fsdecode(name)))
+        return out
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def probe(path):
+    # duration, sample rate, channels via ffprobe; None where unknown
+    try:
+        out = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "a:0",
+             "-show_entries", "format=duration:stream=sample_rate,channels",
+             "-of", "json", path],
+            capture_output=True, timeout=10, check=True).stdout
+        info = json.loads(out)
+    except (OSError, ValueError, subprocess.SubprocessError):
+        return None, None, None
+    fmt = info.get("format", {})
+    st = (info.get("streams") or [{}])[0]
+
+    def num(v, kind):
+        try:
+            return kind(v)
+        except (TypeError, ValueError):
+            return None
+    return (num(fmt.get("duration"), float), num(st.get("sample_rate"), int),
+            num(st.get("channels"), int))
+
+
+class Library:
+    def __init__(self, db_path=LIBRARY_DB, songs_dir=SONGS_DIR):
+        self.songs_dir = songs_dir
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(db_path, timeout=10.0,
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.listeners = []     # called with (added_ids, removed_ids)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # -- settings ---------------------------------------------------------
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM settings WHERE key=?",
+                                  (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)",
+                            (key, value))
+            self.db.commit()
+
+    # -- lookups ----------------------------------------------------------
+
+    def path_of(self, tid):
+        with self.lock:
+            row = self.db.execute("SELECT path FROM tracks WHERE id=?",
+                                  (tid,)).fetchone()
+        return os.path.join(self.songs_dir, row[0]) if row else None
+
+    def name_of(self, tid):
+        with self.lock:
+            row = self.db.execute("SELECT path FROM tracks WHERE id=?",
+                                  (tid,)).fetchone()
+        return os.path.basename(row[0]) if row else ""
+
+    def entry(self, tid):
+        # The song's analysis record in the shape open_features() expects;
+        # size/mtime are the file's state when it was hashed.
+        with self.lock:
+            row = self.db.execute(
+                "SELECT bpm, loudness, hash, hashed_size, hashed_mtime,"
+                " feature_fps, frames, duration FROM tracks WHERE id=?",
+                (tid,)).fetchone()
+        if row is None:
+            return {}
+        keys = ("bpm", "loudness", "hash", "size", "mtime", "feature_fps",
+                "frames", "duration")
+        return {k: v for k, v in zip(keys, row) if v is not None}
+
+    def ids(self, present=True):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id FROM tracks WHERE present>=? ORDER BY path",
+                (1 if present else 0,)).fetchall()
+        return [r[0] for r in rows]
+
+    def find(self, path):
+        rel = os.path.relpath(os.path.join(self.songs_dir, path),
+                              self.songs_dir)
+        with self.lock:
+            row = self.db.execute("SELECT id FROM tracks WHERE path=?",
+                                  (rel,)).fetchone()
+        return row[0] if row else None
+
+    def tracks(self, present=True):
+        with self.lock:
+            cur = self.db.execute(
+                "SELECT * FROM tracks WHERE present>=? ORDER BY path",
+                (1 if present else 0,))
+            names = [d[0] for d in cur.description]
+            return [dict(zip(names, r)) for r in cur.fetchall()]
+
+    # -- scanning ---------------------------------------------------------
+
+    def _notify(self, added, removed):
+        if added or removed:
+            for fn in self.listeners:
+                fn(added, removed)
+
+    def _rename_match(self, rel, size, mtime, missing):
+        # A vanished row with the same size and mtime is the same file
+        # under a new name.  A stored content hash must agree as well;
+        # without one the match has to be unambiguous.
+        rows = missing.get((size, mtime), [])
+        for row in rows:
+            digest = row[1]
+            if digest:
+                try:
+                    if content_hash(os.path.join(self.songs_dir, rel)) != digest:
+                        continue
+                except OSError:
+                    continue
+            elif len(rows) > 1:
+                continue
+            rows.remove(row)
+            return row
+        return None
+
+    def scan(self):
+        # Incremental: stat every song, touch only rows that changed.
+        # Returns (added ids, removed ids).
+        files = {}
+        try:
+            with os.scandir(self.songs_dir) as it:
+                for e in it:
+                    if is_song(e.name) and e.is_file():
+                        st = e.stat()
+                        files[e.name] = (st.st_size, int(st.st_mtime))
+        except FileNotFoundError:
+            pass
+        added, removed = [], []
+        with self.lock:
+            rows = {r[1]: r for r in self.db.execute(
+                "SELECT id, path, size, mtime, present, hash FROM tracks")}
+            # rows without a file; absent ones can still be renamed back
+            missing = {}
+            for path, (tid, _, size, mtime, present, digest) in rows.items():
+                if path not in files:
+                    missing.setdefault((size, mtime), []).append(
+                        (tid, digest, present))
+            now = time.time()
+            for rel, (size, mtime) in sorted(files.items()):
+                row = rows.get(rel)
+                if row is None:
+                    match = self._rename_match(rel, size, mtime, missing)
+                    if match is not None:
+                        tid, _, present = match
+                        self.db.execute("UPDATE tracks SET path=?, present=1"
+                                        " WHERE id=?", (rel, tid))
+                        if not present:
+                            added.append(tid)
+                        continue
+                    cur = self.db.execute(
+                        "INSERT INTO tracks (path, size, mtime, added)"
+                        " VALUES (?, ?, ?, ?)", (rel, size, mtime, now))
+                    added.append(cur.lastrowid)
+                elif (row[2], row[3], row[4]) != (size, mtime, 1):
+                    # changed in place: reprobe, which rehashes it; analysis
+                    # only applies while hashed_size/mtime match
+                    self.db.execute(
+                        "UPDATE tracks SET size=?, mtime=?, present=1,"
+                        " probed=0 WHERE id=?", (size, mtime, row[0]))
+                    if not row[4]:
+                        added.append(row[0])
+            for gone in missing.values():
+                for tid, _, present in gone:
+                    if present:
+                        self.db.execute("UPDATE tracks SET present=0"
+                                        " WHERE id=?", (tid,))
+                        removed.append(tid)
+            self.db.commit()
+        self._notify(added, removed)
+        return added, removed
+
+    def _stat(self, rel):
+        try:
+            st = os.stat(os.path.join(self.songs_dir, rel))
+        except OSError:
+            return None
+        return st.st_size, int(st.st_mtime)
+
+    def file_changed(self, name):
+        # inotify: a song was written or moved in
+        stat = self._stat(name)
+        if stat is None or not is_song(name):
+            return
+        added = []
+        with self.lock:
+            row = self.db.execute("SELECT id, present FROM tracks WHERE path=?",
+                                  (name,)).fetchone()
+            if row is None:
+                cur = self.db.execute(
+                    "INSERT INTO tracks (path, size, mtime, added)"
+                    " VALUES (?, ?, ?, ?)", (name, stat[0], stat[1], time.time()))
+                added.append(cur.lastrowid)
+            else:
+                self.db.execute("UPDATE tracks SET size=?, mtime=?, present=1,"
+                                " probed=0 WHERE id=?", (stat[0], stat[1], row[0]))
+                if not row[1]:
+                    added.append(row[0])
+            self.db.commit()
+        self._notify(added, [])
+
+    def file_removed(self, name):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id FROM tracks WHERE path=? AND present=1",
+                (name,)).fetchone()
+            if row is None:
+                return
+            self.db.execute("UPDATE tracks SET present=0 WHERE id=?", (row[0],))
+            self.db.commit()
+        self._notify([], [row[0]])
+
+    def file_renamed(self, old, new):
+        if not is_song(new):
+            self.file_removed(old)
+            return
+        with self.lock:
+            row = self.db.execute("SELECT id, present FROM tracks WHERE path=?",
+                                  (old,)).fetchone()
+            if row is not None:
+                # a row under the new name (an overwritten file) gives way
+                over = self.db.execute("SELECT id FROM tracks WHERE path=?",
+                                       (new,)).fetchone()
+                if over is not None:
+                    self.db.execute("DELETE FROM tracks WHERE id=?", over)
+                self.db.execute("UPDATE tracks SET path=?, present=1 WHERE id=?",
+                                (new, row[0]))
+                self.db.commit()
+        if row is None:
+            self.file_changed(new)
+        else:
+            self._notify([] if row[1] else [row[0]], [over[0]] if over else [])
+
+    def unprobed(self, limit=1):
+        with self.lock:
+            return [r[0] for r in self.db.execute(
+                "SELECT id FROM tracks WHERE present=1 AND probed=0 LIMIT ?",
+                (limit,))]
+
+    def probe_track(self, tid):
+        path = self.path_of(tid)
+        duration, rate, channels = probe(path) if path else (None, None, None)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT hash, hashed_size, hashed_mtime, size, mtime"
+                " FROM tracks WHERE id=?", (tid,)).fetchone()
+        # A touched file whose content is unchanged keeps its cached
+        # features.  Hashing happens here, on the watcher thread, so the
+        # playback path only compares size/mtime.
+        rehashed = None
+        if path and row and row[0] and (row[1], row[2]) != (row[3], row[4]):
+            try:
+                if content_hash(path) == row[0]:
+                    rehashed = (row[3], row[4])
+            except OSError:
+                pass
+        with self.lock:
+            self.db.execute(
+                "UPDATE tracks SET probed=1, duration=COALESCE(?, duration),"
+                " sample_rate=?, channels=? WHERE id=?",
+                (duration, rate, channels, tid))
+            if rehashed is not None:
+                self.db.execute("UPDATE tracks SET hashed_size=?, hashed_mtime=?"
+                                " WHERE id=?", rehashed + (tid,))
+            self.db.commit()
+
+    # -- analysis results -------------------------------------------------
+
+    def set_analysis(self, tid, entry):
+        # entry from tools/analyze_bpm.py: hash, size, mtime, feature_fps and,
+        # when (re)analyzed, bpm, frames, loudness, duration
+        digest = entry.get("hash")
+        with self.lock:
+            self.db.execute(
+                "UPDATE tracks SET hash=?, hashed_size=?, hashed_mtime=?,"
+                " features=?, feature_fps=?, bpm=COALESCE(?, bpm),"
+                " frames=COALESCE(?, frames), loudness=COALESCE(?, loudness),"
+                " duration=COALESCE(duration, ?) WHERE id=?",
+                (digest, entry.get("size"), entry.get("mtime"),
+                 feature_path(digest) if digest else None,
+                 entry.get("feature_fps"), entry.get("bpm"), entry.get("frames"),
+                 entry.get("loudness"), entry.get("duration"), tid))
+            self.db.commit()
+
+    def import_table(self, path=BPM_TABLE):
+        # One-off import of the old bpm_table.json (keyed by file name).
+        try:
+            with open(path, "r") as f:
+                table = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        n = 0
+        for name, entry in table.items():
+            tid = self.find(name)
+            if tid is not None and isinstance(entry, dict):
+                self.set_analysis(tid, entry)
+                n += 1
+        return n
+
+    # -- playlists --------------------------------------------------------
+
+    def set_playlist(self, name, tids):
+        with self.lock:
+            self.db.execute("DELETE FROM playlists WHERE name=?", (name,))
+            self.db.executemany("INSERT INTO playlists VALUES (?, ?, ?)",
+                                [(name, i, t) for i, t in enumerate(tids)])
+            self.db.commit()
+
+    def playlist(self, name):
+        with self.lock:
+            return [r[0] for r in self.db.execute(
+                "SELECT p.track_id FROM playlists p JOIN tracks t"
+                " ON t.id = p.track_id WHERE p.name=? AND t.present=1"
+                " ORDER BY p.pos", (name,))]
+
+    def playlists(self):
+        with self.lock:
+            return [r[0] for r in self.db.execute(
+                "SELECT DISTINCT name FROM playlists ORDER BY name")]
+
+
+class PlayQueue:
+    # Track ids in play order plus the current position.  kind is "all"
+    # (sorted by path), "shuffle" or "playlist:<name>".  New songs join "all"
+    # at the end and "shuffle" at a random later position; songs that
+    # disappear leave the queue.  Positions wrap around.  kind=None resumes
+    # the saved queue, whatever its kind.
+    def __init__(self, library, kind=None):
+        self.lib = library
+        self.lock = threading.Lock()
+        self.order = array.array("q")
+        self.pos = 0
+        self.kind = None
+        saved = library.get("queue_kind")
+        kind = kind or saved or "all"
+        if saved == kind and library.get("queue_order") is not None:
+            self.kind = kind
+            self.order.frombytes(library.get("queue_order"))
+            self.pos = int(library.get("queue_pos", 0))
+        else:
+            self.rebuild(kind)
+        library.listeners.append(self.changed)
+
+    def __len__(self):
+        return len(self.order)
+
+    def rebuild(self, kind):
+        if kind == "shuffle":
+            ids = self.lib.ids()
+            random.shuffle(ids)
+        elif kind.startswith("playlist:"):
+            ids = self.lib.playlist(kind.split(":", 1)[1])
+        else:
+            kind = "all"
+            ids = self.lib.ids()
+        with self.lock:
+            self.kind = kind
+            self.order = array.array("q", ids)
+            self.pos = 0
+        self._save(order=True)
+
+    def _save(self, order=False):
+        if order:
+            self.lib.put("queue_kind", self.kind)
+            self.lib.put("queue_order", self.order.tobytes())
+        self.lib.put("queue_pos", self.pos)
+
+    def id_at(self, pos):
+        with self.lock:
+            n = len(self.order)
+            return self.order[pos % n] if n else None
+
+    def seek(self, pos):
+        # Makes pos current; returns its track id.
+        with self.lock:
+            n = len(self.order)
+            if not n:
+                return None
+            self.pos = pos % n
+            tid = self.order[self.pos]
+        self.lib.put("queue_pos", self.pos)
+        return tid
+
+    def changed(self, added, removed):
+        with self.lock:
+            if removed:
+                gone = set(removed)
+                keep = array.array("q")
+                for i, tid in enumerate(self.order):
+                    if tid in gone:
+                        if i < self.pos:
+                            self.pos -= 1
+                    else:
+                        keep.append(tid)
+                self.order = keep
+                if self.pos >= len(keep):
+                    self.pos = 0
+            if self.kind == "all":
+                self.order.extend(added)
+            elif self.kind == "shuffle":
+                for tid in added:
+                    n = len(self.order)
+                    self.order.insert(random.randint(min(self.pos + 1, n), n),
+                                      tid)
+        self._save(order=True)
+
+
+class LibraryWatcher(threading.Thread):
+    # Keeps the index current: an initial incremental scan, then inotify
+    # events (or a rescan every RESCAN_INTERVAL), with probing of new files
+    # in between.
+    def __init__(self, library, import_table=BPM_TABLE):
+        super().__init__(daemon=True)
+        self.lib = library
+        self.import_path = import_table
+        self.running = True
+        self.inotify = None
+        try:
+            self.inotify = Inotify()
+            self.inotify.add_watch(library.songs_dir)
+        except (OSError, AttributeError) as e:
+            print("library: no inotify (%s), rescanning every %.0f s"
+                  % (e, RESCAN_INTERVAL))
+            if self.inotify is not None:
+                self.inotify.close()
+            self.inotify = None
+        self.moves = {}         # cookie -> (old name, time)
+
+    def stop(self):
+        self.running = False
+
+    def handle(self, events):
+        for mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.lib.scan()
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                print("library: songs directory went away", flush=True)
+            elif mask & IN_ISDIR:
+                continue
+            elif mask & IN_MOVED_FROM:
+                self.moves[cookie] = (name, time.monotonic())
+            elif mask & IN_MOVED_TO:
+                old = self.moves.pop(cookie, None)
+                if old is not None:
+                    self.lib.file_renamed(old[0], name)
+                else:
+                    self.lib.file_changed(name)
+            elif mask & IN_CLOSE_WRITE:
+                self.lib.file_changed(name)
+            elif mask & IN_DELETE:
+                self.lib.file_removed(name)
+
+    def expire_moves(self, now):
+        for cookie, (name, t) in list(self.moves.items()):
+            if now - t > MOVE_PAIR_TIMEOUT:
+                del self.moves[cookie]
+                self.lib.file_removed(name)     # moved out of the directory
+
+    def run(self):
+        lib = self.lib
+        lib.scan()
+        if self.import_path and not lib.get("imported_table"):
+            n = lib.import_table(self.import_path)
+            lib.put("imported_table", 1)
+            if n:
+                print("library: imported %d songs from %s"
+                      % (n, os.path.basename(self.import_path)), flush=True)
+        next_scan = time.monotonic() + RESCAN_INTERVAL
+        try:
+            while self.running:
+                pending = lib.unprobed(1)
+                timeout = 0.0 if pending else MOVE_PAIR_TIMEOUT
+                if self.inotify is not None:
+                    ready, _, _ = select.select([self.inotify], [], [], timeout)
+                    if ready:
+                        self.handle(self.inotify.read())
+                        continue
+                elif not pending:
+                    time.sleep(timeout)
+                now = time.monotonic()
+                self.expire_moves(now)
+                if self.inotify is None and now >= next_scan:
+                    lib.scan()
+                    next_scan = now + RESCAN_INTERVAL
+                if pending:
+                    lib.probe_track(pending[0])
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# Stage timing histograms, counters and a local read-only metrics endpoint.
+#
+# Histograms have fixed log-spaced buckets in preallocated arrays; recording
+# a sample is a clock read, a bisect and two array updates.  Timing can be
+# switched off at runtime (start() then returns None and stop() returns at
+# once), and `every` samples only one call in N.  Counters that already exist
+# elsewhere (ring drops, sender drops, ...) are exported as gauges read at
+# query time, so they cost nothing on the hot path.
+#
+# The endpoint is a Unix stream socket.  A client sends one word and gets one
+# reply: "json" (default), "prom" (Prometheus text), "on", "off" or "reset".
+import os, json, math, time, array, bisect, socket, threading
+
+METRICS_ENABLED = os.environ.get("ML_METRICS", "1") == "1"
+
+# 10 us .. ~1.3 s, four buckets per octave
+BUCKETS = tuple(1e-5 * 2 ** (i / 4.0) for i in range(68))
+
+
+class Histogram:
+    def __init__(self, registry, name, labels="", bounds=BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.bounds = bounds
+        self.counts = array.array("Q", bytes(8 * (len(bounds) + 1)))
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.every = 1
+        self._n = 0
+
+    def start(self):
+        if not self.registry.enabled:
+            return None
+        if self.every > 1:
+            self._n += 1
+            if self._n % self.every:
+                return None
+        return time.perf_counter()
+
+    def stop(self, t0):
+        if t0 is not None:
+            self.observe(time.perf_counter() - t0)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the q-th sample
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and i < len(self.bounds):
+                return min(self.bounds[i], self.max)
+        return self.max
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class Registry:
+    def __init__(self, prefix, enabled=METRICS_ENABLED):
+        self.prefix = prefix
+        self.enabled = enabled
+        self.histograms = []
+        self.gauges = {}
+        self.started = time.monotonic()
+
+    def histogram(self, name, labels="", every=1):
+        h = Histogram(self, "%s_%s" % (self.prefix, name), labels)
+        h.every = every
+        self.histograms.append(h)
+        return h
+
+    def gauge(self, name, fn):
+        self.gauges["%s_%s" % (self.prefix, name)] = fn
+
+    def reset(self):
+        for h in self.histograms:
+            h.reset()
+        self.started = time.monotonic()
+
+    def _gauge_values(self):
+        out = {}
+        for name, fn in self.gauges.items():
+            try:
+                out[name] = float(fn())
+            except Exception:
+                out[name] = float("nan")
+        return out
+
+    def snapshot(self):
+        hists = {}
+        for h in self.histograms:
+            key = h.name + ("{%s}" % h.labels if h.labels else "")
+            hists[key] = {
+                "count": h.count,
+                "mean_ms": h.sum / h.count * 1000.0 if h.count else 0.0,
+                "p50_ms": h.quantile(0.5) * 1000.0,
+                "p99_ms": h.quantile(0.99) * 1000.0,
+                "max_ms": h.max * 1000.0,
+            }
+        return {"enabled": self.enabled,
+                "window_s": time.monotonic() - self.started,
+                "gauges": self._gauge_values(), "histograms": hists}
+
+    def prometheus(self):
+        lines = []
+        for name, value in self._gauge_values().items():
+            lines.append("%s %s" % (name, prom_value(value)))
+        seen = set()
+        for h in self.histograms:
+            if h.name not in seen:
+                lines.append("# TYPE %s histogram" % h.name)
+                seen.add(h.name)
+            lab = h.labels + "," if h.labels else ""
+            total = 0
+            for i, bound in enumerate(h.bounds):
+                total += h.counts[i]
+                lines.append('%s_bucket{%sle="%.6g"} %d' % (h.name, lab, bound, total))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (h.name, lab, h.count))
+            suffix = "{%s}" % h.labels if h.labels else ""
+            lines.append("%s_sum%s %s" % (h.name, suffix, prom_value(h.sum)))
+            lines.append("%s_count%s %d" % (h.name, suffix, h.count))
+        return "\n".join(lines) + "\n"
+
+
+def prom_value(v):
+    # Prometheus text format spells the special values NaN, +Inf and -Inf.
+    if math.isnan(v):
+        return "NaN"
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr(float(v))
+
+
+class MetricsServer(threading.Thread):
+    # Serves one registry on a Unix socket; runs entirely off the hot path.
+    def __init__(self, registry, path):
+        super().__init__(daemon=True)
+        self.registry = registry
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(4)
+
+    def handle(self, word):
+        reg = self.registry
+        if word == "prom":
+            return reg.prometheus()
+        if word in ("on", "off"):
+            reg.enabled = word == "on"
+        elif word == "reset":
+            reg.reset()
+        return json.dumps(reg.snapshot(), indent=1) + "\n"
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    conn.settimeout(1.0)
+                    word = conn.recv(64).decode(errors="replace").strip().lower()
+                    conn.sendall(self.handle(word or "json").encode())
+                except OSError:
+                    pass
+
+    def close(self):
+        self.sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def serve(registry, path):
+    try:
+        srv = MetricsServer(registry, path)
+    except OSError as e:
+        print("metrics endpoint disabled:", e)
+        return None
+    srv.start()
+    return srv
+
+
+def query(path, word="json"):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(2.0)
+    with s:
+        s.connect(path)
+        s.sendall(word.encode())
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            data = s.recv(65536)
+            if not data:
+                return b"".join(chunks).decode()
+            chunks.append(data)
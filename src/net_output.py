@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import ctypes, ctypes.util, socket, struct, uuid
+
+import numpy as np
+
+E131_PORT = 5568
+DDP_PORT = 4048
+E131_HEADER = 126
+E131_SYNC_SIZE = 49
+E131_SEQ_OFFSET = 111
+E131_MAX_PIXELS = 170           # 510 of 512 DMX slots
+DDP_HEADER = 10
+DDP_MAX_PIXELS = 480            # 1440 byte payload, fits a 1500 MTU
+DDP_FLAG_VER1 = 0x40
+DDP_FLAG_PUSH = 0x01
+DDP_TYPE_RGB8 = 0x0B
+DDP_ID_DISPLAY = 1
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fn = libc.sendmmsg
+    except (OSError, AttributeError, TypeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    fn.restype = ctypes.c_int
+    return fn
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+class PacketBatch:
+    # Fixed set of preallocated UDP packets to one destination, sent with a
+    # single sendmmsg() call when libc provides it.
+    def __init__(self, sock, host, port, sizes):
+        self.sock = sock
+        self.dest = (socket.gethostbyname(host), port)
+        self.packets = [bytearray(n) for n in sizes]
+        self._cbufs = [(ctypes.c_char * len(p)).from_buffer(p) for p in self.packets]
+        n = len(self.packets)
+        self._iov = (_iovec * n)()
+        self._msgs = (_mmsghdr * n)()
+        # sockaddr_in: family in host order, port and address in network order
+        sin = (struct.pack("=H", socket.AF_INET) + struct.pack("!H", port)
+               + socket.inet_aton(self.dest[0]) + bytes(8))
+        self._addr = ctypes.create_string_buffer(sin, len(sin))
+        for i, cb in enumerate(self._cbufs):
+            self._iov[i].iov_base = ctypes.addressof(cb)
+            self._iov[i].iov_len = len(cb)
+            h = self._msgs[i].msg_hdr
+            h.msg_name = ctypes.addressof(self._addr)
+            h.msg_namelen = len(sin)
+            h.msg_iov = ctypes.pointer(self._iov[i])
+            h.msg_iovlen = 1
+        self._base = ctypes.addressof(self._msgs)
+        self._stride = ctypes.sizeof(_mmsghdr)
+        self.syscalls = 0
+        self.sent = 0
+        self.errors = 0
+
+    def view(self, i, start, length):
+        return np.frombuffer(self.packets[i], dtype=np.uint8,
+                             count=length, offset=start)
+
+    def send(self, count=None):
+        n = len(self.packets) if count is None else count
+        if _sendmmsg is not None:
+            done = 0
+            while done < n:
+                r = _sendmmsg(self.sock.fileno(), self._base + done * self._stride,
+                              n - done, 0)
+                self.syscalls += 1
+                if r <= 0:
+                    self.errors += 1
+                    break
+                done += r
+            self.sent += done
+            return
+        for p in self.packets[:n]:
+            try:
+                self.sock.sendto(p, self.dest)
+                self.sent += 1
+            except OSError:
+                self.errors += 1
+            self.syscalls += 1
+
+
+def rgb_view(fb):
+    # 0x00RRGGBB little-endian words -> (count, 3) R,G,B byte view, no copy
+    return fb.pixels.view(np.uint8).reshape(-1, 4)[:, 2::-1]
+
+
+class _UdpOutput:
+    def __init__(self, count):
+        self.count = count
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        self.frames = 0
+
+    def address(self):
+        return None
+
+    def close(self):
+        self.sock.close()
+
+
+class E131Output(_UdpOutput):
+    def __init__(self, count, host, universe=1, pixels_per_universe=E131_MAX_PIXELS,
+                 sync_universe=0, priority=100, source="musical_lights",
+                 port=E131_PORT, **_):
+        super().__init__(count)
+        ppu = max(1, min(E131_MAX_PIXELS, pixels_per_universe))
+        self.spans = [(i, min(ppu, count - i)) for i in range(0, count, ppu)]
+        sizes = [E131_HEADER + 3 * n for _, n in self.spans]
+        self.sync_universe = sync_universe
+        if sync_universe:
+            sizes.append(E131_SYNC_SIZE)
+        self.batch = PacketBatch(self.sock, host, port, sizes)
+        cid = uuid.uuid5(uuid.NAMESPACE_DNS, "%s/%s/%d" % (source, host, universe)).bytes
+        for k, (_, n) in enumerate(self.spans):
+            self._data_header(self.batch.packets[k], cid, source, priority,
+                              universe + k, 3 * n)
+        if sync_universe:
+            self._sync_header(self.batch.packets[-1], cid, sync_universe)
+        self.payload = [self.batch.view(k, E131_HEADER, 3 * n)
+                        .reshape(n, 3) for k, (_, n) in enumerate(self.spans)]
+        self.seq = 0
+
+    def _data_header(self, p, cid, source, priority, universe, slots):
+        length = E131_HEADER + slots
+        struct.pack_into("!HH12sHI16s", p, 0, 0x0010, 0, b"ASC-E1.17\0\0\0",
+                         0x7000 | (length - 16), 0x00000004, cid)
+        struct.pack_into("!HI64sBHBBH", p, 38, 0x7000 | (length - 38),
+                         0x00000002, source.encode()[:63], priority,
+                         self.sync_universe, 0, 0, universe)
+        struct.pack_into("!HBBHHHB", p, 115, 0x7000 | (length - 115), 0x02,
+                         0xA1, 0, 1, slots + 1, 0)
+
+    def _sync_header(self, p, cid, sync_universe):
+        struct.pack_into("!HH12sHI16s", p, 0, 0x0010, 0, b"ASC-E1.17\0\0\0",
+                         0x7000 | (E131_SYNC_SIZE - 16), 0x00000008, cid)
+        struct.pack_into("!HIBHH", p, 38, 0x7000 | (E131_SYNC_SIZE - 38),
+                         0x00000001, 0, sync_universe, 0)
+
+    def show(self, fb):
+        rgb = rgb_view(fb)
+        self.seq = (self.seq + 1) & 0xFF
+        packets = self.batch.packets
+        for k, (start, n) in enumerate(self.spans):
+            self.payload[k][:] = rgb[start:start + n]
+            packets[k][E131_SEQ_OFFSET] = self.seq
+        if self.sync_universe:
+            packets[-1][44] = self.seq   # sync packet sequence number
+        self.batch.send()
+        self.frames += 1
+
+
+class DDPOutput(_UdpOutput):
+    def __init__(self, count, host, port=DDP_PORT, pixels_per_packet=DDP_MAX_PIXELS,
+                 dest_id=DDP_ID_DISPLAY, **_):
+        super().__init__(count)
+        ppp = max(1, min(DDP_MAX_PIXELS, pixels_per_packet))
+        self.spans = [(i, min(ppp, count - i)) for i in range(0, count, ppp)]
+        self.batch = PacketBatch(self.sock, host, port,
+                                 [DDP_HEADER + 3 * n for _, n in self.spans])
+        last = len(self.spans) - 1
+        for k, (start, n) in enumerate(self.spans):
+            flags = DDP_FLAG_VER1 | (DDP_FLAG_PUSH if k == last else 0)
+            struct.pack_into("!BBBBIH", self.batch.packets[k], 0, flags, 0,
+                             DDP_TYPE_RGB8, dest_id, 3 * start, 3 * n)
+        self.payload = [self.batch.view(k, DDP_HEADER, 3 * n).reshape(n, 3)
+                        for k, (_, n) in enumerate(self.spans)]
+        self.seq = 0
+
+    def show(self, fb):
+        rgb = rgb_view(fb)
+        self.seq = self.seq % 15 + 1     # 1..15, 0 means "not used"
+        packets = self.batch.packets
+        for k, (start, n) in enumerate(self.spans):
+            self.payload[k][:] = rgb[start:start + n]
+            packets[k][1] = self.seq
+        self.batch.send()
+        self.frames += 1
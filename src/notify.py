@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# Readiness and heartbeat messages to the supervisor.  The supervisor passes
+# the write end of a pipe in ML_NOTIFY_FD; without it (engine started by
+# hand) every call is a no-op.  Heartbeats are rate limited, so calling
+# beat() once per frame costs a clock read.
+import os, time
+
+NOTIFY_ENV = "ML_NOTIFY_FD"
+HEARTBEAT_INTERVAL = 1.0
+
+
+class Notifier:
+    def __init__(self, fd=None):
+        if fd is None:
+            try:
+                fd = int(os.environ.get(NOTIFY_ENV, ""))
+            except ValueError:
+                fd = None
+        self.fd = fd
+        self.next_beat = 0.0
+        if fd is not None:
+            try:
+                os.set_blocking(fd, False)
+            except OSError:
+                self.fd = None
+
+    def _send(self, msg):
+        if self.fd is None:
+            return
+        try:
+            os.write(self.fd, msg)
+        except BlockingIOError:
+            pass                        # supervisor busy; next beat will do
+        except OSError:
+            self.fd = None              # supervisor gone
+
+    def ready(self):
+        self._send(b"READY\n")
+        self.next_beat = time.monotonic() + HEARTBEAT_INTERVAL
+
+    def beat(self, now=None):
+        if self.fd is None:
+            return
+        if now is None:
+            now = time.monotonic()
+        if now >= self.next_beat:
+            self.next_beat = now + HEARTBEAT_INTERVAL
+            self._send(b"BEAT\n")
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
+import os, time, threading
+
 HAVE_OLED = False
 _oled = None
+_worker = None
+_worker_lock = threading.Lock()
 try:
     import board, busio
     from adafruit_ssd1306 import SSD1306_I2C
@@ -9,6 +13,14 @@ try:
 except ImportError:
     HAVE_OLED = False
 
+OLED_WIDTH = 128
+OLED_HEIGHT = 32
+LINE_HEIGHT = 10
+MIN_INTERVAL = 0.2          # at most 5 full I2C refreshes per second
+STATS_INTERVAL = 1.0
+GLYPH_CACHE_SIZE = 64
+OLED_STATS = os.environ.get("OLED_STATS", "0") == "1"
+
 
 class OLEDStub:
     def show_text(self, l1="", l2="", l3=""):
@@ -16,6 +28,8 @@ class OLEDStub:
 
 
 class RealOLED:
+    # One image is reused for every frame; each line is rendered once per
+    # distinct text and pasted from the cache afterwards.
     def __init__(self, drv, w, h, font=None):
         self.drv = drv
         self.w = w
@@ -23,16 +37,30 @@ class RealOLED:
         self.Image = Image
         self.ImageDraw = ImageDraw
         self.font = font
+        self.img = self.Image.new("1", (self.w, self.h))
+        self.lines = [None, None, None]
+        self.glyphs = {}
+
+    def _line(self, text):
+        img = self.glyphs.get(text)
+        if img is None:
+            if len(self.glyphs) >= GLYPH_CACHE_SIZE:
+                self.glyphs.pop(next(iter(self.glyphs)))
+            img = self.Image.new("1", (self.w, LINE_HEIGHT))
+            self.ImageDraw.Draw(img).text((0, 0), text, font=self.font, fill=255)
+            self.glyphs[text] = img
+        return img
 
     def show_text(self, l1="", l2="", l3=""):
-        img = self.Image.new("1", (self.w, self.h))
-        draw = self.ImageDraw.Draw(img)
-        draw.rectangle((0, 0, self.w, self.h), outline=0, fill=0)
-        draw.text((0, 0), str(l1), font=self.font, fill=255)
-        draw.text((0, 10), str(l2), font=self.font, fill=255)
-        draw.text((0, 20), str(l3), font=self.font, fill=255)
-        self.drv.image(img)
-        self.drv.show()
+        changed = False
+        for i, text in enumerate((str(l1), str(l2), str(l3))):
+            if text != self.lines[i]:
+                self.img.paste(self._line(text), (0, i * LINE_HEIGHT))
+                self.lines[i] = text
+                changed = True
+        if changed:
+            self.drv.image(self.img)
+            self.drv.show()
 
 
 def _init():
@@ -42,19 +70,99 @@ def _init():
         return
     try:
         i2c = busio.I2C(board.SCL, board.SDA)
-        drv = SSD1306_I2C(128, 32, i2c)
+        drv = SSD1306_I2C(OLED_WIDTH, OLED_HEIGHT, i2c)
         try:
             font = ImageFont.load_default()
         except Exception:
             font = None
-        _oled = RealOLED(drv, 128, 32, font)
+        _oled = RealOLED(drv, OLED_WIDTH, OLED_HEIGHT, font)
     except Exception as e:
         print("OLED init failed:", e)
         _oled = OLEDStub()
 
 
-def oled_show(l1="", l2="", l3=""):
-    global _oled
-    if _oled is None:
+class DisplayWorker(threading.Thread):
+    # Owns the display.  Callers only replace the pending text; the worker
+    # coalesces bursts, drops repeats and rate-limits the I2C refreshes.
+    def __init__(self, min_interval=MIN_INTERVAL, show_stats=OLED_STATS):
+        super().__init__(daemon=True)
+        self.min_interval = min_interval
+        self.show_stats = show_stats
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = None
+        self.shown = None
+        self.stats = {}
+        self.running = True
+        self.updates = 0
+        self.coalesced = 0
+
+    def post(self, l1="", l2="", l3=""):
+        with self.lock:
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = (str(l1), str(l2), str(l3))
+        self.wake.set()
+
+    def set_stats(self, **values):
+        with self.lock:
+            self.stats.update(values)
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
+    def _stats_line(self):
+        parts = []
+        fps = self.stats.get("fps")
+        bpm = self.stats.get("bpm")
+        if fps is not None:
+            parts.append("%.0ffps" % fps)
+        if bpm:
+            parts.append("%.0fbpm" % bpm)
+        return " ".join(parts)
+
+    def run(self):
         _init()
-    _oled.show_text(l1, l2, l3)
+        last = 0.0
+        while self.running:
+            self.wake.wait(STATS_INTERVAL if self.show_stats else None)
+            self.wake.clear()
+            if not self.running:
+                break
+            wait = last + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)        # later posts overwrite pending meanwhile
+            with self.lock:
+                text = self.pending or self.shown
+                self.pending = None
+                if text is not None and self.show_stats:
+                    text = (text[0], text[1], self._stats_line() or text[2])
+            if text is None or text == self.shown:
+                continue
+            try:
+                _oled.show_text(*text)
+            except Exception as e:
+                print("OLED update failed:", e)
+            self.shown = text
+            self.updates += 1
+            last = time.monotonic()
+
+
+def _get_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = DisplayWorker()
+            _worker.start()
+        return _worker
+
+
+def oled_show(l1="", l2="", l3=""):
+    # Never blocks on the bus: the text is handed to the display worker.
+    _get_worker().post(l1, l2, l3)
+
+
+def oled_stats(**values):
+    if OLED_STATS:
+        _get_worker().set_stats(**values)
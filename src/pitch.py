@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import math
+
+import numpy as np
+
+# Lead pitch from the analyzer's magnitude spectrum.
+#  - Harmonic product spectrum (summed in the log domain) over the candidate
+#    bins picks the fundamental, which removes most octave-up errors of a
+#    plain argmax; a sub-octave check catches the opposite case.  Only
+#    candidates with a real peak of their own compete, so a pure tone is not
+#    outvoted by noise that happens to sit on some other bin's harmonics.
+#  - The peak is refined by parabolic interpolation on log magnitude (exact
+#    for a Gaussian peak, close for the Hann window) around the local maximum
+#    nearest each of the first few harmonics, averaged by their level.
+#  - Confidence is the share of band energy that sits on the harmonics.
+# Index arrays are built once; a hop is one gather + reduction for the HPS
+# and a fifteen-value gather for the refinement, done with scalar math.
+HPS_HARMONICS = 4
+REFINE_HARMONICS = 3
+SUB_OCTAVE_RATIO = 0.3      # keep f/2 only if its peak is at least this strong
+FUNDAMENTAL_FLOOR = 0.03    # candidates weaker than this share of the band
+                            # peak are noise, however their harmonics score
+EPS = 1e-6
+LOG_FLOOR = math.log(FUNDAMENTAL_FLOOR)
+
+
+class PitchEstimator:
+    def __init__(self, freqs, band, harmonics=HPS_HARMONICS,
+                 refine=REFINE_HARMONICS, min_amp=0.2, dtype=np.float32):
+        self.freqs = freqs
+        self.df = float(freqs[1] - freqs[0])
+        self.nbins = freqs.size
+        self.min_amp = min_amp
+        lo = max(1, int(np.searchsorted(freqs, band[0], "left")))
+        hi = int(np.searchsorted(freqs, band[1], "right"))
+        self.lo = lo
+        self.cand = np.arange(lo, hi)
+        # harmonic h of candidate k sits at bin h*k (clipped to the spectrum)
+        h = np.arange(1, harmonics + 1)[:, None]
+        self.hps_idx = np.minimum(h * self.cand[None, :], self.nbins - 1)
+        self.gather = np.zeros(self.hps_idx.shape, dtype=dtype)
+        self.hps = np.zeros(self.cand.size, dtype=dtype)
+        self.refine = refine
+        # bins k*h-2 .. k*h+2 for h = 1..refine, filled in per hop
+        self.ref_mul = np.repeat(np.arange(1, refine + 1), 5)
+        self.ref_off = np.tile(np.arange(-2, 3), refine)
+        self.ref_idx = np.zeros(5 * refine, dtype=np.intp)
+        self.band_hi = min(self.nbins - 1, hi * refine + 1)
+        self.frequency = 0.0
+        self.confidence = 0.0
+        self.amplitude = 0.0
+
+    def estimate(self, mag):
+        # Returns (frequency Hz or 0.0, confidence 0..1); also kept as attrs.
+        g = self.gather
+        np.take(mag, self.hps_idx, out=g)
+        np.maximum(g, EPS, out=g)
+        np.log(g, out=g)
+        g.sum(axis=0, out=self.hps)
+        # g[0] holds log mag of the candidates themselves
+        np.putmask(self.hps, g[0] < g[0].max() + LOG_FLOOR, -np.inf)
+        k = int(self.cand[int(self.hps.argmax())])
+        # the HPS winner can sit a bin off the actual spectral peak
+        if mag[k - 1] > mag[k] and mag[k - 1] >= mag[k + 1]:
+            k -= 1
+        elif mag[k + 1] > mag[k]:
+            k += 1
+        half = k // 2
+        if (half - 1 >= self.lo and mag[half] >= SUB_OCTAVE_RATIO * mag[k]
+                and mag[half] >= mag[half - 1] and mag[half] >= mag[half + 1]):
+            # strong sub-octave peak: the candidate was the 2nd harmonic
+            k = half
+        self.amplitude = amp = float(mag[k])
+        if amp <= self.min_amp:
+            self.frequency = self.confidence = 0.0
+            return 0.0, 0.0
+
+        # refine the fundamental from its first harmonics
+        idx = self.ref_idx
+        np.multiply(self.ref_mul, k, out=idx)
+        np.add(idx, self.ref_off, out=idx)
+        np.minimum(idx, self.nbins - 1, out=idx)
+        vals = mag.take(idx).tolist()
+        num = den = on = 0.0
+        for h in range(1, self.refine + 1):
+            if h * k + 2 >= self.nbins:
+                break
+            w = vals[5 * h - 5:5 * h]
+            # local peak within one bin of h*k, then its two neighbours
+            j = max((1, 2, 3), key=w.__getitem__)
+            a, b, c = w[j - 1:j + 2]
+            on += a * a + b * b + c * c
+            la, lb, lc = math.log(a + EPS), math.log(b + EPS), math.log(c + EPS)
+            # not a local maximum -> clamp pushes delta to the +-0.5 limit
+            denom = min(la - 2.0 * lb + lc, -EPS)
+            delta = max(-0.5, min(0.5, 0.5 * (la - lc) / denom))
+            num += (h * k + j - 2 + delta) / h * b
+            den += b
+        f0 = num / den * self.df if den > 0.0 else k * self.df
+
+        band = mag[self.lo:self.band_hi]
+        total = float(np.dot(band, band))
+        self.confidence = min(1.0, on / total) if total > 0.0 else 0.0
+        self.frequency = f0
+        return f0, self.confidence
@@ -1,4 +1,4 @@
-import socket
+import socket, struct
 
 SOCKET_PATH = "/tmp/musical_lights.sock"
 
@@ -22,10 +22,180 @@ NOTE_NAMES = ["C", "C#", "D", "D#", "E", "F",
               "F#", "G", "G#", "A", "A#", "B"]
 
 
-def create_client_socket():
+def create_client_socket(path=SOCKET_PATH):
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        s.connect(SOCKET_PATH)
+        s.connect(path)
         return s
     except (FileNotFoundError, ConnectionRefusedError):
+        s.close()
         return None
+
+
+# Binary state messages.  Every message starts with a fixed header:
+#   magic "ML", version, kind, total length, sequence number
+# Newer versions only append fields, so a reader decodes the prefix it knows
+# and uses the length field to step over the rest.
+PROTO_MAGIC = b"ML"
+PROTO_VERSION = 3
+MSG_STATE = 1
+MSG_HELLO = 2
+MSG_SHM = 3      # producer offers a shared-memory slot (eventfd via SCM_RIGHTS)
+MSG_ACK = 4      # LED engine -> producer: slot attached, stop sending states
+
+# Producers with a higher priority take over the lights while they are
+# sending; equal priorities share them (newest state wins).
+PRIORITY_DEFAULT = 100
+PRIORITY_MAX = 255
+
+HEADER = struct.Struct("<2sBBHI")
+STATE_V1 = struct.Struct("<bbffff")  # mode note level gliss kick snare
+STATE_V2 = struct.Struct("<fff")     # beat phase, tempo (bpm), downbeat
+STATE_V3 = struct.Struct("<d")       # apply at (CLOCK_MONOTONIC s, 0: now)
+STATE_V1_SIZE = HEADER.size + STATE_V1.size
+STATE_V2_SIZE = STATE_V1_SIZE + STATE_V2.size
+STATE_SIZE = STATE_V2_SIZE + STATE_V3.size
+HELLO_V1 = struct.Struct("<B15s")     # priority, producer name
+HELLO_SIZE = HEADER.size + HELLO_V1.size
+SHM_V1 = struct.Struct("<32s")        # shared memory segment name
+SHM_SIZE = HEADER.size + SHM_V1.size
+MAX_MSG_SIZE = 256
+MAX_BUFFER = 64 * 1024
+
+
+class State:
+    __slots__ = ("seq", "mode", "note", "level", "gliss", "kick", "snare",
+                 "phase", "tempo", "downbeat", "apply_at")
+
+    def __init__(self, seq=0, mode=MODE_MUSIC, note=-1, level=0.0, gliss=0.0,
+                 kick=0.0, snare=0.0, phase=0.0, tempo=0.0, downbeat=0.0,
+                 apply_at=0.0):
+        self.seq = seq
+        self.mode = mode
+        self.note = note
+        self.level = level
+        self.gliss = gliss
+        self.kick = kick
+        self.snare = snare
+        self.phase = phase
+        self.tempo = tempo
+        self.downbeat = downbeat
+        self.apply_at = apply_at
+
+    def copy(self):
+        return State(*(getattr(self, k) for k in State.__slots__))
+
+
+class StateEncoder:
+    def __init__(self):
+        self.seq = 0
+        self.buf = bytearray(STATE_SIZE)
+
+    def encode(self, mode, note, level, gliss, kick, snare, phase=0.0,
+               tempo=0.0, downbeat=0.0, apply_at=0.0):
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        HEADER.pack_into(self.buf, 0, PROTO_MAGIC, PROTO_VERSION, MSG_STATE,
+                         STATE_SIZE, self.seq)
+        STATE_V1.pack_into(self.buf, HEADER.size, mode, note, level, gliss,
+                           kick, snare)
+        STATE_V2.pack_into(self.buf, STATE_V1_SIZE, phase, tempo, downbeat)
+        STATE_V3.pack_into(self.buf, STATE_V2_SIZE, apply_at)
+        return self.buf
+
+
+def encode_hello(priority=PRIORITY_DEFAULT, name=""):
+    buf = bytearray(HELLO_SIZE)
+    HEADER.pack_into(buf, 0, PROTO_MAGIC, PROTO_VERSION, MSG_HELLO,
+                     HELLO_SIZE, 0)
+    HELLO_V1.pack_into(buf, HEADER.size, max(0, min(PRIORITY_MAX, priority)),
+                       name.encode()[:15])
+    return bytes(buf)
+
+
+def encode_shm(name):
+    buf = bytearray(SHM_SIZE)
+    HEADER.pack_into(buf, 0, PROTO_MAGIC, PROTO_VERSION, MSG_SHM, SHM_SIZE, 0)
+    SHM_V1.pack_into(buf, HEADER.size, name.encode()[:32])
+    return bytes(buf)
+
+
+def encode_ack():
+    return HEADER.pack(PROTO_MAGIC, PROTO_VERSION, MSG_ACK, HEADER.size, 0)
+
+
+def decode_state(buf, offset=0, state=None):
+    magic, version, kind, length, seq = HEADER.unpack_from(buf, offset)
+    if magic != PROTO_MAGIC or kind != MSG_STATE or length < STATE_V1_SIZE:
+        return None
+    if state is None:
+        state = State()
+    state.seq = seq
+    (state.mode, state.note, state.level, state.gliss, state.kick,
+     state.snare) = STATE_V1.unpack_from(buf, offset + HEADER.size)
+    if length >= STATE_V2_SIZE:
+        state.phase, state.tempo, state.downbeat = STATE_V2.unpack_from(
+            buf, offset + STATE_V1_SIZE)
+    else:
+        state.phase = state.tempo = state.downbeat = 0.0
+    if length >= STATE_SIZE:
+        state.apply_at = STATE_V3.unpack_from(buf, offset + STATE_V2_SIZE)[0]
+    else:
+        state.apply_at = 0.0
+    return state
+
+
+class StateDecoder:
+    # Accumulates stream bytes and decodes only the newest complete state.
+    def __init__(self):
+        self.buf = bytearray()
+        self.state = State()
+        self.priority = PRIORITY_DEFAULT
+        self.name = ""
+        self.shm_name = None
+        self.received = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        pos = 0
+        newest = -1
+        end = len(buf)
+        while end - pos >= HEADER.size:
+            if buf[pos:pos + 2] != PROTO_MAGIC:
+                nxt = buf.find(PROTO_MAGIC, pos + 1)
+                self.errors += 1
+                if nxt < 0:
+                    pos = end - 1
+                    break
+                pos = nxt
+                continue
+            length = HEADER.unpack_from(buf, pos)[3]
+            if length < HEADER.size or length > MAX_MSG_SIZE:
+                self.errors += 1
+                pos += 1
+                continue
+            if end - pos < length:
+                break
+            if buf[pos + 3] == MSG_STATE and length >= STATE_V1_SIZE:
+                if newest >= 0:
+                    self.dropped += 1
+                newest = pos
+                self.received += 1
+            elif buf[pos + 3] == MSG_HELLO and length >= HELLO_SIZE:
+                prio, name = HELLO_V1.unpack_from(buf, pos + HEADER.size)
+                self.priority = prio
+                self.name = name.rstrip(b"\0").decode(errors="replace")
+            elif buf[pos + 3] == MSG_SHM and length >= SHM_SIZE:
+                name = SHM_V1.unpack_from(buf, pos + HEADER.size)[0]
+                self.shm_name = name.rstrip(b"\0").decode(errors="replace")
+            pos += length
+        result = None
+        if newest >= 0:
+            result = decode_state(buf, newest, self.state)
+        if pos:
+            del buf[:pos]
+        if len(buf) > MAX_BUFFER:
+            buf.clear()
+        return result
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import time
+
+
+class FrameClock:
+    # Deadline based frame scheduler.  Deadlines advance by a fixed period so
+    # sleep error does not accumulate; frames that are missed entirely are
+    # skipped (and counted) instead of being rendered back-to-back.
+    def __init__(self, fps):
+        self.period = 1.0 / fps
+        self.deadline = time.monotonic()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames = 0
+        self.overruns = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.stats_start = time.monotonic()
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def tick(self):
+        now = time.monotonic()
+        late = now - self.deadline
+        if late < 0:
+            late = 0.0
+        self.frames += 1
+        self.jitter_sum += late
+        if late > self.jitter_max:
+            self.jitter_max = late
+        self.deadline += self.period
+        if late >= self.period:
+            missed = int(late / self.period)
+            self.overruns += missed
+            self.deadline += missed * self.period
+        return now
+
+    def report(self):
+        elapsed = time.monotonic() - self.stats_start
+        frames = self.frames or 1
+        return {
+            "fps": self.frames / elapsed if elapsed > 0 else 0.0,
+            "jitter_mean_ms": self.jitter_sum / frames * 1000.0,
+            "jitter_max_ms": self.jitter_max * 1000.0,
+            "overruns": self.overruns,
+        }
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Shared-memory state slot.  The audio engine publishes each encoded state
+# message into a seqlock-protected slot and bumps an eventfd; the LED engine
+# is woken by the eventfd and copies the newest message out.  Older states
+# are simply overwritten, so a slow reader never builds up a backlog.
+#
+# Pure Python has no memory barriers: on ARM the payload stores may become
+# visible out of order with the sequence number, so matching sequence
+# numbers do not prove a clean copy.  Every copy is also checked for a
+# plausible state (version, length, known mode, finite values) and retried
+# like a torn read otherwise.  A mix of two valid states can still get
+# through; at worst that is one frame of slightly wrong lights.
+import os, math, struct
+from multiprocessing import shared_memory, resource_tracker
+
+from protocol import (PROTO_VERSION, STATE_SIZE, MODE_NAMES, HEADER,
+                      decode_state, State)
+
+HAVE_EVENTFD = hasattr(os, "eventfd")
+
+SEQLOCK = struct.Struct("<I")
+MSG_OFFSET = 8
+SLOT_SIZE = 64
+SEQLOCK_TRIES = 16
+
+_created = set()    # segments owned by writers in this process
+
+
+class ShmStateWriter:
+    def __init__(self, name=None):
+        self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                              size=SLOT_SIZE)
+        self.name = self.shm.name
+        _created.add(self.name)
+        self.buf = self.shm.buf
+        self.efd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        self.lock = 0
+        self.published = 0
+
+    def publish(self, msg):
+        # odd sequence while the message is being written
+        self.lock += 1
+        SEQLOCK.pack_into(self.buf, 0, self.lock)
+        self.buf[MSG_OFFSET:MSG_OFFSET + len(msg)] = msg
+        self.lock += 1
+        SEQLOCK.pack_into(self.buf, 0, self.lock)
+        self.published += 1
+        try:
+            os.eventfd_write(self.efd, 1)
+        except BlockingIOError:
+            pass                        # counter saturated: reader is awake anyway
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+        _created.discard(self.name)
+        os.close(self.efd)
+
+
+class ShmStateReader:
+    def __init__(self, name, efd):
+        self.shm = shared_memory.SharedMemory(name=name)
+        if name not in _created:
+            try:
+                # the writer's process owns (and unlinks) the segment
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+            except Exception:
+                pass
+        self.buf = self.shm.buf
+        self.efd = efd
+        self.copy = bytearray(STATE_SIZE)
+        self.state = State()
+        self.last_seq = None
+        self.torn = 0
+
+    def fileno(self):
+        return self.efd
+
+    def read(self):
+        # Newest state if it changed since the last call, else None.
+        try:
+            os.eventfd_read(self.efd)
+        except BlockingIOError:
+            pass
+        buf = self.buf
+        for _ in range(SEQLOCK_TRIES):
+            s1 = SEQLOCK.unpack_from(buf, 0)[0]
+            if s1 == 0:
+                return None             # nothing published yet
+            if s1 & 1:
+                self.torn += 1
+                continue
+            self.copy[:] = buf[MSG_OFFSET:MSG_OFFSET + STATE_SIZE]
+            if SEQLOCK.unpack_from(buf, 0)[0] == s1:
+                st = decode_state(self.copy, 0, self.state)
+                if st is not None and self.plausible(st):
+                    break
+            self.torn += 1
+        else:
+            return None
+        if st.seq == self.last_seq:
+            return None
+        self.last_seq = st.seq
+        return st
+
+    def plausible(self, st):
+        # the copy holds a whole state from this protocol version
+        _, version, _, length, _ = HEADER.unpack_from(self.copy, 0)
+        return (version == PROTO_VERSION and length == STATE_SIZE
+                and st.mode in MODE_NAMES and -1 <= st.note < 12
+                and all(map(math.isfinite, (st.level, st.gliss, st.kick,
+                                            st.snare, st.phase, st.tempo,
+                                            st.downbeat, st.apply_at))))
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        os.close(self.efd)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Stand-ins for the Pi hardware so both engines run on any Linux box.
+import ctypes
+
+import numpy as np
+
+
+class FakeChannel:
+    # Opaque like the SWIG ws2811_channel_t pointer: the LED array is only
+    # reachable through the module's accessors.
+    def __init__(self, count):
+        self._buf = (ctypes.c_uint32 * count)()
+
+
+class FakeWS281x:
+    # The parts of the _rpi_ws281x module used by framebuffer.py.
+    @staticmethod
+    def ws2811_channel_t_leds_get(chan):
+        return ctypes.addressof(chan._buf)
+
+    @staticmethod
+    def ws2811_led_set(chan, n, color):
+        chan._buf[n] = color
+
+
+class FakePixelStrip:
+    # Enough of rpi_ws281x.PixelStrip for WS281xOutput and the old API.
+    def __init__(self, count, *args, **kwargs):
+        self.count = count
+        self._channel = FakeChannel(count)
+        self.pixels = np.ctypeslib.as_array(self._channel._buf)
+        self.shows = 0
+        self.on_show = None
+
+    def begin(self):
+        pass
+
+    def numPixels(self):
+        return self.count
+
+    def setPixelColor(self, n, color):
+        self.pixels[n] = color
+
+    def getPixelColor(self, n):
+        return int(self.pixels[n])
+
+    def show(self):
+        self.shows += 1
+        if self.on_show is not None:
+            self.on_show(self)
+
+
+class FakeGPIO:
+    # Mirrors the parts of RPi.GPIO used by buttons.py.  Pins idle high
+    # (pull-ups); press() pulls one low until release().
+    BCM = 11
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    LOW = 0
+    HIGH = 1
+    FALLING = 32
+    RISING = 31
+    BOTH = 33
+
+    def __init__(self):
+        self.levels = {}
+        self.callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        self.levels.setdefault(pin, self.HIGH)
+
+    def input(self, pin):
+        return self.levels.get(pin, self.HIGH)
+
+    def cleanup(self):
+        self.callbacks.clear()
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def _set(self, pin, level):
+        if self.levels.get(pin, self.HIGH) == level:
+            return
+        self.levels[pin] = level
+        cb = self.callbacks.get(pin)
+        if cb is not None:
+            cb(pin)
+
+    def press(self, pin):
+        self._set(pin, self.LOW)
+
+    def release(self, pin):
+        self._set(pin, self.HIGH)
+
+
+def install_fake_ws281x():
+    # FakePixelStrip channels only work with the fake accessors.
+    import framebuffer
+    framebuffer.ws = FakeWS281x
+    return FakeWS281x
+
+
+def install_fake_gpio(gpio=None):
+    import buttons
+    gpio = gpio or FakeGPIO()
+    buttons.GPIO = gpio
+    buttons.HAVE_GPIO = True
+    return gpio
+
+
+class SyntheticPCM:
+    # Mono int16 test signal: a lead tone, a kick on every beat, a snare on
+    # the backbeat and broadband noise.
+    def __init__(self, sample_rate=44100, lead_hz=440.0, bpm=120.0,
+                 noise=0.02, seed=0):
+        self.sr = sample_rate
+        self.lead_hz = lead_hz
+        self.bpm = bpm
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.pos = 0
+
+    def hop(self, n):
+        t = (self.pos + np.arange(n)) / self.sr
+        self.pos += n
+        beat = 60.0 / self.bpm
+        since = np.mod(t, beat)
+        beat_no = np.floor(t / beat).astype(np.int64)
+        sig = 0.25 * np.sin(2 * np.pi * self.lead_hz * t)
+        # kick: 60 Hz burst with a fast decay
+        sig += 0.6 * np.sin(2 * np.pi * 60.0 * since) * np.exp(-since * 30.0)
+        # snare: noise burst on beats 2 and 4
+        snare = (beat_no % 2 == 1) * np.exp(-since * 40.0)
+        sig += 0.4 * snare * self.rng.standard_normal(n)
+        sig += self.noise * self.rng.standard_normal(n)
+        return (np.clip(sig, -1.0, 1.0) * 32767).astype(np.int16)
+
+    def stereo_bytes(self, n):
+        mono = self.hop(n)
+        return np.repeat(mono, 2).tobytes()
+
+    def beat_times(self, duration):
+        return np.arange(0.0, duration, 60.0 / self.bpm)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import os, struct
+
+import numpy as np
+
+from protocol import State
+
+# State traces: every state the LED engine applies, as fixed-size records
+# behind a small header, so a trace can be memory-mapped and indexed without
+# parsing.  Times are seconds since the trace was opened (CLOCK_MONOTONIC).
+#   header: magic, version, record size, LED count, LED fps, wall clock start
+#   record: time, seq, producer priority, mode, note, level, gliss, kick,
+#           snare, phase, tempo, downbeat
+TRACE_MAGIC = b"MLTR"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<4sHHIfd")
+TRACE_RECORD = struct.Struct("<dIBbbxfffffff")
+TRACE_DTYPE = np.dtype([
+    ("t", "<f8"), ("seq", "<u4"), ("priority", "u1"), ("mode", "i1"),
+    ("note", "i1"), ("pad", "u1"), ("level", "<f4"), ("gliss", "<f4"),
+    ("kick", "<f4"), ("snare", "<f4"), ("phase", "<f4"), ("tempo", "<f4"),
+    ("downbeat", "<f4")])
+TRACE_BATCH = 256           # records buffered before a write
+
+# Frame dumps: the rendered framebuffer of every frame, three bytes per LED
+# (the 0x00RRGGBB words without their pad byte, i.e. B, G, R), for byte-exact
+# comparison between builds and for previews.
+FRAMES_MAGIC = b"MLFD"
+FRAMES_VERSION = 1
+FRAMES_HEADER = struct.Struct("<4sHHIf")
+
+
+class TraceWriter:
+    def __init__(self, path, count, fps, start, wall):
+        self.start = start
+        self.f = open(path, "wb")
+        self.f.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION,
+                                       TRACE_RECORD.size, count, fps, wall))
+        self.buf = bytearray(TRACE_RECORD.size * TRACE_BATCH)
+        self.n = 0
+        self.records = 0
+
+    def record(self, now, priority, st):
+        TRACE_RECORD.pack_into(
+            self.buf, self.n * TRACE_RECORD.size, now - self.start,
+            st.seq & 0xFFFFFFFF, priority, st.mode, st.note, st.level,
+            st.gliss, st.kick, st.snare, st.phase, st.tempo, st.downbeat)
+        self.n += 1
+        self.records += 1
+        if self.n == TRACE_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.n:
+            self.f.write(memoryview(self.buf)[:self.n * TRACE_RECORD.size])
+            self.n = 0
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class TraceReader:
+    # Read-only memory map of a trace; a truncated last record is ignored.
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            head = f.read(TRACE_HEADER.size)
+        if len(head) < TRACE_HEADER.size:
+            raise ValueError("%s: not a state trace" % path)
+        magic, version, size, self.count, self.fps, self.wall = \
+            TRACE_HEADER.unpack(head)
+        if magic != TRACE_MAGIC or size != TRACE_DTYPE.itemsize:
+            raise ValueError("%s: not a state trace (version %d)"
+                             % (path, version))
+        n = (os.path.getsize(path) - TRACE_HEADER.size) // size
+        if n:
+            self.records = np.memmap(path, dtype=TRACE_DTYPE, mode="r",
+                                     offset=TRACE_HEADER.size, shape=(n,))
+        else:
+            self.records = np.zeros(0, dtype=TRACE_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def duration(self):
+        t = self.records["t"]
+        return float(t[-1] - t[0]) if len(t) else 0.0
+
+    def state(self, i, st=None):
+        r = self.records[i]
+        if st is None:
+            st = State()
+        st.seq = int(r["seq"])
+        st.mode = int(r["mode"])
+        st.note = int(r["note"])
+        st.level = float(r["level"])
+        st.gliss = float(r["gliss"])
+        st.kick = float(r["kick"])
+        st.snare = float(r["snare"])
+        st.phase = float(r["phase"])
+        st.tempo = float(r["tempo"])
+        st.downbeat = float(r["downbeat"])
+        return st
+
+
+class FrameDumpWriter:
+    def __init__(self, path, count, fps):
+        self.count = count
+        self.f = open(path, "wb")
+        self.f.write(FRAMES_HEADER.pack(FRAMES_MAGIC, FRAMES_VERSION, 3,
+                                        count, fps))
+        self.frames = 0
+
+    def write(self, fb):
+        self.f.write(fb.pixels.view(np.uint8).reshape(self.count, 4)[:, :3]
+                     .tobytes())
+        self.frames += 1
+
+    def close(self):
+        self.f.close()
+
+
+def open_frame_dump(path):
+    # -> (frames x count x 3 uint8 memmap, fps)
+    with open(path, "rb") as f:
+        head = f.read(FRAMES_HEADER.size)
+    if len(head) < FRAMES_HEADER.size:
+        raise ValueError("%s: not a frame dump" % path)
+    magic, version, depth, count, fps = FRAMES_HEADER.unpack(head)
+    if magic != FRAMES_MAGIC or depth != 3:
+        raise ValueError("%s: not a frame dump (version %d)" % (path, version))
+    n = (os.path.getsize(path) - FRAMES_HEADER.size) // (count * 3)
+    if not n:
+        return np.zeros((0, count, 3), dtype=np.uint8), fps
+    return np.memmap(path, dtype=np.uint8, mode="r", offset=FRAMES_HEADER.size,
+                     shape=(n, count, 3)), fps
@@ -1,45 +1,128 @@
 #!/usr/bin/env python3
-# Supervisor v4
-import subprocess, time, os, sys
+# Supervisor v5
+# Each engine gets the write end of a pipe (ML_NOTIFY_FD) and reports READY
+# once it is serving, then a heartbeat about once a second from its main
+# loop.  An engine that exits, never becomes ready or stops beating is
+# restarted on its own, with exponential backoff.  The LED engine is asked to
+# hand off (SIGUSR1) so the next instance picks up its last frame; the audio
+# engine just reconnects to the new LED engine.
+import subprocess, time, os, sys, select, signal
 
 LED_CMD  = ["/home/sijeo/christmas_lights/bin/python3", "src/led_engine.py"]
 AUDIO_CMD= ["/home/sijeo/christmas_lights/bin/python3", "src/audio_engine.py"]
-SOCK="/tmp/musical_lights.sock"
 LOG_DIR="logs"
+NOTIFY_ENV="ML_NOTIFY_FD"
+READY_TIMEOUT=10.0
+STALL_TIMEOUT=5.0       # no heartbeat for this long: frame loop is stuck
+STOP_GRACE=2.0
+BACKOFF_MIN=0.5
+BACKOFF_MAX=30.0
+STABLE_TIME=60.0        # up this long: backoff starts over
 os.makedirs(LOG_DIR,exist_ok=True)
 
-def start(cmd,name):
-    lf=open(os.path.join(LOG_DIR,f"{name}.log"),"a")
-    p=subprocess.Popen(cmd,stdout=lf,stderr=lf)
-    return p,lf
+def log(*args):
+    print(time.strftime("%H:%M:%S"), *args, flush=True)
 
-def wait_sock(timeout=10):
-    for _ in range(timeout*10):
-        if os.path.exists(SOCK): return True
-        time.sleep(0.1)
-    return False
+class Engine:
+    def __init__(self,name,cmd,restart_sig=signal.SIGTERM):
+        self.name=name
+        self.cmd=cmd
+        self.restart_sig=restart_sig
+        self.proc=None
+        self.fd=None
+        self.ready=False
+        self.started=0.0
+        self.last_beat=0.0
+        self.backoff=BACKOFF_MIN
+        self.next_start=0.0
+        self.restarts=0
+
+    def start(self):
+        r,w=os.pipe()
+        os.set_blocking(r,False)
+        env=dict(os.environ)
+        env[NOTIFY_ENV]=str(w)
+        with open(os.path.join(LOG_DIR,f"{self.name}.log"),"a") as lf:
+            self.proc=subprocess.Popen(self.cmd,stdout=lf,stderr=lf,env=env,
+                                       pass_fds=(w,))
+        os.close(w)
+        self.fd=r
+        self.ready=False
+        self.started=self.last_beat=time.monotonic()
+        log(self.name,"started, pid",self.proc.pid)
+
+    def read(self):
+        try:
+            data=os.read(self.fd,4096)
+        except BlockingIOError:
+            return
+        if not data:
+            return              # pipe closed: exit is picked up by health()
+        self.last_beat=time.monotonic()
+        if not self.ready and b"READY" in data:
+            self.ready=True
+            log(self.name,"ready after %.2f s"%(self.last_beat-self.started))
+
+    def health(self,now):
+        rc=self.proc.poll()
+        if rc is not None:
+            return "exited with %d"%rc
+        if not self.ready and now-self.started>READY_TIMEOUT:
+            return "not ready after %.0f s"%READY_TIMEOUT
+        if self.ready and now-self.last_beat>STALL_TIMEOUT:
+            return "stalled, no heartbeat for %.1f s"%(now-self.last_beat)
+        return None
+
+    def stop(self,sig=signal.SIGTERM):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.send_signal(sig)
+            try:
+                self.proc.wait(STOP_GRACE)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        os.close(self.fd)
+        self.proc=None
+        self.fd=None
+
+    def restart_later(self,now,reason):
+        log(self.name,reason)
+        if now-self.started>=STABLE_TIME:
+            self.backoff=BACKOFF_MIN
+        self.stop(self.restart_sig)
+        self.next_start=now+self.backoff
+        log(self.name,"restarting in %.1f s"%self.backoff)
+        self.backoff=min(self.backoff*2,BACKOFF_MAX)
+        self.restarts+=1
 
 def main():
-    led,lf1=start(LED_CMD,"led_engine")
-    if not wait_sock():
-        led.terminate(); sys.exit(1)
-    audio,lf2=start(AUDIO_CMD,"audio_engine")
+    led=Engine("led_engine",LED_CMD,signal.SIGUSR1)
+    audio=Engine("audio_engine",AUDIO_CMD)
+    engines=(led,audio)
+    signal.signal(signal.SIGTERM,lambda *_: sys.exit(0))
+    led.start()
     try:
         while True:
-            if led.poll() is not None:
-                led,lf1=start(LED_CMD,"led_engine"); wait_sock()
-                audio.terminate()
-                audio,lf2=start(AUDIO_CMD,"audio_engine")
-            if audio.poll() is not None:
-                audio,lf2=start(AUDIO_CMD,"audio_engine")
-            time.sleep(0.5)
+            fds={e.fd:e for e in engines if e.fd is not None}
+            ready,_,_=select.select(list(fds),[],[],0.5)
+            for fd in ready:
+                fds[fd].read()
+            now=time.monotonic()
+            for e in engines:
+                if e.proc is not None:
+                    reason=e.health(now)
+                    if reason:
+                        e.restart_later(now,reason)
+                elif now>=e.next_start and (e is led or led.ready or led.restarts):
+                    # first start waits for the LED engine; later ones don't
+                    e.start()
     except KeyboardInterrupt:
         pass
     finally:
-        try: led.terminate()
-        except: pass
-        try: audio.terminate()
-        except: pass
+        audio.stop()
+        led.stop()
 
 if __name__=="__main__":
     main()
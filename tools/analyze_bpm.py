@@ -1,42 +1,249 @@
 #!/usr/bin/env python3
-import os, json, sys
+import os, sys, time, argparse, subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 try:
     import librosa, numpy as np  # noqa
 except ImportError:
     print("Install librosa, numpy, soundfile first.")
     sys.exit(1)
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+from feature_cache import (FEATURE_DTYPE, FEATURE_SR, FEATURE_FPS, FEATURE_HOP,
+                           FEATURE_WINDOW, content_hash, feature_path,
+                           fps_current, save_features)
+from pitch import PitchEstimator
+from library import Library, LIBRARY_DB, SONGS_DIR, BPM_TABLE
 
-def analyze_song(path):
-    y, sr = librosa.load(path, sr=None, mono=True)
-    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-    return float(tempo)
+BANDS = {"bass": (40, 150), "mid": (200, 2000), "high": (4000, 8000)}
+LEAD_BAND = (200, 2000)
+PITCH_MIN_AMP = 0.2
+PITCH_MIN_CONFIDENCE = 0.1     # same gate as the live engine
+ENV_DECAY = 0.85
+BLOCK_SECONDS = 10.0
+
+
+def band_slice(freqs, lo, hi):
+    return slice(int(np.searchsorted(freqs, lo, "left")),
+                 int(np.searchsorted(freqs, hi, "right")))
+
+
+def onset_envelope(onset, delta):
+    # Peak-picked onsets turned into the same 0..1 decaying envelope the
+    # live engine sends.
+    env = np.zeros(len(onset), dtype=np.float32)
+    if len(onset) == 0 or onset.max() <= 0:
+        return env
+    onset = onset / onset.max()
+    peaks = librosa.util.peak_pick(onset, pre_max=3, post_max=3, pre_avg=10,
+                                   post_avg=10, delta=delta, wait=4)
+    hits = np.zeros(len(onset), dtype=bool)
+    hits[peaks] = True
+    e = 0.0
+    for i in range(len(onset)):
+        e = 1.0 if hits[i] else e * ENV_DECAY
+        env[i] = e
+    return env
+
+
+def smooth_notes(lead, conf):
+    n = len(lead)
+    notes = np.full(n, -1, dtype=np.int8)
+    gliss = np.zeros(n, dtype=np.float32)
+    smooth = None
+    for i in range(n):
+        if lead[i] > 0 and conf[i] >= PITCH_MIN_CONFIDENCE:
+            midi = 69.0 + 12.0 * np.log2(lead[i] / 440.0)
+            gliss[i] = midi - round(midi)
+            smooth = midi if smooth is None else 0.75 * smooth + 0.25 * midi
+        elif smooth is not None and lead[i] <= 0:
+            smooth *= 0.9       # low confidence holds the note, silence fades it
+        if smooth is not None:
+            notes[i] = int(round(smooth)) % 12
+    return notes, gliss
+
+
+class FeatureExtractor:
+    # Frame-by-frame STFT over a stream of PCM blocks.  Only the tail of the
+    # previous block and small per-frame summaries are kept, so memory does
+    # not grow with the length of the audio.
+    def __init__(self, sr=FEATURE_SR):
+        self.win = np.hanning(FEATURE_WINDOW).astype(np.float32)
+        self.freqs = np.fft.rfftfreq(FEATURE_WINDOW, 1.0 / sr)
+        self.bands = {k: band_slice(self.freqs, lo, hi)
+                      for k, (lo, hi) in BANDS.items()}
+        self.pitch = PitchEstimator(self.freqs, LEAD_BAND,
+                                    min_amp=PITCH_MIN_AMP)
+        # frames are centred on multiples of the hop, like librosa center=True
+        self.carry = np.zeros(FEATURE_WINDOW // 2, dtype=np.float32)
+        self.prev_db = None
+        self.parts = []
+
+    def feed(self, pcm):
+        buf = np.concatenate([self.carry, pcm])
+        if len(buf) < FEATURE_WINDOW:
+            self.carry = buf
+            return
+        n = (len(buf) - FEATURE_WINDOW) // FEATURE_HOP + 1
+        frames = np.lib.stride_tricks.sliding_window_view(
+            buf, FEATURE_WINDOW)[::FEATURE_HOP][:n]
+        frames = (frames - frames.mean(axis=1, keepdims=True)) * self.win
+        mag = np.abs(np.fft.rfft(frames, axis=1)).astype(np.float32)
+        self.carry = buf[n * FEATURE_HOP:]
+
+        part = {k: mag[:, sl].mean(axis=1) for k, sl in self.bands.items()}
+        part["level"] = np.minimum(1.0, mag.mean(axis=1) * 4.0)
+        est = self.pitch.estimate
+        pitch = np.array([est(row) for row in mag], dtype=np.float32)
+        part["lead"] = pitch[:, 0]
+        part["conf"] = pitch[:, 1]
+
+        db = 20.0 * np.log10(np.maximum(mag, 1e-5))
+        prev = db[:1] if self.prev_db is None else self.prev_db
+        flux = np.maximum(0.0, np.diff(np.concatenate([prev, db]), axis=0))
+        self.prev_db = db[-1:]
+        part["onset"] = flux.mean(axis=1)
+        part["kick_flux"] = flux[:, self.bands["bass"]].mean(axis=1)
+        part["snare_flux"] = flux[:, self.bands["mid"]].mean(axis=1)
+        self.parts.append(part)
+
+    def finish(self, sr=FEATURE_SR):
+        self.feed(np.zeros(FEATURE_WINDOW // 2, dtype=np.float32))
+        cols = {k: np.concatenate([p[k] for p in self.parts])
+                if self.parts else np.zeros(0, dtype=np.float32)
+                for k in ("bass", "mid", "high", "level", "conf", "lead",
+                          "onset", "kick_flux", "snare_flux")}
+        n = len(cols["level"])
+        out = np.zeros(n, dtype=FEATURE_DTYPE)
+        for k in ("bass", "mid", "high", "level"):
+            out[k] = cols[k]
+        out["note"], out["gliss"] = smooth_notes(cols["lead"], cols["conf"])
+        out["kick"] = onset_envelope(cols["kick_flux"], 0.25)
+        out["snare"] = onset_envelope(cols["snare_flux"], 0.3)
+        tempo = 0.0
+        if n:
+            tempo, beats = librosa.beat.beat_track(
+                onset_envelope=cols["onset"], sr=sr, hop_length=FEATURE_HOP)
+            out["beat"][beats[beats < n]] = 1
+        return float(np.atleast_1d(tempo)[0]), out
+
+
+def decode_blocks(path, block_seconds=BLOCK_SECONDS, sr=FEATURE_SR):
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", path,
+           "-ac", "1", "-ar", str(sr), "-f", "s16le", "-"]
+    block = int(block_seconds * sr) * 2
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        while True:
+            raw = proc.stdout.read(block)
+            if not raw:
+                break
+            yield np.frombuffer(raw[:len(raw) & ~1], dtype=np.int16) \
+                .astype(np.float32) / 32768.0
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode:
+        raise RuntimeError("ffmpeg failed on %s" % path)
+
+
+def analyze_song(path, block_seconds=BLOCK_SECONDS):
+    # -> bpm, feature track, loudness (RMS dBFS or None), duration (s)
+    fx = FeatureExtractor()
+    sq = 0.0
+    n = 0
+    for pcm in decode_blocks(path, block_seconds):
+        fx.feed(pcm)
+        sq += float(np.dot(pcm, pcm))
+        n += len(pcm)
+    bpm, track = fx.finish()
+    loudness = 10.0 * np.log10(sq / n) if n and sq > 0.0 else None
+    return bpm, track, loudness, n / FEATURE_SR
+
+
+def stat_key(path):
+    st = os.stat(path)
+    return st.st_size, int(st.st_mtime)
+
+
+def is_current(row, path):
+    # row: a library track; hashed_size/mtime are the file when analyzed
+    if (row["bpm"] is None or not row["hash"]
+            or not fps_current(row["feature_fps"])):
+        return False
+    if (row["hashed_size"], row["hashed_mtime"]) != stat_key(path):
+        return False
+    return os.path.exists(feature_path(row["hash"]))
+
+
+def process_song(path, old_hash=None, block_seconds=BLOCK_SECONDS):
+    # Runs in a worker process.  Returns the song's new table entry.
+    size, mtime = stat_key(path)
+    digest = content_hash(path)
+    entry = {"hash": digest, "size": size, "mtime": mtime,
+             "feature_fps": FEATURE_FPS}
+    if digest == old_hash and os.path.exists(feature_path(digest)):
+        return entry, False  # touched but unchanged: keep cached features
+    bpm, track, loudness, duration = analyze_song(path, block_seconds)
+    save_features(digest, track)
+    entry.update(bpm=bpm, frames=len(track), loudness=loudness,
+                 duration=duration)
+    return entry, True
 
 
 def main():
-    base = os.path.dirname(os.path.abspath(__file__))
-    songs_dir = os.path.join(base, "..", "songs")
-    out = os.path.join(base, "..", "bpm_table.json")
-    data = {}
-    if os.path.exists(out):
-        try:
-            with open(out, "r") as f:
-                data = json.load(f)
-        except Exception:
-            data = {}
-    for name in sorted(os.listdir(songs_dir)):
-        if not name.lower().endswith(".mp3"):
-            continue
-        if name in data:
+    ap = argparse.ArgumentParser(description="Precompute BPM and feature tracks")
+    ap.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--force", action="store_true", help="re-analyze everything")
+    ap.add_argument("--block-seconds", type=float, default=BLOCK_SECONDS)
+    ap.add_argument("--songs", default=SONGS_DIR)
+    ap.add_argument("--db", default=LIBRARY_DB, help="library index")
+    args = ap.parse_args()
+
+    lib = Library(args.db, args.songs)
+    lib.scan()
+    if not lib.get("imported_table"):
+        lib.import_table(BPM_TABLE)
+        lib.put("imported_table", 1)
+    todo = []
+    for row in lib.tracks():
+        path = os.path.join(args.songs, row["path"])
+        if not args.force and is_current(row, path):
             continue
-        path = os.path.join(songs_dir, name)
-        print("Analyzing", name)
-        bpm = analyze_song(path)
-        data[name] = {"bpm": bpm}
-        print(" -> %.1f BPM" % bpm)
-    with open(out, "w") as f:
-        json.dump(data, f, indent=2)
-    print("Saved to", out)
+        todo.append(row)
+    if not todo:
+        print("Nothing to do")
+        return
+
+    t0 = time.monotonic()
+    done = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futs = {}
+        for row in todo:
+            # features at another frame rate are redone even if unchanged
+            old = (None if args.force or not fps_current(row["feature_fps"])
+                   else row["hash"])
+            futs[pool.submit(process_song, os.path.join(args.songs, row["path"]),
+                             old, args.block_seconds)] = row
+        for fut in as_completed(futs):
+            row = futs[fut]
+            name = row["path"]
+            done += 1
+            try:
+                entry, analyzed = fut.result()
+            except Exception as e:
+                print("[%d/%d] %s failed: %s" % (done, len(todo), name, e))
+                continue
+            # Stored after every song so a killed run keeps its progress.
+            lib.set_analysis(row["id"], entry)
+            rate = done / max(1e-6, time.monotonic() - t0) * 60.0
+            if analyzed:
+                info = "%.1f BPM, %d frames" % (entry["bpm"], entry["frames"])
+            else:
+                info = "unchanged"
+            print("[%d/%d] %s -> %s (%.1f songs/min)"
+                  % (done, len(todo), name, info, rate), flush=True)
+    print("Saved to", args.db)
 
 
 if __name__ == "__main__":
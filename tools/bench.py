@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# Headless benchmarks for both engines.  Prints one JSON document so results
+# can be stored and compared between commits.
+import os, sys, json, time, shutil, argparse, tempfile, threading, tracemalloc, platform
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+# keep the audio engine off the user's library and saved queue
+TMP = tempfile.mkdtemp(prefix="ml-bench-")
+os.environ.setdefault("LIBRARY_DB", os.path.join(TMP, "library.db"))
+from sim import (FakePixelStrip, SyntheticPCM, install_fake_gpio,
+                 install_fake_ws281x)
+from framebuffer import WS281xOutput
+from protocol import (MODE_MUSIC, MODE_AMBIENT, MODE_OFF, MODE_TREE,
+                      MODE_CHASE, MODE_SPARKLE, MODE_NAMES, State)
+
+install_fake_gpio()
+install_fake_ws281x()
+import audio_engine
+import led_engine
+
+led_engine.STATS_INTERVAL = float("inf")   # keep stdout pure JSON
+audio_engine.STATE_TRANSPORT = "socket"      # end-to-end picks its own
+
+MODES = [MODE_MUSIC, MODE_AMBIENT, MODE_OFF, MODE_TREE, MODE_CHASE, MODE_SPARKLE]
+
+
+def summarize(times):
+    t = np.asarray(times) * 1000.0
+    total = t.sum() / 1000.0
+    return {
+        "frames": int(t.size),
+        "fps": float(t.size / total) if total > 0 else 0.0,
+        "p50_ms": float(np.percentile(t, 50)),
+        "p99_ms": float(np.percentile(t, 99)),
+        "max_ms": float(t.max()),
+    }
+
+
+def measure_allocs(fn, frames):
+    # Net allocated blocks and mean transient peak (bytes) per call.
+    fn()
+    tracemalloc.start()
+    blocks0 = sys.getallocatedblocks()
+    peaks = 0
+    for _ in range(frames):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn()
+        peaks += tracemalloc.get_traced_memory()[1] - base
+    blocks = sys.getallocatedblocks() - blocks0
+    tracemalloc.stop()
+    return {"alloc_peak_bytes": peaks / frames, "alloc_blocks": blocks / frames}
+
+
+def make_server(count, sock_path):
+    strip = FakePixelStrip(count)
+    out = WS281xOutput(count, 0, 0, 0, False, 255, 0, 0, strip=strip)
+    return led_engine.LightServer(count, out, socket_path=sock_path), strip
+
+
+def bench_analysis(frames):
+    eng = audio_engine.AudioEngine()
+    pcm = SyntheticPCM()
+    hops = [pcm.hop(audio_engine.FRAME_SIZE) for _ in range(64)]
+    times = []
+    for i in range(frames):
+        hop = hops[i % len(hops)]
+        t0 = time.perf_counter()
+        eng.live_step(hop)
+        times.append(time.perf_counter() - t0)
+    res = summarize(times)
+    i = [0]
+
+    def step():
+        eng.live_step(hops[i[0] % len(hops)])
+        i[0] += 1
+    res.update(measure_allocs(step, min(frames, 200)))
+    res["window"] = eng.analyzer.size
+    return res
+
+
+def bench_render(counts, frames, tmp):
+    results = []
+    st = State(mode=MODE_MUSIC, note=5, level=0.6, gliss=0.1, kick=1.0,
+               snare=0.5)
+    for count in counts:
+        srv, strip = make_server(count, os.path.join(tmp, "render.sock"))
+        for mode in MODES:
+            st.mode = mode
+            render_t, push_t, total_t = [], [], []
+            for _ in range(frames):
+                t0 = time.perf_counter()
+                srv.render(st)
+                t1 = time.perf_counter()
+                srv.push()
+                t2 = time.perf_counter()
+                render_t.append(t1 - t0)
+                push_t.append(t2 - t1)
+                total_t.append(t2 - t0)
+
+            def step():
+                srv.render(st)
+                srv.push()
+            res = {"mode": MODE_NAMES[mode], "leds": count}
+            res.update(summarize(total_t))
+            res["render_p50_ms"] = float(np.percentile(render_t, 50) * 1000.0)
+            res["push_p50_ms"] = float(np.percentile(push_t, 50) * 1000.0)
+            res.update(measure_allocs(step, min(frames, 200)))
+            results.append(res)
+        srv.server.close()
+    return results
+
+
+def bench_end_to_end(count, seconds, tmp, transport="socket"):
+    # Audio hop -> analysis -> socket/shm -> LED decode/render -> strip.show().
+    # "delivery" is send() until the LED engine has applied the state.
+    sock_path = os.path.join(tmp, "e2e-%s.sock" % transport)
+    srv, strip = make_server(count, sock_path)
+    sent = {}
+    latencies = []
+    delivery = []
+    update = srv.update
+
+    def timed_update(st, now):
+        t0 = sent.get(st.seq)
+        if t0 is not None:
+            delivery.append(time.perf_counter() - t0)
+        update(st, now)
+    srv.update = timed_update
+
+    def on_show(_):
+        t = time.perf_counter()
+        t0 = sent.pop(srv.cur.seq, None)
+        if t0 is not None:
+            latencies.append(t - t0)
+    strip.on_show = on_show
+    th = threading.Thread(target=srv.run, daemon=True)
+    th.start()
+
+    eng = audio_engine.AudioEngine()
+    eng.sender.close()
+    eng.sender = audio_engine.StateSender(sock_path, shm=transport == "shm")
+    pcm = SyntheticPCM()
+    hop_s = audio_engine.FRAME_SIZE / audio_engine.SAMPLE_RATE
+    end = time.perf_counter() + seconds
+    next_hop = time.perf_counter()
+    while time.perf_counter() < end:
+        hop = pcm.hop(audio_engine.FRAME_SIZE)
+        t0 = time.perf_counter()
+        note, gliss, level = eng.live_step(hop)
+        sent[(eng.encoder.seq + 1) & 0xFFFFFFFF] = t0
+        eng.send(MODE_MUSIC, note, level, gliss, eng.kick_env, eng.snare_env)
+        next_hop += hop_s
+        time.sleep(max(0.0, next_hop - time.perf_counter()))
+    srv.running = False
+    th.join(timeout=2.0)
+    srv.server.close()
+    res = {"leds": count, "led_fps": led_engine.LED_FPS, "transport": transport,
+           "shm_attached": eng.sender.attached,
+           "states_sent": eng.sender.sent, "states_shown": len(latencies)}
+    eng.sender.close()
+    if delivery:
+        d = np.asarray(delivery) * 1000.0
+        res.update({"delivery_p50_ms": float(np.percentile(d, 50)),
+                    "delivery_p99_ms": float(np.percentile(d, 99))})
+    if latencies:
+        lat = np.asarray(latencies) * 1000.0
+        res.update({"latency_p50_ms": float(np.percentile(lat, 50)),
+                    "latency_p99_ms": float(np.percentile(lat, 99))})
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Headless engine benchmarks")
+    ap.add_argument("--counts", default="300,1000,3000")
+    ap.add_argument("--frames", type=int, default=500)
+    ap.add_argument("--e2e-seconds", type=float, default=3.0)
+    ap.add_argument("--out", help="write JSON here instead of stdout")
+    args = ap.parse_args()
+    counts = [int(c) for c in args.counts.split(",") if c]
+
+    try:
+        report = {
+            "host": platform.node(),
+            "machine": platform.machine(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "analysis": bench_analysis(args.frames),
+            "render": bench_render(counts, args.frames, TMP),
+            "end_to_end": [bench_end_to_end(counts[0], args.e2e_seconds, TMP, t)
+                           for t in ("socket", "shm")],
+        }
+    finally:
+        shutil.rmtree(TMP, ignore_errors=True)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
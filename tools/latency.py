@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# Audio -> light offset of the whole pipeline, without hardware:
+#   python3 tools/latency.py                          default delay model
+#   python3 tools/latency.py --device-delay 0.25      a slower sound card
+#   python3 tools/latency.py --output-delay 0.2       try a model setting
+# A synthetic click track (kick on every beat) goes through the audio
+# engine's analysis stage into an in-process LED engine.  A loopback
+# stand-in plays the PCM out at the sample rate behind `--device-delay` of
+# buffering the engine cannot see (and reports the pipe backlog it can), so
+# the moment each click is heard is known exactly; a light-sensor output
+# timestamps the frames where the strip flashes.  Each run is done without
+# (SYNC_AUDIO=0) and with the latency model, and the residual offset gives
+# the AUDIO_OUTPUT_DELAY to use.
+import os, sys, time, json, shutil, argparse, tempfile, threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+TMP = tempfile.mkdtemp(prefix="ml-latency-")
+os.environ.setdefault("LIBRARY_DB", os.path.join(TMP, "library.db"))
+from sim import SyntheticPCM, install_fake_gpio
+from framebuffer import NullOutput
+from decoder import PCM_FRAME_BYTES, SINK_PIPE_BYTES
+
+install_fake_gpio()
+import audio_engine
+import led_engine
+
+led_engine.STATS_INTERVAL = float("inf")
+
+LED_COUNT = 60
+FLASH_LEVEL = 128       # red channel of the first LED, rising through this
+# every mode shows the kick as a full-strip white flash
+FLASH_PRESETS = {
+    "modes": {},
+    "presets": {"flash": {"fade": 0.0, "layers": [
+        {"type": "fill", "color": [255, 255, 255],
+         "bind": {"brightness": "kick"}}]}},
+}
+
+
+class LoopbackSink:
+    # PlaybackSink stand-in.  Bytes leave the "pipe" at the sample rate from
+    # the first write on and are heard device_delay later; write() blocks
+    # while more than pipe_bytes are queued, like the real pipe.
+    def __init__(self, device_delay, pipe_bytes=SINK_PIPE_BYTES):
+        self.device_delay = device_delay
+        self.pipe_bytes = pipe_bytes
+        self.rate = audio_engine.SAMPLE_RATE * PCM_FRAME_BYTES
+        self.start = None
+        self.written = 0
+
+    def queued(self):
+        if self.start is None:
+            return 0
+        return max(0, int(self.written - (time.monotonic() - self.start)
+                          * self.rate))
+
+    def write(self, data):
+        if self.start is None:
+            self.start = time.monotonic()
+        self.written += len(data)
+        wait = self.start + (self.written - self.pipe_bytes) / self.rate \
+            - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def heard(self, sample):
+        return self.start + sample / audio_engine.SAMPLE_RATE + self.device_delay
+
+    def close(self):
+        pass
+
+
+class LightSensor(NullOutput):
+    # Output stand-in that timestamps each rising edge of the flash.
+    def __init__(self, count):
+        super().__init__(count)
+        self.flashes = []
+        self.lit = False
+
+    def show(self, fb):
+        lit = ((int(fb.pixels[0]) >> 16) & 0xFF) >= FLASH_LEVEL
+        if lit and not self.lit:
+            self.flashes.append(time.monotonic())
+        self.lit = lit
+
+
+def run(args, sync):
+    audio_engine.SYNC_AUDIO = sync
+    audio_engine.AUDIO_OUTPUT_DELAY = args.output_delay
+    sock = os.path.join(TMP, "led.sock")
+    sensor = LightSensor(LED_COUNT)
+    presets = dict(FLASH_PRESETS)
+    presets["modes"] = {name.lower(): "flash"
+                        for name in led_engine.MODE_NAMES.values()}
+    srv = led_engine.LightServer(LED_COUNT, sensor, sock, presets=presets)
+    th = threading.Thread(target=srv.run, daemon=True)
+    th.start()
+
+    eng = audio_engine.AudioEngine()
+    eng.sender.close()
+    eng.sender = audio_engine.StateSender(sock, shm=args.transport == "shm")
+    eng.sink = sink = LoopbackSink(args.device_delay)
+    eng.track = None
+    n = audio_engine.FRAME_SIZE
+    beat = args.interval
+    pcm = SyntheticPCM(bpm=60.0 / beat, noise=0.01, seed=args.seed)
+    hops = int(args.seconds * audio_engine.SAMPLE_RATE / n)
+    done = threading.Event()
+
+    def reader():
+        # DecodeReader stand-in: the sink write paces the pipeline.
+        for _ in range(hops):
+            mono = pcm.hop(n)
+            sink.write(np.repeat(mono, 2).tobytes())
+            eng.ring.write(mono)
+        done.set()
+    rt = threading.Thread(target=reader, daemon=True)
+    rt.start()
+    hop = np.zeros(n, dtype=np.int16)
+    while not (done.is_set() and not eng.ring.depth()):
+        if eng.ring.read(hop, timeout=0.05):
+            eng.process_hop(hop)
+    time.sleep(args.device_delay + 0.5)     # let the last clicks be "heard"
+    srv.running = False
+    th.join(timeout=2.0)
+    srv.server.close()
+    eng.sender.close()
+    eng.library.close()
+
+    # First flash after each click reached the sink (nothing can light up
+    # earlier), for the clicks after the warm-up.
+    flashes = np.asarray(sensor.flashes)
+    clicks = pcm.beat_times(hops * n / audio_engine.SAMPLE_RATE)
+    ahead = args.device_delay + sink.pipe_bytes / sink.rate
+    offsets = []
+    for c in clicks[clicks >= args.warmup]:
+        h = sink.heard(int(round(c * audio_engine.SAMPLE_RATE)))
+        near = flashes[(flashes >= h - ahead) & (flashes < h - ahead + beat)]
+        if near.size:
+            offsets.append(float(near[0] - h))
+    res = {"sync": sync, "clicks": int((clicks >= args.warmup).sum()),
+           "detected": len(offsets), "led_lead_ms": srv.lead * 1000.0,
+           "lookahead_ms": eng.lookahead * 1000.0}
+    if offsets:
+        o = np.asarray(offsets) * 1000.0
+        res.update({"offset_median_ms": float(np.median(o)),
+                    "offset_mean_ms": float(o.mean()),
+                    "offset_p10_ms": float(np.percentile(o, 10)),
+                    "offset_p90_ms": float(np.percentile(o, 90))})
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Audio to light offset")
+    ap.add_argument("--device-delay", type=float, default=0.15,
+                    help="hidden output buffering of the stand-in (s)")
+    ap.add_argument("--output-delay", type=float,
+                    default=audio_engine.AUDIO_OUTPUT_DELAY,
+                    help="AUDIO_OUTPUT_DELAY assumed by the model (s)")
+    ap.add_argument("--seconds", type=float, default=20.0)
+    ap.add_argument("--warmup", type=float, default=2.0,
+                    help="clicks before this are ignored (beat tracker)")
+    ap.add_argument("--interval", type=float, default=0.613,
+                    help="seconds between clicks (off the frame grid)")
+    ap.add_argument("--transport", default="socket", choices=("socket", "shm"))
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    try:
+        results = [run(args, False), run(args, True)]
+    finally:
+        shutil.rmtree(TMP, ignore_errors=True)
+    if args.json:
+        print(json.dumps({"device_delay": args.device_delay,
+                          "output_delay": args.output_delay,
+                          "runs": results}, indent=2))
+        return
+    for r in results:
+        name = "latency model" if r["sync"] else "uncompensated"
+        if "offset_median_ms" not in r:
+            print("%-14s no flashes matched (%d clicks)" % (name, r["clicks"]))
+            continue
+        print("%-14s light %+7.1f ms after sound (p10 %+.1f, p90 %+.1f), "
+              "%d/%d clicks" % (name, r["offset_median_ms"], r["offset_p10_ms"],
+                                r["offset_p90_ms"], r["detected"], r["clicks"]))
+    r = results[1]
+    if "offset_median_ms" in r:
+        print("lookahead %.1f ms, LED render + push %.2f ms"
+              % (r["lookahead_ms"], r["led_lead_ms"]))
+        print("suggested: AUDIO_OUTPUT_DELAY=%.3f"
+              % max(0.0, args.output_delay - r["offset_median_ms"] / 1000.0))
+
+
+if __name__ == "__main__":
+    main()
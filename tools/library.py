@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# Song library index from the command line:
+#   python3 tools/library.py scan               rescan songs/ (and probe)
+#   python3 tools/library.py list [--missing]   tracks with BPM / duration
+#   python3 tools/library.py playlist xmas a.mp3 b.mp3 | --m3u list.m3u
+#   python3 tools/library.py queue shuffle      all | shuffle | playlist:xmas
+#   python3 tools/library.py bench 5000         scan/startup/next timings
+# Queue changes are picked up when the audio engine next starts.
+import os, sys, time, argparse, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+from library import (Library, PlayQueue, LibraryWatcher, LIBRARY_DB,
+                     SONGS_DIR, BPM_TABLE)
+
+
+def cmd_scan(lib, args):
+    added, removed = lib.scan()
+    if not lib.get("imported_table"):
+        n = lib.import_table(BPM_TABLE)
+        lib.put("imported_table", 1)
+        print("imported %d songs from %s" % (n, BPM_TABLE))
+    print("%d added, %d gone" % (len(added), len(removed)))
+    if args.probe:
+        while True:
+            todo = lib.unprobed(16)
+            if not todo:
+                break
+            for tid in todo:
+                lib.probe_track(tid)
+
+
+def cmd_list(lib, args):
+    for t in lib.tracks(present=not args.missing):
+        if args.missing and t["present"]:
+            continue
+        bpm = "%6.1f" % t["bpm"] if t["bpm"] else "     -"
+        dur = "%5.0fs" % t["duration"] if t["duration"] else "     -"
+        loud = "%6.1f" % t["loudness"] if t["loudness"] is not None else "     -"
+        print("%5d %s %s %s dB  %s" % (t["id"], bpm, dur, loud, t["path"]))
+
+
+def cmd_playlist(lib, args):
+    names = list(args.songs)
+    if args.m3u:
+        with open(args.m3u, "r") as f:
+            names += [ln.strip() for ln in f
+                      if ln.strip() and not ln.startswith("#")]
+    tids = []
+    for name in names:
+        tid = lib.find(os.path.basename(name))
+        if tid is None:
+            print("not in library:", name)
+        else:
+            tids.append(tid)
+    lib.set_playlist(args.name, tids)
+    print("playlist %s: %d songs" % (args.name, len(tids)))
+
+
+def cmd_queue(lib, args):
+    q = PlayQueue(lib, args.kind)
+    if q.kind == args.kind and args.reshuffle:
+        q.rebuild(args.kind)
+    print("queue %s: %d songs, at %d" % (q.kind, len(q), q.pos))
+
+
+def cmd_bench(lib, args):
+    # Synthetic collection of empty files: index, startup and NEXT cost.
+    with tempfile.TemporaryDirectory() as d:
+        songs = os.path.join(d, "songs")
+        os.mkdir(songs)
+        for i in range(args.count):
+            open(os.path.join(songs, "song%05d.mp3" % i), "w").close()
+        db = os.path.join(d, "library.db")
+        lib = Library(db, songs)
+        t0 = time.perf_counter()
+        lib.scan()
+        t1 = time.perf_counter()
+        lib.scan()
+        t2 = time.perf_counter()
+        PlayQueue(lib, "shuffle")
+        lib.close()
+        t3 = time.perf_counter()
+        lib = Library(db, songs)
+        q = PlayQueue(lib)
+        t4 = time.perf_counter()
+        n = 1000
+        for i in range(n):
+            tid = q.seek(q.pos + 1)
+            lib.path_of(tid)
+            lib.entry(tid)
+        t5 = time.perf_counter()
+        w = LibraryWatcher(lib, import_table=None)
+        w.start()
+        time.sleep(0.2)
+        tid = q.id_at(q.pos)
+        old = lib.name_of(tid)
+        t6 = time.perf_counter()
+        os.rename(os.path.join(songs, old), os.path.join(songs, "renamed.mp3"))
+        while lib.name_of(tid) != "renamed.mp3" and time.perf_counter() - t6 < 5:
+            time.sleep(0.001)
+        t7 = time.perf_counter()
+        w.stop()
+        print("tracks            %d" % args.count)
+        print("first scan        %.1f ms" % ((t1 - t0) * 1000))
+        print("rescan unchanged  %.1f ms" % ((t2 - t1) * 1000))
+        print("startup           %.1f ms  (open index + saved queue)"
+              % ((t4 - t3) * 1000))
+        print("next track        %.1f us  (seek + path + entry)"
+              % ((t5 - t4) / n * 1e6))
+        print("rename -> index   %.1f ms  (%s)"
+              % ((t7 - t6) * 1000, "inotify" if w.inotify else "rescan"))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", default=LIBRARY_DB)
+    ap.add_argument("--songs", default=SONGS_DIR)
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("scan")
+    p.add_argument("--probe", action="store_true",
+                   help="also read duration / sample rate of new songs")
+    p = sub.add_parser("list")
+    p.add_argument("--missing", action="store_true")
+    p = sub.add_parser("playlist")
+    p.add_argument("name")
+    p.add_argument("songs", nargs="*")
+    p.add_argument("--m3u")
+    p = sub.add_parser("queue")
+    p.add_argument("kind", help="all | shuffle | playlist:<name>")
+    p.add_argument("--reshuffle", action="store_true")
+    p = sub.add_parser("bench")
+    p.add_argument("count", type=int, nargs="?", default=5000)
+    args = ap.parse_args()
+    lib = None if args.cmd == "bench" else Library(args.db, args.songs)
+    globals()["cmd_" + args.cmd](lib, args)
+
+
+if __name__ == "__main__":
+    main()
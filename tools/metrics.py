@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+# Query or toggle an engine's metrics endpoint:
+#   python3 tools/metrics.py led            JSON snapshot
+#   python3 tools/metrics.py audio prom     Prometheus text
+#   python3 tools/metrics.py led off        stop timing (on / reset likewise)
+import os, sys, argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+from metrics import query
+
+PATHS = {
+    "led": os.environ.get("LED_METRICS", "/tmp/musical_lights.led.metrics"),
+    "audio": os.environ.get("AUDIO_METRICS", "/tmp/musical_lights.audio.metrics"),
+}
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("engine", choices=sorted(PATHS))
+    ap.add_argument("command", nargs="?", default="json",
+                    choices=["json", "prom", "on", "off", "reset"])
+    args = ap.parse_args()
+    try:
+        sys.stdout.write(query(PATHS[args.engine], args.command))
+    except OSError as e:
+        sys.exit("%s engine not reachable at %s: %s"
+                 % (args.engine, PATHS[args.engine], e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Lead pitch accuracy vs cost on synthetic tones, per analysis window length.
+# Each tone is a random note between the lead band limits with random
+# harmonic amplitudes (sometimes a weak fundamental), slight vibrato and
+# noise.  Compares the old bin argmax, argmax + parabolic interpolation and
+# the full estimator (HPS + interpolation + sub-octave check).
+import os, sys, json, time, argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+from audio_analyzer import AudioAnalyzer, LEAD_BAND
+from pitch import PitchEstimator
+
+SR = 44100
+HOP = SR // 40
+
+
+def tone(rng, f0, n, noise):
+    t = np.arange(n) / SR
+    amps = rng.uniform(0.2, 1.0, 6)
+    if rng.random() < 0.3:
+        amps[0] *= 0.3                      # weak fundamental
+    vib = 1.0 + 0.003 * np.sin(2 * np.pi * 5.0 * t + rng.uniform(0, 6.28))
+    sig = np.zeros(n)
+    for h, a in enumerate(amps, 1):
+        if h * f0 < SR / 2:
+            sig += a * np.sin(2 * np.pi * h * f0 * np.cumsum(vib) / SR
+                              + rng.uniform(0, 6.28))
+    sig *= 0.3 / max(1.0, np.abs(sig).max() * 0.3 / 0.9)
+    sig += noise * rng.standard_normal(n)
+    return (np.clip(sig, -1, 1) * 32767).astype(np.int16)
+
+
+def argmax_pitch(an):
+    sl = an.lead
+    return float(an.freqs[sl.start + int(an.mag[sl].argmax())])
+
+
+def parabolic_pitch(an):
+    sl = an.lead
+    k = sl.start + int(an.mag[sl].argmax())
+    a, b, c = np.log(an.mag[k - 1:k + 2] + 1e-6)
+    d = a - 2 * b + c
+    delta = 0.5 * (a - c) / d if d < 0 else 0.0
+    return float((k + delta) * (an.freqs[1] - an.freqs[0]))
+
+
+def cents(f, ref):
+    return 1200.0 * np.log2(np.maximum(f, 1e-3) / ref)
+
+
+def run(hops, trials, noise, seed):
+    rng = np.random.default_rng(seed)
+    an = AudioAnalyzer(SR, HOP * hops)
+    est = PitchEstimator(an.freqs, LEAD_BAND, min_amp=0.0,
+                         dtype=an.mag.dtype)
+    methods = {"argmax": argmax_pitch, "parabolic": parabolic_pitch,
+               "estimator": lambda a: est.estimate(a.mag)[0]}
+    errs = {m: [] for m in methods}
+    cost = dict.fromkeys(methods, 0.0)
+    lo, hi = np.log2(LEAD_BAND[0] * 1.05), np.log2(LEAD_BAND[1] / 1.05)
+    for _ in range(trials):
+        f0 = 2.0 ** rng.uniform(lo, hi)
+        an.reset()
+        an.push(tone(rng, f0, HOP * hops, noise))
+        an.analyze()
+        for m, fn in methods.items():
+            t0 = time.perf_counter()
+            f = fn(an)
+            cost[m] += time.perf_counter() - t0
+            errs[m].append(cents(f, f0))
+    out = {}
+    for m in methods:
+        e = np.abs(np.asarray(errs[m]))
+        octave = np.abs(np.abs(np.asarray(errs[m])) - 1200.0) < 100.0
+        out[m] = {"median_cents": float(np.median(e)),
+                  "p90_cents": float(np.percentile(e, 90)),
+                  "note_ok": float(np.mean(e < 50.0)),
+                  "octave_errors": float(np.mean(octave)),
+                  "us_per_hop": cost[m] / trials * 1e6}
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--windows", default="1,2,3", help="window lengths in hops")
+    ap.add_argument("--trials", type=int, default=400)
+    ap.add_argument("--noise", type=float, default=0.02)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+    report = {}
+    for hops in [int(w) for w in args.windows.split(",") if w]:
+        report[hops] = run(hops, args.trials, args.noise, args.seed)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print("%-6s %-10s %10s %10s %8s %8s %8s" % ("hops", "method", "median c",
+          "p90 c", "note ok", "octave", "us/hop"))
+    for hops, res in report.items():
+        for m, r in res.items():
+            print("%-6d %-10s %10.1f %10.1f %7.1f%% %7.1f%% %8.1f"
+                  % (hops, m, r["median_cents"], r["p90_cents"],
+                     r["note_ok"] * 100, r["octave_errors"] * 100,
+                     r["us_per_hop"]))
+
+
+if __name__ == "__main__":
+    main()
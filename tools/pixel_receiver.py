@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# Stand-in for a remote pixel controller: listens for E1.31 and DDP, counts
+# complete frames and reports throughput and sequence gaps.  With --send it
+# also drives the network outputs locally at full speed.
+import os, sys, time, socket, struct, select, argparse, threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+from framebuffer import FrameBuffer
+from net_output import E131Output, DDPOutput, E131_PORT, DDP_PORT, DDP_FLAG_PUSH
+
+
+class Stats:
+    def __init__(self, name):
+        self.name = name
+        self.packets = 0
+        self.bytes = 0
+        self.frames = 0
+        self.gaps = 0
+        self.last_seq = {}
+
+    def seq(self, key, seq, nxt):
+        last = self.last_seq.get(key)
+        if last is not None and seq != nxt(last):
+            self.gaps += 1
+        self.last_seq[key] = seq
+
+
+def handle_e131(data, st, universes):
+    st.packets += 1
+    st.bytes += len(data)
+    if len(data) < 49 or data[4:16] != b"ASC-E1.17\0\0\0":
+        return
+    vector = struct.unpack_from("!I", data, 18)[0]
+    if vector == 0x00000008:        # universe sync: frame boundary
+        st.frames += 1
+        return
+    universe = struct.unpack_from("!H", data, 113)[0]
+    st.seq(universe, data[111], lambda last: (last + 1) & 0xFF)
+    sync = struct.unpack_from("!H", data, 109)[0]
+    universes.add(universe)
+    if not sync and universe == min(universes):
+        st.frames += 1              # unsynchronised: count first universe
+
+
+def handle_ddp(data, st):
+    st.packets += 1
+    st.bytes += len(data)
+    if len(data) < 10:
+        return
+    if data[1]:
+        # every packet of a frame carries the frame's sequence number
+        st.seq(struct.unpack_from("!I", data, 4)[0], data[1] & 0x0F,
+               lambda last: last % 15 + 1)
+    if data[0] & DDP_FLAG_PUSH:
+        st.frames += 1
+
+
+def sender(kind, host, count, seconds, result):
+    fb = FrameBuffer(count)
+    out = (E131Output(count, host, sync_universe=64000) if kind == "e131"
+           else DDPOutput(count, host))
+    end = time.perf_counter() + seconds
+    t0 = time.perf_counter()
+    while time.perf_counter() < end:
+        fb.pixels[:] = np.uint32(out.frames * 0x010101 & 0xFFFFFF)
+        out.show(fb)
+        time.sleep(0)
+    dt = time.perf_counter() - t0
+    result[kind] = {"frames": out.frames, "fps": out.frames / dt,
+                    "packets": out.batch.sent, "syscalls": out.batch.syscalls,
+                    "errors": out.batch.errors}
+    out.close()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--bind", default="127.0.0.1")
+    ap.add_argument("--seconds", type=float, default=0,
+                    help="stop after N seconds (0 = run forever)")
+    ap.add_argument("--send", choices=["e131", "ddp"],
+                    help="also drive that output at full speed")
+    ap.add_argument("--leds", type=int, default=1000)
+    args = ap.parse_args()
+
+    socks = {}
+    for name, port in (("e131", E131_PORT), ("ddp", DDP_PORT)):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        s.bind((args.bind, port))
+        socks[s] = Stats(name)
+    universes = set()
+    buf = bytearray(2048)
+    view = memoryview(buf)
+
+    sent = {}
+    if args.send:
+        th = threading.Thread(target=sender, daemon=True,
+                              args=(args.send, args.bind, args.leds,
+                                    args.seconds or 5.0, sent))
+        th.start()
+
+    start = last = time.monotonic()
+    end = start + args.seconds if args.seconds else None
+    if args.send and not args.seconds:
+        end = start + 5.0
+    prev = {s: 0 for s in socks}
+    while end is None or time.monotonic() < end:
+        ready, _, _ = select.select(list(socks), [], [], 0.5)
+        for s in ready:
+            n = s.recv_into(buf)
+            st = socks[s]
+            if st.name == "e131":
+                handle_e131(view[:n], st, universes)
+            else:
+                handle_ddp(view[:n], st)
+        now = time.monotonic()
+        if now - last >= 1.0:
+            for s, st in socks.items():
+                if st.packets:
+                    print("%s: %.1f frames/s, %d packets, %.1f KB, %d gaps"
+                          % (st.name, (st.frames - prev[s]) / (now - last),
+                             st.packets, st.bytes / 1024.0, st.gaps), flush=True)
+                prev[s] = st.frames
+            last = now
+    if args.send:
+        th.join()
+        print("sent:", sent.get(args.send))
+        print("received frames:", {st.name: st.frames for st in socks.values()})
+
+
+if __name__ == "__main__":
+    main()
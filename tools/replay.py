@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# Replays a state trace recorded with LED_TRACE=trace.bin:
+#   python3 tools/replay.py trace.bin                    in-process, real time
+#   python3 tools/replay.py trace.bin --speed 8          8x, or --speed max
+#   python3 tools/replay.py trace.bin --speed max --frames out.frames
+#   python3 tools/replay.py trace.bin --speed max --compare out.frames
+#   python3 tools/replay.py trace.bin --gif preview.gif
+#   python3 tools/replay.py trace.bin --live             into the running engine
+# In-process replays run a LightServer on trace time, so the rendered frames
+# only depend on the trace, the presets and --seed, never on the speed.
+import os, sys, time, struct, argparse, tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+from protocol import State, StateEncoder, SOCKET_PATH, MODE_NAMES
+from state_trace import TraceReader, FrameDumpWriter, open_frame_dump
+from framebuffer import make_output
+import led_engine
+
+led_engine.STATS_INTERVAL = float("inf")
+
+# GIF preview: one row of LEDs per frame on a 6x6x6 colour cube.  The LZW
+# stream is written as plain 9-bit literals with a clear code every
+# LZW_RUN pixels, so the code size never grows and encoding is a numpy
+# bit-pack instead of a dictionary walk.
+GIF_LEVELS = 6
+LZW_CLEAR = 256
+LZW_END = 257
+LZW_RUN = 250
+
+
+class GifWriter:
+    def __init__(self, path, count, fps, height=8, max_width=600):
+        self.count = count
+        self.step = max(1, -(-count // max_width))
+        self.width = -(-count // self.step)
+        self.height = height
+        self.delay = max(2, int(round(100.0 / fps)))
+        self.f = open(path, "wb")
+        pal = np.zeros((256, 3), dtype=np.uint8)
+        lv = np.round(np.arange(GIF_LEVELS) * 255.0 / (GIF_LEVELS - 1))
+        r, g, b = np.meshgrid(lv, lv, lv, indexing="ij")
+        pal[:GIF_LEVELS ** 3] = np.stack([r.ravel(), g.ravel(), b.ravel()], 1)
+        self.f.write(b"GIF89a" + struct.pack("<HHBBB", self.width, height,
+                                             0xF7, 0, 0))
+        self.f.write(pal.tobytes())
+        self.f.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+        self.frames = 0
+
+    def write(self, bgr):
+        q = (bgr[::self.step].astype(np.uint16) * GIF_LEVELS) >> 8
+        row = q[:, 2] * GIF_LEVELS * GIF_LEVELS + q[:, 1] * GIF_LEVELS + q[:, 0]
+        idx = np.tile(row, self.height)
+        n = idx.size
+        chunks = -(-n // LZW_RUN)
+        codes = np.empty(n + chunks + 1, dtype=np.uint16)
+        codes[np.arange(n) + np.arange(n) // LZW_RUN + 1] = idx
+        codes[np.arange(chunks) * (LZW_RUN + 1)] = LZW_CLEAR
+        codes[-1] = LZW_END
+        bits = ((codes[:, None] >> np.arange(9)) & 1).astype(np.uint8)
+        data = np.packbits(bits.ravel(), bitorder="little").tobytes()
+        f = self.f
+        f.write(b"\x21\xf9\x04\x00" + struct.pack("<H", self.delay) + b"\x00\x00")
+        f.write(b"\x2c" + struct.pack("<HHHHB", 0, 0, self.width,
+                                      self.height, 0))
+        f.write(b"\x08")
+        for i in range(0, len(data), 255):
+            block = data[i:i + 255]
+            f.write(bytes((len(block),)) + block)
+        f.write(b"\x00")
+        self.frames += 1
+
+    def close(self):
+        self.f.write(b"\x3b")
+        self.f.close()
+
+
+def pace(wall0, t, speed):
+    # Sleep until trace time t (seconds from the start) is due at `speed`.
+    if speed is None:
+        return False
+    delay = wall0 + t / speed - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+        return False
+    return delay < -0.01
+
+
+def replay_live(trace, args):
+    # Stream the trace into a running LED engine over its socket.
+    from audio_pipeline import StateSender
+    sender = StateSender(args.socket, args.priority, "replay")
+    enc = StateEncoder()
+    times = trace.records["t"]
+    st = State()
+    late = 0
+    wall0 = time.monotonic()
+    for i in range(len(trace)):
+        late += pace(wall0, times[i] - times[0], args.speed)
+        trace.state(i, st)
+        sender.send(enc.encode(st.mode, st.note, st.level, st.gliss, st.kick,
+                               st.snare, st.phase, st.tempo, st.downbeat))
+    sender.close()
+    print("states   %d sent, %d dropped, %d late"
+          % (sender.sent, sender.dropped, late))
+
+
+def replay(trace, args):
+    fps = args.fps or trace.fps
+    led_engine.LED_FPS = fps
+    output = make_output(args.output, trace.count, pin=led_engine.LED_PIN,
+                         freq_hz=led_engine.LED_FREQ_HZ, dma=led_engine.LED_DMA,
+                         invert=led_engine.LED_INVERT,
+                         brightness=led_engine.LED_BRIGHTNESS,
+                         channel=led_engine.LED_CHANNEL,
+                         strip_type=led_engine.LED_STRIP_TYPE)
+    with tempfile.TemporaryDirectory() as d:
+        srv = led_engine.LightServer(trace.count, output,
+                                     os.path.join(d, "replay.sock"),
+                                     presets=args.presets)
+    srv.effects.rng = np.random.default_rng(args.seed)
+    dump = FrameDumpWriter(args.frames, srv.count, fps) if args.frames else None
+    gif = GifWriter(args.gif, srv.count, args.gif_fps) if args.gif else None
+    gif_every = max(1, int(round(fps / args.gif_fps)))
+    ref = None
+    if args.compare:
+        ref, _ = open_frame_dump(args.compare)
+        if ref.shape[1] != srv.count:
+            sys.exit("%s: %d LEDs, trace has %d"
+                     % (args.compare, ref.shape[1], srv.count))
+    # frames as pushed, i.e. after the output stage
+    bgr = srv.out_fb.pixels.view(np.uint8).reshape(srv.count, 4)[:, :3]
+
+    times = trace.records["t"]
+    n = len(trace)
+    period = 1.0 / fps
+    t0 = float(times[0])
+    end = float(times[-1]) + args.tail
+    frame_times = []
+    peak_ma = 0.0
+    modes = {}
+    diff_frames = 0
+    first_diff = None
+    late = 0
+    i = 0
+    k = 0
+    wall0 = time.monotonic()
+    while True:
+        t = t0 + k * period
+        if t > end:
+            break
+        late += pace(wall0, t - t0, args.speed)
+        while i < n and times[i] <= t:
+            srv.update(trace.state(i), float(times[i]))
+            i += 1
+        c0 = time.perf_counter()
+        srv.show_frame(t)
+        frame_times.append(time.perf_counter() - c0)
+        peak_ma = max(peak_ma, srv.stage.estimated_ma)
+        modes[srv.cur.mode] = modes.get(srv.cur.mode, 0) + 1
+        if dump is not None:
+            dump.write(srv.out_fb)
+        if gif is not None and k % gif_every == 0:
+            gif.write(bgr)
+        if ref is not None:
+            if k >= len(ref) or not np.array_equal(ref[k], bgr):
+                diff_frames += 1
+                if first_diff is None:
+                    px = (srv.count if k >= len(ref) else
+                          int(np.any(ref[k] != bgr, axis=1).sum()))
+                    first_diff = (k, px)
+        k += 1
+    wall = time.monotonic() - wall0
+    srv.server.close()
+    srv.output.close()
+    if dump is not None:
+        dump.close()
+    if gif is not None:
+        gif.close()
+
+    ms = np.asarray(frame_times) * 1000.0
+    print("trace    %d states, %.1f s, %d LEDs" % (n, trace.duration, trace.count))
+    print("frames   %d in %.2f s (%.0f fps, %s)"
+          % (k, wall, k / wall if wall > 0 else 0.0,
+             "max speed" if args.speed is None else "%gx, %d late"
+             % (args.speed, late)))
+    print("frame    p50 %.3f ms  p99 %.3f ms  max %.3f ms  (render + push)"
+          % (np.percentile(ms, 50), np.percentile(ms, 99), ms.max()))
+    print("current  peak %.2f A estimated, %d frames limited to %.2f A"
+          % (peak_ma / 1000.0, srv.stage.limited_frames,
+             srv.stage.budget_ma / 1000.0))
+    print("modes    " + ", ".join("%s %d" % (MODE_NAMES.get(m, m), c)
+                                  for m, c in sorted(modes.items())))
+    if dump is not None:
+        print("dumped   %d frames to %s" % (dump.frames, args.frames))
+    if gif is not None:
+        print("preview  %d frames to %s" % (gif.frames, args.gif))
+    if ref is not None:
+        if len(ref) > k:
+            diff_frames += len(ref) - k
+        if diff_frames:
+            print("compare  %d of %d frames differ, first at frame %d "
+                  "(%d LEDs)" % (diff_frames, max(k, len(ref)),
+                                 first_diff[0] if first_diff else k,
+                                 first_diff[1] if first_diff else 0))
+            sys.exit(1)
+        print("compare  identical (%d frames)" % k)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("trace")
+    ap.add_argument("--speed", default="1",
+                    help="replay speed factor, or 'max' for as fast as possible")
+    ap.add_argument("--seed", type=int, default=0,
+                    help="seed for the random effects (sparkle, tree)")
+    ap.add_argument("--fps", type=float, help="frame rate (default: recorded)")
+    ap.add_argument("--tail", type=float, default=1.0,
+                    help="seconds rendered after the last state")
+    ap.add_argument("--presets", help="presets file (default: LED_PRESETS)")
+    ap.add_argument("--output", default="null", choices=("null", "ws281x"))
+    ap.add_argument("--frames", help="dump every rendered frame to this file")
+    ap.add_argument("--compare", help="frame dump to compare against")
+    ap.add_argument("--gif", help="write an animated preview")
+    ap.add_argument("--gif-fps", type=float, default=20.0)
+    ap.add_argument("--live", action="store_true",
+                    help="send the states to the running LED engine instead")
+    ap.add_argument("--socket", default=SOCKET_PATH)
+    ap.add_argument("--priority", type=int, default=200,
+                    help="producer priority for --live")
+    args = ap.parse_args()
+    args.speed = None if args.speed == "max" else float(args.speed)
+    if args.speed is not None and args.speed <= 0:
+        ap.error("--speed must be positive or 'max'")
+
+    trace = TraceReader(args.trace)
+    if not len(trace):
+        sys.exit("%s: no states recorded" % args.trace)
+    if args.live:
+        if args.frames or args.compare or args.gif:
+            ap.error("--frames, --compare and --gif need an in-process replay")
+        replay_live(trace, args)
+    else:
+        replay(trace, args)
+
+
+if __name__ == "__main__":
+    main()